@@ -0,0 +1,300 @@
+"""
+Admission Control for Expensive Endpoints
+Caps how many generations / image jobs run at once in a worker. Extra
+requests wait in a bounded FIFO queue for at most a queue-time deadline;
+anything beyond that is rejected immediately with a Retry-After hint
+instead of piling up upstream sessions and multi-megapixel resizes.
+
+Queued requests are grouped by caller identity (the credential they bring,
+or their address) and served round-robin, weighted per identity, with a
+cap on how many requests one identity may have in flight. One user's burst
+of 4-image generations therefore can't starve everyone else's quick turns.
+
+Works from both sync (Flask threads) and async (ASGI) handlers.
+"""
+
+import asyncio
+import contextlib
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted (queue full or waited too long)"""
+
+    def __init__(self, gate, reason, status, retry_after):
+        super().__init__(f"{gate}: {reason}")
+        self.gate = gate
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    """A queued request: a threading.Event for sync callers, a Future for async ones"""
+
+    __slots__ = ('loop', 'event', 'future', 'granted', 'enqueued_at', 'identity')
+
+    def __init__(self, identity, loop=None):
+        self.identity = identity
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class AdmissionGate:
+    """
+    Concurrency limit + bounded, fair-share wait queue for one endpoint.
+
+    Each identity has its own FIFO queue. When a slot frees up, identities
+    with queued work are visited round-robin; an identity with weight w is
+    served up to w times before the turn passes on. Identities already at
+    per_identity_inflight running requests are skipped until one finishes.
+
+    Rejections:
+        429 'queue_full'     - the wait queue (or the identity's share of it) is full
+        503 'queue_timeout'  - waited longer than queue_timeout seconds
+    """
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout,
+                 per_identity_inflight=None, per_identity_queue=None):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.per_identity_inflight = per_identity_inflight or self.max_concurrent
+        self.per_identity_queue = per_identity_queue or self.max_queue
+
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # identity -> deque of waiters, in round-robin order
+        self._queued = 0
+        self._inflight = {}           # identity -> running requests
+        self._weights = {}            # identity -> weight of its queued work
+        self._credit = {}             # identity -> grants left in its current turn
+        self._running = 0
+
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.max_queue_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._recent_waits = deque(maxlen=1000)
+        self._service_ewma = None
+
+    # --- core state transitions (caller holds the lock) ---
+
+    def _try_enter(self, identity, weight, loop=None):
+        """Admit now, or enqueue. Returns None when admitted, else the waiter."""
+        if (self._running < self.max_concurrent
+                and self._inflight.get(identity, 0) < self.per_identity_inflight
+                and identity not in self._queues):
+            self._start(identity)
+            return None
+
+        queue = self._queues.get(identity)
+        if self._queued >= self.max_queue or (queue and len(queue) >= self.per_identity_queue):
+            self.rejected_full += 1
+            raise AdmissionRejected(self.name, 'queue_full', 429, self._retry_after())
+
+        waiter = _Waiter(identity, loop)
+        if queue is None:
+            queue = self._queues[identity] = deque()
+            self._credit[identity] = max(1, int(weight))
+        self._weights[identity] = max(1, int(weight))
+        queue.append(waiter)
+        self._queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queued)
+        return waiter
+
+    def _start(self, identity):
+        self._running += 1
+        self._inflight[identity] = self._inflight.get(identity, 0) + 1
+
+    def _next_waiter(self):
+        """Weighted round-robin over identities that are under their in-flight cap"""
+        for identity in list(self._queues):
+            if self._inflight.get(identity, 0) >= self.per_identity_inflight:
+                continue
+
+            queue = self._queues[identity]
+            waiter = queue.popleft()
+            self._queued -= 1
+            self._credit[identity] -= 1
+
+            if not queue:
+                del self._queues[identity]
+                self._credit.pop(identity, None)
+                self._weights.pop(identity, None)
+            elif self._credit[identity] <= 0:
+                # Turn used up: go to the back of the rotation
+                self._queues.move_to_end(identity)
+                self._credit[identity] = self._weights[identity]
+            return waiter
+        return None
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._start(waiter.identity)
+            waiter.granted = True
+            waiter.wake()
+
+    def _abandon(self, waiter, timed_out=True):
+        """Stop waiting. Returns True if the waiter was granted a slot in the meantime."""
+        if waiter.granted:
+            return True
+        queue = self._queues[waiter.identity]
+        queue.remove(waiter)
+        self._queued -= 1
+        if not queue:
+            del self._queues[waiter.identity]
+            self._credit.pop(waiter.identity, None)
+            self._weights.pop(waiter.identity, None)
+        if timed_out:
+            self.rejected_timeout += 1
+        return False
+
+    def _admitted(self, waited):
+        self.admitted += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        self._recent_waits.append(waited)
+
+    def _leave(self, identity, service_time):
+        # EWMA of service time drives the Retry-After estimate
+        if self._service_ewma is None:
+            self._service_ewma = service_time
+        else:
+            self._service_ewma = 0.8 * self._service_ewma + 0.2 * service_time
+
+        self._running -= 1
+        remaining = self._inflight.get(identity, 1) - 1
+        if remaining > 0:
+            self._inflight[identity] = remaining
+        else:
+            self._inflight.pop(identity, None)
+        self._dispatch()
+
+    def _retry_after(self):
+        service = self._service_ewma or 5.0
+        backlog = self._queued + self._running
+        return max(1, int(service * backlog / self.max_concurrent + 0.5))
+
+    # --- public API ---
+
+    @contextlib.contextmanager
+    def admit(self, identity=None, weight=1):
+        """
+        Blocking admission for sync handlers
+        Args:
+            identity: fair-share key (credential id, client address); None shares one queue
+            weight: turns this identity gets per round-robin cycle
+        """
+        with self._lock:
+            waiter = self._try_enter(identity, weight)
+
+        waited = 0.0
+        if waiter is not None:
+            waiter.event.wait(self.queue_timeout)
+            with self._lock:
+                if not self._abandon(waiter):
+                    raise AdmissionRejected(self.name, 'queue_timeout', 503, self._retry_after())
+            waited = time.monotonic() - waiter.enqueued_at
+
+        with self._lock:
+            self._admitted(waited)
+
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            with self._lock:
+                self._leave(identity, time.monotonic() - started)
+
+    @contextlib.asynccontextmanager
+    async def admit_async(self, identity=None, weight=1):
+        """Non-blocking admission for async handlers (see admit)"""
+        with self._lock:
+            waiter = self._try_enter(identity, weight, asyncio.get_running_loop())
+
+        waited = 0.0
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if not self._abandon(waiter):
+                        raise AdmissionRejected(self.name, 'queue_timeout', 503, self._retry_after())
+            except asyncio.CancelledError:
+                # Client went away while queued; hand on the slot if we were just given one
+                with self._lock:
+                    if self._abandon(waiter, timed_out=False):
+                        self._leave(identity, 0.0)
+                raise
+            waited = time.monotonic() - waiter.enqueued_at
+
+        with self._lock:
+            self._admitted(waited)
+
+        started = time.monotonic()
+        try:
+            yield waited
+        finally:
+            with self._lock:
+                self._leave(identity, time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._recent_waits)
+            p95 = waits[int(0.95 * (len(waits) - 1))] if waits else 0.0
+            return {
+                'running': self._running,
+                'max_concurrent': self.max_concurrent,
+                'queue_depth': self._queued,
+                'max_queue': self.max_queue,
+                'active_identities': len(self._inflight),
+                'queued_identities': len(self._queues),
+                'per_identity_inflight': self.per_identity_inflight,
+                'max_queue_depth_seen': self.max_queue_depth,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_full,
+                'rejected_queue_timeout': self.rejected_timeout,
+                'avg_wait_ms': round(self._wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+                'p95_wait_ms': round(p95 * 1000, 1),
+                'max_wait_ms': round(self._wait_max * 1000, 1),
+            }
+
+
+def gate_from_env(name, max_concurrent, max_queue, queue_timeout, per_identity_inflight=None, per_identity_queue=None):
+    """
+    Build a gate, overridable with ADMISSION_<NAME>_CONCURRENCY / _QUEUE / _QUEUE_TIMEOUT
+    and the fair-share limits ADMISSION_<NAME>_PER_USER_INFLIGHT / _PER_USER_QUEUE
+    """
+    prefix = f'ADMISSION_{name.upper()}'
+    per_identity_inflight = os.getenv(f'{prefix}_PER_USER_INFLIGHT', per_identity_inflight)
+    per_identity_queue = os.getenv(f'{prefix}_PER_USER_QUEUE', per_identity_queue)
+    return AdmissionGate(
+        name,
+        max_concurrent=int(os.getenv(f'{prefix}_CONCURRENCY', str(max_concurrent))),
+        max_queue=int(os.getenv(f'{prefix}_QUEUE', str(max_queue))),
+        queue_timeout=float(os.getenv(f'{prefix}_QUEUE_TIMEOUT', str(queue_timeout))),
+        per_identity_inflight=int(per_identity_inflight) if per_identity_inflight else None,
+        per_identity_queue=int(per_identity_queue) if per_identity_queue else None,
+    )
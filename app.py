@@ -3,26 +3,78 @@ Gemini Web Integration - Backend Server
 Uses cookie-based authentication with real Gemini API for image generation
 """
 
-from flask import Flask, render_template, request, jsonify, send_from_directory, Response
+from flask import Flask, render_template, request, jsonify, abort, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import wrap_file
 import os
 import time
 import base64
 import asyncio
-import requests
-from io import BytesIO
-from PIL import Image, ImageEnhance
+import concurrent.futures
+import contextlib
+import hashlib
+import resource
 from dotenv import load_dotenv, set_key
 import json
+import gemini_webapi.client
 from gemini_webapi import GeminiClient as RealGeminiClient
+from gemini_webapi.exceptions import AuthError, UsageLimitExceededError, TemporarilyBlockedError
 import io
+import functools
+from async_runtime import background_loop, run_async
+from chat_store import store_from_env as chat_store_from_env
+from state_backend import backend_from_env as state_backend_from_env
+from cookie_pool import credential_id, pool_from_env as cookie_pool_from_env
+import retry_policy
+from admission import AdmissionRejected, gate_from_env
+import metrics
+import tracing
+import image_ingest
+from image_ops import ImageOpError
+from image_workers import pool_from_env as image_pool_from_env
+from upscale_cache import cache_from_env as upscale_cache_from_env
+from history_index import index_from_env as history_index_from_env
+from static_assets import assets_from_env as static_assets_from_env
+from image_variants import variants_from_env as image_variants_from_env
+from output_storage import store_from_env as output_store_from_env
+from attachment_cache import cache_from_env as attachment_cache_from_env
+from zip_stream import stream_zip
 # from enhancer import ImageEnhancer
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app)
+# /static is served by send_static below (caching headers, precompressed variants, sendfile)
+app = Flask(__name__, static_folder=None)
+CORS(app, expose_headers=[tracing.TRACE_HEADER])
+
+# X-Forwarded-For is only believed from this many trusted proxies in front of the app
+# (0 = none: request.remote_addr is the peer, and forwarded headers are ignored)
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+
+@app.before_request
+def begin_trace():
+    """Start a trace per request, continuing the caller's X-Trace-Id if it sent one"""
+    tracing.start_trace(request.headers.get(tracing.TRACE_HEADER))
+
+
+@app.after_request
+def expose_trace_id(response):
+    trace_id = tracing.current_trace_id()
+    if trace_id:
+        response.headers[tracing.TRACE_HEADER] = trace_id
+    return response
+
+
+@app.teardown_request
+def finish_trace(exc):
+    # Runs after streamed responses finish, so batch endpoints report their whole run
+    tracing.finish_trace(request.endpoint)
+
 
 # Log startup to help identify cold starts in logs
 print("🚀 Server starting up... (Cold Start Re-initialization)")
@@ -32,18 +84,114 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 
+# Generation deadline (seconds) and retry/backoff policy for Gemini calls
+GENERATION_DEADLINE = float(os.getenv('GENERATION_DEADLINE', '180'))
+RETRY_POLICY = retry_policy.policy_from_env()
+
+# Batch generation: max prompts per request and overall time budget (seconds)
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+BATCH_DEADLINE = float(os.getenv('BATCH_DEADLINE', '1800'))
+UPSCALE_BATCH_MAX_ITEMS = int(os.getenv('UPSCALE_BATCH_MAX_ITEMS', '16'))
+# ZIP export (/api/export): max images per archive
+EXPORT_MAX_ITEMS = int(os.getenv('EXPORT_MAX_ITEMS', '100'))
+
+# Admission control for expensive endpoints, fair-shared between callers:
+# (max concurrent, max queued, max seconds in queue, in-flight per user, queued per user)
+# Override via ADMISSION_<NAME>_* env vars
+CPU_COUNT = os.cpu_count() or 1
+
+# CPU budget for image processing (IMAGE_WORKERS, default one per core; IMAGE_WORKER_MODE thread|process)
+IMAGE_WORKERS = image_pool_from_env()
+
+# Upscaled outputs, stored under static/upscaled and reused for repeat upscales
+UPSCALE_CACHE = upscale_cache_from_env(os.path.join(app.root_path, 'static'))
+
+# Searchable index of generated images (SQLite in the instance folder)
+HISTORY = history_index_from_env(app.instance_path)
+# History is private to the browser session that generated it; HISTORY_PUBLIC=1
+# turns /api/history into a gallery of everyone's images
+HISTORY_PUBLIC = os.getenv('HISTORY_PUBLIC', '0').lower() in ('1', 'true', 'yes')
+
+def transcode_image(data, fmt, consume):
+    """The 'transcode' image operation, for IMAGE_VARIANTS"""
+    output, info = run_image_op('transcode', data, consume=consume, fmt=fmt)
+    for stage, seconds in info['stages'].items():
+        tracing.record_stage(stage, seconds)
+    return output, info
+
+
+# WebP/AVIF transcodes of generated images, made on first request by the image workers
+IMAGE_VARIANTS = image_variants_from_env(transcode_image)
+
+# Where generated images are persisted (OUTPUT_STORAGE local|s3, optional write-behind)
+GENERATED_OUTPUTS = output_store_from_env(os.path.join(app.root_path, 'static'))
+
+# Fingerprinted URLs and precompressed variants for static/ (templates use asset_url)
+STATIC_ASSETS = static_assets_from_env(
+    os.path.join(app.root_path, 'static'), app.instance_path,
+    variants=IMAGE_VARIANTS, outputs={'generated': GENERATED_OUTPUTS}
+)
+app.jinja_env.globals['asset_url'] = STATIC_ASSETS.url
+
+ADMISSION_GATES = {
+    'generate': gate_from_env('generate', 4, 16, 30, per_identity_inflight=2, per_identity_queue=4),
+    'chat': gate_from_env('chat', 16, 64, 30, per_identity_inflight=2, per_identity_queue=4),
+    'upscale': gate_from_env('upscale', CPU_COUNT, 8, 15, per_identity_inflight=2, per_identity_queue=4),
+    'upload': gate_from_env('upload', CPU_COUNT * 2, 16, 10, per_identity_inflight=2, per_identity_queue=4),
+}
+
+def parse_fair_share_weights(spec):
+    """
+    "identity:weight,identity:weight" -> {identity: weight}
+    (identities are the ids shown in /api/stats, or "ip:<address>"). Invalid entries are skipped.
+    """
+    weights = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        key, _, value = item.rpartition(':')
+        try:
+            weight = int(value)
+        except ValueError:
+            weight = 0
+        if not key.strip() or weight < 1:
+            print(f"⚠️ Ignoring invalid FAIR_SHARE_WEIGHTS entry: {item.strip()!r}")
+            continue
+        weights[key.strip()] = weight
+    return weights
+
+
+# Optional fair-share weights per caller identity
+FAIR_SHARE_WEIGHTS = parse_fair_share_weights(os.getenv('FAIR_SHARE_WEIGHTS', ''))
+
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# State shared by all workers and nodes (STATE_BACKEND local|redis): chat sessions, primary cookies
+SHARED_STATE = state_backend_from_env()
+
 # Gemini Cookies from environment
 GEMINI_COOKIES = {
     '__Secure-1PSID': os.getenv('GEMINI_COOKIE_1PSID', ''),
     '__Secure-1PSIDTS': os.getenv('GEMINI_COOKIE_1PSIDTS', '')
 }
+# Cookies updated via /api/update_cookies on any worker win over this process's .env
+GEMINI_COOKIES.update(SHARED_STATE.get('credentials', 'primary') or {})
+
+# Server-side accounts: the primary pair above plus GEMINI_COOKIE_1PSID_2, _3, ...
+COOKIE_POOL = cookie_pool_from_env(GEMINI_COOKIES)
+POOL_EXHAUSTED_ERROR = 'All Gemini accounts are cooling down after failures or rate limits. Please retry shortly.'
+
 
+# Per-session Chat History (Manual Context Management)
+# Keyed by the chat session id from the cookie / X-Chat-Session header
+CHAT_HISTORY = chat_store_from_env(SHARED_STATE)
+CHAT_SESSION_COOKIE = 'chat_session'
+CHAT_SESSION_HEADER = 'X-Chat-Session'
 
-# Global Chat History (Manual Context Management)
-CHAT_HISTORY = []
+# Chat image attachments: decoded once and uploaded to Gemini once per account
+CHAT_ATTACHMENTS = attachment_cache_from_env(app.instance_path, SHARED_STATE)
+CHAT_ATTACHMENTS.install(gemini_webapi.client)
 
 class GeminiClient:
     """
@@ -54,11 +202,10 @@ class GeminiClient:
     def __init__(self, cookies):
         self.cookies = cookies
         self.client = None
-        self.chat_session = None
         self._initialize_client()
         
-    def _initialize_client(self):
-        """Initialize the real Gemini client"""
+    def _initialize_client(self, verify=True):
+        """Initialize the real Gemini client (verify=False skips the "Hello" handshake)"""
         try:
             # Extract cookie values
             psid = self.cookies.get('__Secure-1PSID', '')
@@ -73,21 +220,16 @@ class GeminiClient:
             # gemini-webapi expects: GeminiClient(Secure_1PSID, Secure_1PSIDTS)
             # NOT keyword arguments!
             self.client = RealGeminiClient(psid, psidts)
+            if not verify:
+                return
             
             # Verify the session is actually valid
             print("🔄 Verifying session connectivity...")
             try:
                 # Minimal test to check if cookies work
-                import asyncio
-                try:
-                    # Using generate_content ("Hello") as handshake
-                    asyncio.run(self.client.generate_content("Hello"))
-                except RuntimeError:
-                    # Fallback for nested loops if necessary
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(self.client.generate_content("Hello"))
-                    loop.close()
+                # Using generate_content ("Hello") as handshake. Runs on the shared
+                # background loop so the client stays usable for later requests.
+                run_async(self.client.generate_content("Hello"))
                     
                 print(f"✅ Gemini client initialized and VERIFIED successfully!")
                 print(f"   PSID: {psid[:30]}...")
@@ -107,6 +249,10 @@ class GeminiClient:
         """Check if cookies are valid"""
         target_cookies = cookies or self.cookies
         
+        # Extra pooled accounts can serve requests even if the primary pair is missing
+        if not cookies and any(account.configured for account in COOKIE_POOL.accounts[1:]):
+            return True, "Cookie pool configured"
+        
         if not target_cookies.get('__Secure-1PSID'):
             return False, "Missing __Secure-1PSID cookie"
         
@@ -116,45 +262,81 @@ class GeminiClient:
         
         return True, "Cookies are valid"
     
+    def select_cookies(self, cookies=None, prefer=None):
+        """
+        Pick credentials for a request: the caller's own cookies, or a pooled server account.
+        Returns:
+            (cookies, account) - account is None for user cookies;
+            cookies is None when every pooled account is cooling down
+        """
+        if cookies and cookies.get('__Secure-1PSID'):
+            return cookies, None
+        
+        account = COOKIE_POOL.acquire(prefer=prefer)
+        if account is None:
+            return None, None
+        return account.cookies, account
+
     def generate_text(self, prompt):
         """
         Generate text using Gemini
         Used for prompt enhancement
         """
+        # Since gemini-webapi is async, we submit it to the background loop
+        # that owns self.client instead of spinning up a new loop per call.
+        return run_async(self.generate_text_async(prompt))
+
+    async def generate_text_async(self, prompt):
+        """Async version of generate_text (must run on the background loop)"""
         if not self.client:
             return {"success": False, "error": "Gemini client not initialized"}
             
         try:
             # Send text request using generate_content (standard Gemini API)
-            # Since gemini-webapi is async, we must await it.
-            # Using asyncio.run to handle the coroutine in this synchronous context.
-            response = asyncio.run(self.client.generate_content(prompt))
+            response = await self.client.generate_content(prompt)
             
             # Access text attribute safely
             return {"success": True, "text": response.text}
         except Exception as e:
             print(f"❌ Text generation error: {e}")
-            # If asyncio.run fails due to existing loop (unlikely in sync Flask), fall back
-            if "event loop is already running" in str(e):
-                loop = asyncio.get_event_loop()
-                response = loop.run_until_complete(self.client.generate_content(prompt))
-                return {"success": True, "text": response.text}
-                
             return {"success": False, "error": str(e)}
 
-    def generate_images(self, prompt, aspect_ratio='square', quantity=4, reference_image=None, style_preset=None, hd_mode=False, cookies=None):
+    def generate_images(self, prompt, aspect_ratio='square', quantity=4, reference_image=None, style_preset=None, hd_mode=False, cookies=None, owner=None):
         """
         Generate images using real Gemini API
         Args:
             cookies: Optional dict override
+            owner: history owner key the images are indexed under (see history_owner)
+        """
+        # The whole pipeline runs on the background loop; this thread just waits for the result.
+        return run_async(self.generate_images_async(
+            prompt,
+            aspect_ratio=aspect_ratio,
+            quantity=quantity,
+            reference_image=reference_image,
+            style_preset=style_preset,
+            hd_mode=hd_mode,
+            cookies=cookies,
+            owner=owner
+        ))
+
+    async def generate_images_async(self, prompt, aspect_ratio='square', quantity=4, reference_image=None, style_preset=None, hd_mode=False, cookies=None, client_cache=None, owner=None):
+        """
+        Async version of generate_images (used directly by the ASGI app)
+        Image download/crop runs in worker threads so the loop stays free.
+        
+        client_cache: optional dict shared by several generations (see generate_batch_async);
+        initialized upstream clients are reused from it per credential and left open
+        for the owner of the cache to close.
         """
-        # Determine cookies
-        current_cookies = cookies or self.cookies
-        if not current_cookies or not current_cookies.get('__Secure-1PSID'):
-             global GEMINI_COOKIES
-             current_cookies = GEMINI_COOKIES
+        # Determine cookies (user override, else least-loaded healthy pool account)
+        current_cookies, account = self.select_cookies(cookies)
+        if current_cookies is None:
+            return {'success': False, 'error': POOL_EXHAUSTED_ERROR, 'retry_after': COOKIE_POOL.retry_after()}
         
         start_time = time.time()
+        # Carried into every upstream call; partial results are returned when it runs out
+        deadline = retry_policy.Deadline(GENERATION_DEADLINE)
         
         try:
             # Map aspect ratios
@@ -208,7 +390,8 @@ class GeminiClient:
             # Add Negative Prompt (Subtle)
             generation_prompt += " --no grid, collage, text, watermark, blur"
 
-            print(f"🎨 Generating with simplified prompt: {generation_prompt}")
+            tracing.log('generation_start', prompt=generation_prompt, quantity=quantity,
+                        aspect_ratio=aspect_ratio, account=account.name if account else 'user')
             
             # Handling Reference Image (Multimodal)
             temp_ref_path = None
@@ -234,7 +417,7 @@ class GeminiClient:
                         f.write(ref_data)
                         
                     generation_files = [temp_ref_path]
-                    print(f"📎 Attached reference image: {temp_ref_path}")
+                    tracing.log('reference_attached', path=temp_ref_path)
                     
                     # For Img2Img, keep it simple too
                     generation_prompt = f"Make a variation of this image: {prompt}"
@@ -242,40 +425,79 @@ class GeminiClient:
                         generation_prompt += f" in {style_preset} style"
                         
                 except Exception as e:
-                    print(f"⚠️ Failed to process reference image: {e}")
+                    tracing.log('reference_failed', level='warning', error=str(e))
             
             # Gemini web interface typically only returns 1-2 images per request
             # So we'll make multiple requests if needed to reach the desired quantity
             all_generated_images = []
             attempts = 0
-            # Increase limits to support 4 images reliably
-            max_attempts = quantity * 3 + 2 
-            max_duration = 180 # 3 minutes soft limit to allow for 4 images
+            stop_reason = retry_policy.STOP_COMPLETED
             
             # Unified Async Handler to prevent "Event Loop Closed" errors
-            async def run_gemini_session():
+            async def open_client():
                 client = RealGeminiClient(
                     current_cookies.get('__Secure-1PSID'), 
                     current_cookies.get('__Secure-1PSIDTS')
                 )
+                # Initialize within the same loop
+                try:
+                    with tracing.stage('client_init'):
+                        await client.init(timeout=min(30, max(1, deadline.remaining())), auto_close=False)
+                except Exception as e:
+                    COOKIE_POOL.record_failure(account, e)
+                    raise
+                return client
+            
+            async def run_gemini_session():
+                shared = client_cache is not None
+                if shared:
+                    # One init per credential for the whole batch; concurrent items await the same task
+                    key = credential_id(current_cookies)
+                    if key not in client_cache:
+                        client_cache[key] = asyncio.ensure_future(open_client())
+                    try:
+                        client = await asyncio.shield(client_cache[key])
+                    except Exception:
+                        client_cache.pop(key, None)
+                        raise
+                else:
+                    client = await open_client()
                 
                 try:
-                    # Initialize within the same loop
-                    await client.init(timeout=30, auto_close=False)
                     
                     generated_results = []
                     current_attempts = 0
+                    # Increase limits to support 4 images reliably
                     max_retries = quantity * 3 + 2
+                    failures = {}  # failure class -> count, drives per-class backoff
+                    reason = retry_policy.STOP_COMPLETED
                     
-                    while len(generated_results) < quantity and current_attempts < max_retries:
+                    while len(generated_results) < quantity:
+                        if current_attempts >= max_retries:
+                            reason = retry_policy.STOP_MAX_ATTEMPTS
+                            break
+                        if deadline.remaining() < RETRY_POLICY.min_attempt_time:
+                            reason = retry_policy.STOP_DEADLINE
+                            break
+                        
                         current_attempts += 1
-                        print(f"📸 Attempt {current_attempts}: Requesting images (have {len(generated_results)}/{quantity})")
+                        tracing.log('attempt_start', attempt=current_attempts, have=len(generated_results),
+                                    quantity=quantity, remaining_s=round(deadline.remaining(), 1))
                         
                         try:
-                            resp = await client.generate_content(generation_prompt, files=generation_files)
+                            attempt_start = time.time()
+                            try:
+                                resp = await asyncio.wait_for(
+                                    client.generate_content(generation_prompt, files=generation_files),
+                                    timeout=deadline.remaining()
+                                )
+                            finally:
+                                tracing.record_stage('generate_content', time.time() - attempt_start)
+                            COOKIE_POOL.record_success(account, time.time() - attempt_start)
                             
                             if hasattr(resp, 'images') and resp.images:
-                                 print(f"✅ Received {len(resp.images)} images from Gemini")
+                                 metrics.GENERATION_ATTEMPTS.inc(outcome='images')
+                                 tracing.log('attempt_images', attempt=current_attempts, images=len(resp.images))
                                  for img in resp.images:
                                      if len(generated_results) >= quantity:
                                          break
@@ -288,44 +510,71 @@ class GeminiClient:
                                          'title': getattr(img, 'title', 'Generated Image'),
                                          'alt': getattr(img, 'alt', prompt[:100])
                                      })
-                            else:
-                                 print(f"⚠️ No images in response")
-                                 await asyncio.sleep(1)
+                                 continue
+                            
+                            tracing.log('attempt_empty', level='warning', attempt=current_attempts)
+                            metrics.GENERATION_ATTEMPTS.inc(outcome='empty')
+                            metrics.EMPTY_RESPONSES.inc()
+                            failure_class = retry_policy.EMPTY
                                  
                         except Exception as e:
-                            print(f"⚠️ Generation error in loop: {e}")
-                            await asyncio.sleep(1)
+                            if deadline.expired():
+                                metrics.GENERATION_ATTEMPTS.inc(outcome='deadline')
+                                tracing.log('attempt_deadline', level='warning', attempt=current_attempts)
+                                reason = retry_policy.STOP_DEADLINE
+                                break
+                            
+                            failure_class = retry_policy.classify_failure(e)
+                            metrics.GENERATION_ATTEMPTS.inc(outcome=failure_class)
+                            tracing.log('attempt_failed', level='warning', attempt=current_attempts,
+                                        failure_class=failure_class, error=str(e))
+                            if COOKIE_POOL.record_failure(account, e):
+                                # Account's circuit opened (rate limit / repeated failures)
+                                reason = retry_policy.STOP_CIRCUIT_OPEN
+                                break
+                            if not RETRY_POLICY.retryable(failure_class):
+                                reason = retry_policy.STOP_AUTH
+                                break
+                        
+                        # Jittered exponential backoff for this failure class
+                        failures[failure_class] = failures.get(failure_class, 0) + 1
+                        delay = RETRY_POLICY.delay(failure_class, failures[failure_class])
+                        if delay + RETRY_POLICY.min_attempt_time > deadline.remaining():
+                            reason = retry_policy.STOP_DEADLINE
+                            break
+                        await asyncio.sleep(delay)
                     
-                    return generated_results, current_attempts
+                    return generated_results, current_attempts, reason
 
                 finally:
                     # CRITICAL FIX: Ensure client is closed to prevent timeouts/stale sessions
-                    print("🔒 Closing Gemini session...")
+                    # (shared clients are closed by the cache owner)
                     try:
-                        await client.close()
-                        print("✅ Gemini session closed")
+                        if not shared:
+                            await client.close()
                     except Exception as e:
-                        print(f"⚠️ Error closing session: {e}")
+                        tracing.log('session_close_failed', level='warning', error=str(e))
 
             # Run the unified async session
             try:
-                # asyncio.run creates a new loop, runs the function, and closes it.
-                raw_images, total_attempts = asyncio.run(run_gemini_session())
+                raw_images, total_attempts, stop_reason = await run_gemini_session()
                 attempts = total_attempts
                 
-                # Process images (Download & Resize) - Done SYNCHRONOUSLY after loop is closed
+                # Process images (Download & Resize) - Blocking work goes to a worker thread
                 for img_data in raw_images:
                     original_url = img_data['original_url']
                     
                     if any(img['original_url'] == original_url for img in all_generated_images):
                         continue
-                        
-                    print(f"📐 Process image: {original_url[:50]}...")
-                    processed_path = enforce_aspect_ratio(original_url, aspect_ratio, cookies=current_cookies)
+                    
+                    # Stages recorded in the worker thread are attributed to this image
+                    with tracing.image(len(all_generated_images) + 1):
+                        processed_path = await asyncio.to_thread(
+                            enforce_aspect_ratio, original_url, aspect_ratio, cookies=current_cookies
+                        )
                     
                     if processed_path:
                          final_url = processed_path
-                         print(f"✅ Processed successfully")
                     else:
                          # Fallback Proxy
                          from urllib.parse import quote
@@ -335,7 +584,8 @@ class GeminiClient:
                              psidts = quote(current_cookies.get('__Secure-1PSIDTS', ''))
                              proxy_url += f"&psid={psid}&psidts={psidts}"
                          final_url = proxy_url
-                         print(f"⚠️ verification failed, using proxy")
+                         metrics.PROXY_FALLBACKS.inc()
+                         tracing.log('image_proxy_fallback', level='warning', url=original_url[:80])
                     
                     all_generated_images.append({
                         'url': final_url,
@@ -347,7 +597,7 @@ class GeminiClient:
                     })
                     
             except Exception as e:
-                print(f"❌ Async/Loop Error: {e}")
+                tracing.log('session_error', level='error', error=str(e))
                 # Fallback handled by outer except
                 raise e
             
@@ -356,26 +606,46 @@ class GeminiClient:
             
             if not all_generated_images:
                 # Fallback if no images generated
-                print("⚠️ No images were generated")
+                tracing.log('generation_empty', level='warning', attempts=attempts, stop_reason=stop_reason)
                 if temp_ref_path and os.path.exists(temp_ref_path):
                     try:
                         os.remove(temp_ref_path)
                     except:
                         pass
                 
+                error = 'No images were generated by Gemini. Try a different prompt.'
+                if stop_reason == retry_policy.STOP_DEADLINE:
+                    error = f'Gemini did not return any images within {int(GENERATION_DEADLINE)} seconds. Please try again.'
+                elif stop_reason == retry_policy.STOP_CIRCUIT_OPEN:
+                    error = 'Gemini is rate limiting this account. Please try again shortly.'
+                
                 return {
                     'success': False,
-                    'error': 'No images were generated by Gemini. Try a different prompt.'
+                    'error': error,
+                    'meta': {
+                        'prompt': prompt,
+                        'time': round(generation_time, 2),
+                        'attempts': attempts,
+                        'stop_reason': stop_reason,
+                        'trace_id': tracing.current_trace_id()
+                    }
                 }
             
             # Cleanup temp file
             if temp_ref_path and os.path.exists(temp_ref_path):
                 try:
                     os.remove(temp_ref_path)
-                    print(f"🧹 Cleaned up temp reference file")
                 except:
                     pass
             
+            tracing.log('generation_done', images=len(all_generated_images), attempts=attempts,
+                        stop_reason=stop_reason, seconds=round(generation_time, 2))
+            # Index locally stored images for the gallery (proxy fallbacks expire, so they're skipped)
+            for image in all_generated_images:
+                if image['url'].startswith('/static/'):
+                    HISTORY.record(image['url'], prompt, aspect_ratio=aspect_ratio, style=style_preset,
+                                   hd=hd_mode, generation_seconds=round(generation_time, 2),
+                                   trace_id=tracing.current_trace_id(), owner=owner)
             return {
                 'success': True, 
                 'images': all_generated_images,
@@ -383,12 +653,17 @@ class GeminiClient:
                 'meta': {
                     'prompt': prompt,
                     'time': round(generation_time, 2),
-                    'attempts': attempts
+                    'attempts': attempts,
+                    'requested': quantity,
+                    # 'completed', or why we returned fewer images than requested
+                    'stop_reason': stop_reason,
+                    'partial': len(all_generated_images) < quantity,
+                    'trace_id': tracing.current_trace_id()
                 }
             }
             
         except Exception as e:
-            print(f"❌ Generation error: {str(e)}")
+            tracing.log('generation_error', level='error', error=str(e))
             
             # Check for auth failure to invalidate session
             error_msg = str(e).lower()
@@ -408,35 +683,105 @@ class GeminiClient:
                     'generation_time': time.time() - start_time
                 }
             }
+        finally:
+            COOKIE_POOL.release(account)
 
-    def init_chat(self):
-        """Initialize or reset the chat session"""
-        if not self.client:
-            return False
-            
+    async def generate_batch_async(self, specs, identity=None, concurrency=None, owner=None):
+        """
+        Run several generations concurrently, yielding one dict per item as it finishes
+        ({'index': i, 'success': ...}) and finally a summary ({'done': True, ...}).
+        
+        Every item is admitted through the 'generate' gate under the caller's identity,
+        so a batch shares the global generation budget (and fair share) with single
+        requests; items wait for capacity instead of being rejected. Upstream clients
+        are initialized once per credential and shared by the batch's items.
+        
+        Args:
+            specs: (params, error) pairs from parse_batch_request; invalid items are
+                   reported straight away and the rest still run
+            identity: fair-share key for admission
+            concurrency: items of this batch in flight (capped at the per-user gate limit)
+            owner: history owner key for the generated images
+        """
+        gate = ADMISSION_GATES['generate']
+        workers = max(1, min(concurrency or gate.per_identity_inflight, gate.per_identity_inflight))
+        deadline = retry_policy.Deadline(BATCH_DEADLINE)
+        start_time = time.time()
+        pending = asyncio.Queue()
+        finished = asyncio.Queue()
+        client_cache = {}
+        
+        for index, (params, error) in enumerate(specs):
+            if error:
+                body, status = error
+                finished.put_nowait(dict(body, index=index, status=status))
+            else:
+                pending.put_nowait((index, params))
+        
+        async def run_item(params):
+            while True:
+                try:
+                    async with gate.admit_async(identity, FAIR_SHARE_WEIGHTS.get(identity, 1)):
+                        return await self.generate_images_async(**params, client_cache=client_cache, owner=owner)
+                except AdmissionRejected as e:
+                    if deadline.remaining() < e.retry_after:
+                        return {'success': False, 'error': 'Batch deadline reached before this item could start', 'reason': e.reason}
+                    await asyncio.sleep(e.retry_after)
+        
+        async def worker():
+            while not pending.empty():
+                index, params = pending.get_nowait()
+                try:
+                    result = await run_item(params)
+                except Exception as e:
+                    result = {'success': False, 'error': f'Failed to generate images: {str(e)}'}
+                tracing.log('batch_item_done', index=index, success=result.get('success'))
+                await finished.put(dict(result, index=index))
+        
+        tracing.log('batch_start', items=len(specs), runnable=pending.qsize(), workers=workers)
+        tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+        succeeded = 0
         try:
-            # Create a new chat session using the properly initialized client
-            self.chat_session = self.client.start_chat()
-            print("💬 Chat session initialized")
-            return True
-        except Exception as e:
-            print(f"❌ Failed to init chat: {e}")
-            return False
+            for _ in range(len(specs)):
+                item = await finished.get()
+                succeeded += bool(item.get('success'))
+                yield item
+            yield batch_summary(len(specs), succeeded, start_time)
+        finally:
+            # Also reached when the client disconnects mid-stream (generator cancelled)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for opening in client_cache.values():
+                if not opening.done():
+                    opening.cancel()
+                elif not opening.cancelled() and opening.exception() is None:
+                    try:
+                        await opening.result().close()
+                    except Exception as e:
+                        tracing.log('session_close_failed', level='warning', error=str(e))
 
-    async def send_message(self, message, image=None, cookies=None):
-        """Send a message to Gemini (Stateful via Context Appending)"""
+    async def send_message(self, message, image=None, cookies=None, session_id=None):
+        """
+        Send a message to Gemini
+        
+        With a session_id, turns go through a native Gemini chat session so only
+        the new message is uploaded. If that chat has expired, the stored
+        transcript is replayed into a fresh chat instead.
+        Args:
+            session_id: Chat session whose history is used as context (None = stateless)
+        """
+        
+        # History is per session, so it is safe to use with any cookies
+        use_history = session_id is not None
         
         # Determine which cookies to use
-        current_cookies = cookies or self.cookies
-        if not current_cookies or not current_cookies.get('__Secure-1PSID'):
-             global GEMINI_COOKIES
-             current_cookies = GEMINI_COOKIES
+        # Pooled accounts stick to the one that owns this session's native chat
+        prefer = CHAT_HISTORY.chat_owner(session_id) if use_history else None
+        current_cookies, account = self.select_cookies(cookies, prefer=prefer)
         
         if not current_cookies:
-             return {"success": False, "error": "No valid cookies available. Please check .env"}
-
-        # Use global history if using default cookies
-        use_history = (current_cookies == self.cookies or current_cookies == GEMINI_COOKIES)
+             return {"success": False, "error": POOL_EXHAUSTED_ERROR, "retry_after": COOKIE_POOL.retry_after()}
         
         try:
             # UNPACK COOKIES
@@ -444,101 +789,116 @@ class GeminiClient:
             psidts = current_cookies.get('__Secure-1PSIDTS')
             
             if not psid or not psidts:
+                COOKIE_POOL.release(account)
                 return {"success": False, "error": "Missing PSID or PSIDTS in cookies"}
                 
             temp_client = RealGeminiClient(psid, psidts)
         except Exception as e:
+            COOKIE_POOL.release(account)
             return {"success": False, "error": f"Cookie initialization failed: {str(e)}"}
         
+        send_start = time.time()
+        
         try:
-            # Handle image attachment
+            # Handle image attachment (cached: the same picture is usually sent on every turn)
             generation_files = []
-            temp_img_path = None
+            attachment_digests = []
+            owner = credential_id(current_cookies)
             
             if image:
                 try:
-                    import tempfile
-                    # Decode base64
-                    if "base64," in image:
-                        img_data = base64.b64decode(image.split("base64,")[1])
-                    else:
-                        img_data = base64.b64decode(image)
-                        
-                    # Save to temp file
-                    fd, temp_img_path = tempfile.mkstemp(suffix=".jpg")
-                    os.close(fd)
-                    
-                    with open(temp_img_path, "wb") as f:
-                        f.write(img_data)
-                        
-                    generation_files = [temp_img_path]
-                    print(f"📎 Processing image: {temp_img_path}")
+                    img_path, digest = CHAT_ATTACHMENTS.file_for(image)
+                    generation_files = [img_path]
+                    attachment_digests = [digest]
+                    print(f"📎 Processing image: {img_path}")
                 except Exception as e:
                     print(f"⚠️ Failed to process chat image: {e}")
 
-            # --- CONTEXT CONSTRUCTION ---
-            final_prompt = message
-            
-            if use_history:
-                global CHAT_HISTORY
-                if CHAT_HISTORY:
-                    # Append history to prompt
-                    # We format it to look like a conversation transcript
-                    context = "Previous conversation:\n"
-                    for msg in CHAT_HISTORY:
-                        context += f"User: {msg['user']}\n"
-                        context += f"Gemini: {msg['bot']}\n"
-                    context += "\nCurrent message:\n"
-                    final_prompt = context + message
+            chat_mode = 'stateless'
             
-            print(f"🚀 Sending request (History len: {len(CHAT_HISTORY) if use_history else 0})")
+            with CHAT_ATTACHMENTS.uploads_for(owner):
+                if use_history:
+                    metadata = CHAT_HISTORY.chat_metadata(session_id, owner)
+                    response = None
+                
+                    # 1. Resume the native chat: only the new message is sent
+                    if metadata:
+                        print(f"🚀 Sending request (native chat {metadata[0]})")
+                        try:
+                            chat = temp_client.start_chat(metadata=metadata)
+                            response = await chat.send_message(message, files=generation_files or None)
+                            chat_mode = 'native'
+                        except (AuthError, UsageLimitExceededError, TemporarilyBlockedError):
+                            raise
+                        except Exception as e:
+                            print(f"⚠️ Native chat expired, replaying transcript: {e}")
+                            CHAT_HISTORY.set_chat_metadata(session_id, owner, None)
+                            # The replay uploads the attachment afresh, in case its cached upload id was the problem
+                            CHAT_ATTACHMENTS.forget_uploads(owner, attachment_digests)
+                
+                    # 2. New chat, seeded with the transcript (cached prefix, token-budgeted)
+                    if response is None:
+                        context = CHAT_HISTORY.context(session_id)
+                        print(f"🚀 Sending request (History len: {CHAT_HISTORY.turn_count(session_id)})")
+                        chat = temp_client.start_chat()
+                        response = await chat.send_message(context + message, files=generation_files or None)
+                        chat_mode = 'replay' if context else 'new'
+                
+                    CHAT_HISTORY.set_chat_metadata(session_id, owner, chat.metadata)
+                else:
+                    # Stateless call
+                    print(f"🚀 Sending request (stateless)")
+                    response = await temp_client.generate_content(message, files=generation_files or None)
             
-            # Send Request (Stateless call but with Context)
-            if generation_files:
-                response = await temp_client.generate_content(
-                    final_prompt, 
-                    files=generation_files
-                )
-            else:
-                response = await temp_client.generate_content(final_prompt)
+            COOKIE_POOL.record_success(account, time.time() - send_start)
             
-            # Save to History
+            # Save to History (transcript is kept for replay; store trims to the token budget)
+            history = []
             if use_history:
-                CHAT_HISTORY.append({
-                    'user': message,
-                    'bot': response.text
-                })
-                # Limit history to last 20 turns to prevent context overflow
-                if len(CHAT_HISTORY) > 20:
-                    CHAT_HISTORY.pop(0)
-            
-            # Cleanup
-            if temp_img_path and os.path.exists(temp_img_path):
-                try:
-                    os.remove(temp_img_path)
-                except:
-                    pass
+                history = CHAT_HISTORY.append(session_id, message, response.text)
             
             return {
                 "success": True, 
                 "text": response.text,
-                "history": CHAT_HISTORY if use_history else [] 
+                "history": history,
+                "chat_mode": chat_mode
             }
         except Exception as e:
             print(f"❌ Chat FATAL error: {e}")
-            if temp_img_path and os.path.exists(temp_img_path):
-                try:
-                    os.remove(temp_img_path)
-                except:
-                    pass
-                
+            COOKIE_POOL.record_failure(account, e)
+            CHAT_ATTACHMENTS.forget_uploads(owner, attachment_digests)
             return {"success": False, "error": str(e)}
+        finally:
+            COOKIE_POOL.release(account)
+            try:
+                await temp_client.close()
+            except Exception:
+                pass
 
 
 
 
 # Initialize Gemini client
 gemini_client = GeminiClient(GEMINI_COOKIES)
+
+
+def before_fork():
+    """
+    Called in the gunicorn master once the app is preloaded (see gunicorn.conf.py):
+    stop the event loop thread the cookie check ran on, so workers aren't forked
+    from a process with a live loop. Each worker starts its own on first use.
+    """
+    background_loop.stop()
+
+
+def after_fork():
+    """
+    Called in each freshly forked worker: the Gemini client's HTTP sessions belong to
+    the master's (stopped) loop, so build a new one. The master already verified the
+    cookies; repeating the handshake in every worker would only cost startup time.
+    """
+    if gemini_client.client is not None:
+        gemini_client._initialize_client(verify=False)
 # image_enhancer = ImageEnhancer() # Removed legacy upscaler
 
 
@@ -547,6 +907,509 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def rejection_body(error):
+    """JSON body for a request turned away by admission control"""
+    if error.reason == 'queue_full':
+        message = 'Server is busy. Please try again shortly.'
+    else:
+        message = 'Request waited too long in the queue. Please try again shortly.'
+    return {
+        'success': False,
+        'error': message,
+        'reason': error.reason,
+        'retry_after': error.retry_after
+    }
+
+
+def attach_timings(result, data, query_flag=None):
+    """
+    Add the current trace's per-stage / per-image timing breakdown to result['meta']
+    when the caller asked for it ("timings": true in the payload, or ?timings=1)
+    """
+    wanted = (isinstance(data, dict) and data.get('timings') is True) or query_flag in ('1', 'true')
+    trace = tracing.current_trace()
+    if wanted and trace is not None and isinstance(result, dict):
+        result.setdefault('meta', {})['timings'] = trace.breakdown()
+    return result
+
+
+def request_identity(data, remote_addr):
+    """
+    Fair-share key for a request: the credential the caller brought,
+    or their address when they use the server's accounts. The address is the
+    peer's unless a trusted proxy vouches for it (TRUSTED_PROXY_HOPS / ProxyFix);
+    a client-supplied X-Forwarded-For would let anyone pick a fresh identity.
+    """
+    user_cookies = extract_user_cookies(data) if isinstance(data, dict) else None
+    if user_cookies:
+        return credential_id(user_cookies)
+    return f"ip:{remote_addr or 'unknown'}"
+
+
+def admission_controlled(gate_name):
+    """
+    Route decorator: run the view under an admission gate, fast-failing with Retry-After.
+    Queued requests are served round-robin per caller identity.
+    """
+    gate = ADMISSION_GATES[gate_name]
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            identity = request_identity(request.get_json(silent=True), request.remote_addr)
+            try:
+                with gate.admit(identity, FAIR_SHARE_WEIGHTS.get(identity, 1)):
+                    return view(*args, **kwargs)
+            except AdmissionRejected as e:
+                return rejection_response(gate_name, e)
+        return wrapper
+    return decorator
+
+
+def rejection_response(gate_name, error):
+    """429/503 response with Retry-After for a request turned away by admission control"""
+    tracing.log('admission_rejected', level='warning', gate=gate_name,
+                reason=error.reason, retry_after=error.retry_after)
+    response = jsonify(rejection_body(error))
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def extract_user_cookies(data):
+    """Build a cookie dict from the optional 'cookies' field sent by the browser"""
+    user_cookies_data = data.get('cookies')
+    
+    if user_cookies_data and user_cookies_data.get('psid'):
+        return {
+            '__Secure-1PSID': user_cookies_data.get('psid'),
+            '__Secure-1PSIDTS': user_cookies_data.get('psidts')
+        }
+    return None
+
+
+def resolve_chat_session(headers, cookies):
+    """
+    Find the caller's chat session id (header wins over cookie).
+    
+    Returns:
+        (session_id, is_new) - a fresh id is generated when none (or an invalid one) was sent
+    """
+    session_id = headers.get(CHAT_SESSION_HEADER) or cookies.get(CHAT_SESSION_COOKIE)
+    
+    if session_id and len(session_id) <= 64 and session_id.replace('-', '').isalnum():
+        return session_id, False
+    
+    import uuid
+    return uuid.uuid4().hex, True
+
+
+def history_owner(session_id):
+    """History owner key for a browser session (hashed: the session id itself is a credential)"""
+    return hashlib.sha256(session_id.encode('utf-8')).hexdigest()[:32]
+
+
+def history_read_owner(headers, cookies):
+    """Whose history a read may see: the caller's session's, or everyone's (None) with HISTORY_PUBLIC"""
+    if HISTORY_PUBLIC:
+        return None
+    session_id, _ = resolve_chat_session(headers, cookies)
+    return history_owner(session_id)
+
+
+def build_enhance_prompt(prompt):
+    """Meta-prompt asking Gemini to rewrite a simple idea into a detailed image prompt"""
+    return (
+        f"Act as an expert prompt engineer for AI image generation. "
+        f"Rewrite the following simple idea into a detailed, high-quality image prompt. "
+        f"Focus on visual descriptions, lighting, texture, and style. "
+        f"Keep it under 3 sentences. "
+        f"Input: '{prompt}' "
+        f"Output:"
+    )
+
+
+def parse_generation_request(data):
+    """
+    Validate an /api/generate payload.
+    Shared by the Flask and ASGI apps.
+    
+    Returns:
+        (params, None) where params are kwargs for GeminiClient.generate_images,
+        or (None, (error_body, status_code)) if the request is invalid.
+    Raises:
+        ValueError if quantity is not a number
+    """
+    # Validate input
+    if not data:
+        return None, ({'success': False, 'error': 'No data provided'}, 400)
+    
+    prompt = data.get('prompt', '').strip()
+    if not prompt:
+        return None, ({'success': False, 'error': 'Prompt is required'}, 400)
+    
+    if len(prompt) < 3:
+        return None, ({'success': False, 'error': 'Prompt too short (minimum 3 characters)'}, 400)
+    
+    # Get parameters with defaults
+    aspect_ratio = data.get('aspect_ratio', 'square')
+    quantity = int(data.get('quantity', 4))
+    reference_image = data.get('reference_image')
+    selected_style = data.get('style') # New optional parameter
+    hd_mode = data.get('hd_mode', False) # New toggle parameter
+    
+    # Validate aspect ratio
+    if aspect_ratio not in ['square', 'landscape', 'portrait']:
+        return None, ({'success': False, 'error': 'Invalid aspect ratio'}, 400)
+    
+    # Validate quantity
+    if quantity < 1 or quantity > 4:
+        return None, ({'success': False, 'error': 'Quantity must be between 1 and 4'}, 400)
+    
+    # Extract user cookies if provided
+    user_cookies = extract_user_cookies(data)
+
+    # Check cookies
+    is_valid, message = gemini_client.validate_cookies(cookies=user_cookies)
+    if not is_valid:
+        return None, ({
+            'success': False,
+            'error': 'Cookie authentication failed',
+            'details': message,
+            'action': 'Please update your cookies in Settings'
+        }, 401)
+    
+    return {
+        'prompt': prompt,
+        'aspect_ratio': aspect_ratio,
+        'quantity': quantity,
+        'reference_image': reference_image,
+        'style_preset': selected_style, # Pass the style
+        'hd_mode': hd_mode, # Pass the toggle state
+        'cookies': user_cookies # Pass user cookies
+    }, None
+
+
+def parse_batch_request(data):
+    """
+    Validate an /api/generate/batch payload.
+    Fields other than "items" and "concurrency" are defaults for every item.
+    
+    Returns:
+        ({'specs': [(params, error), ...], 'concurrency': n}, None) - one
+        parse_generation_request result per item - or (None, (error_body, status_code))
+    """
+    if not data or not isinstance(data.get('items'), list) or not data['items']:
+        return None, ({'success': False, 'error': 'items must be a non-empty list of generation requests'}, 400)
+    
+    if len(data['items']) > BATCH_MAX_ITEMS:
+        return None, ({'success': False, 'error': f'Too many items (maximum {BATCH_MAX_ITEMS})'}, 400)
+    
+    try:
+        concurrency = int(data.get('concurrency') or 0) or None
+    except (TypeError, ValueError):
+        return None, ({'success': False, 'error': 'concurrency must be a number'}, 400)
+    
+    defaults = {key: value for key, value in data.items() if key not in ('items', 'concurrency')}
+    specs = []
+    for item in data['items']:
+        if not isinstance(item, dict):
+            specs.append((None, ({'success': False, 'error': 'Item must be an object'}, 400)))
+            continue
+        try:
+            specs.append(parse_generation_request({**defaults, **item}))
+        except (TypeError, ValueError) as e:
+            specs.append((None, ({'success': False, 'error': f'Invalid input: {str(e)}'}, 400)))
+    
+    return {'specs': specs, 'concurrency': concurrency}, None
+
+
+def batch_summary(total, succeeded, start_time):
+    """Final NDJSON line of a streamed batch"""
+    return {
+        'done': True,
+        'total': total,
+        'succeeded': succeeded,
+        'failed': total - succeeded,
+        'time': round(time.time() - start_time, 2),
+        'trace_id': tracing.current_trace_id()
+    }
+
+
+def history_page(args, search=False, owner=None):
+    """
+    One page of generation history from query params:
+    limit, cursor, plus aspect_ratio/style filters (list) or q (search).
+    Only `owner`'s images unless owner is None (see history_read_owner).
+    
+    Returns:
+        (response_body, status_code)
+    """
+    try:
+        limit = int(args.get('limit', 50))
+        cursor = args.get('cursor') or None
+        if cursor is not None:
+            int(cursor)
+    except ValueError:
+        return {'success': False, 'error': 'limit and cursor must be integers'}, 400
+    
+    if search:
+        query = (args.get('q') or '').strip()
+        if not query:
+            return {'success': False, 'error': 'No search query provided'}, 400
+        page = HISTORY.search(query, limit, cursor, owner=owner)
+    else:
+        page = HISTORY.list(limit, cursor, aspect_ratio=args.get('aspect_ratio'), style=args.get('style'), owner=owner)
+    return dict(page, success=True), 200
+
+
+def export_entries(args, owner=None):
+    """
+    Resolve /api/export query params into stream_zip entries: ids=1,2,3 (history
+    index ids, of `owner`'s images) and/or repeated url=/static/generated/... or /static/upscaled/...
+    Done before streaming starts, so a bad request still gets a proper error status.
+
+    Returns:
+        (entries, None) or (None, (error_body, status_code))
+    """
+    try:
+        ids = [int(part) for part in (args.get('ids') or '').split(',') if part.strip()]
+    except ValueError:
+        return None, ({'success': False, 'error': 'ids must be comma-separated integers'}, 400)
+    urls = args.getlist('url')
+    # Before the lookup: one IN (...) parameter per id
+    if len(ids) + len(urls) > EXPORT_MAX_ITEMS:
+        return None, ({'success': False, 'error': f'At most {EXPORT_MAX_ITEMS} images per export'}, 400)
+    if ids:
+        found = HISTORY.get(ids, owner=owner)
+        missing = [image_id for image_id in ids if image_id not in found]
+        if missing:
+            return None, ({'success': False, 'error': f'Unknown image ids: {missing}'}, 404)
+        urls = [found[image_id]['url'] for image_id in ids] + urls
+
+    if not urls:
+        return None, ({'success': False, 'error': 'No images provided'}, 400)
+
+    entries, missing = [], []
+    for index, url in enumerate(urls, 1):
+        directory, _, name = url[len('/static/'):].partition('/') if url.startswith('/static/') else ('', '', '')
+        if directory not in ('generated', 'upscaled') or not name or '/' in name or name.startswith('.'):
+            return None, ({'success': False, 'error': f'Only generated or upscaled images can be exported: {url}'}, 400)
+        arcname = f"gemini-image-{index}{os.path.splitext(name)[1]}"
+        if directory == 'upscaled':
+            path = os.path.join(UPSCALE_CACHE.directory, name)
+            if os.path.isfile(path):
+                entries.append((arcname, path))
+            else:
+                missing.append(url)
+        elif not GENERATED_OUTPUTS.exists(name):
+            missing.append(url)
+        else:
+            # Local file when there is one, else read when the archive gets there (memory or object storage)
+            path = GENERATED_OUTPUTS.local_path(name)
+            entries.append((arcname, path or functools.partial(GENERATED_OUTPUTS.read, name)))
+    if missing:
+        return None, ({'success': False, 'error': f'Images not found: {missing}'}, 404)
+    # Anything that still disappears before the archive reaches it (e.g. an evicted upscale) is left out
+    return entries, None
+
+
+def parse_upscale_batch(data):
+    """
+    Validate an /api/upscale/batch payload: {"images": [image, ...]}
+    Returns:
+        (images, None) or (None, (error_body, status_code))
+    """
+    images = data.get('images') if isinstance(data, dict) else None
+    if not isinstance(images, list) or not images:
+        return None, ({'success': False, 'error': 'images must be a non-empty list'}, 400)
+    if len(images) > UPSCALE_BATCH_MAX_ITEMS:
+        return None, ({'success': False, 'error': f'Too many images (maximum {UPSCALE_BATCH_MAX_ITEMS})'}, 400)
+    return images, None
+
+
+def base64_text(encoded):
+    """Base64 of an encoded image buffer as text (run_op consumer)"""
+    return base64.b64encode(encoded).decode('utf-8')
+
+
+def run_image_op(op, data, consume=bytes, **params):
+    """IMAGE_WORKERS.run_op with the operation's memory counted against the current request"""
+    with tracing.holding(len(data)):
+        output, info = IMAGE_WORKERS.run_op(op, data, consume=consume, **params)
+    metrics.IMAGE_OP_PEAK_BYTES.observe(info['peak_bytes'], operation=op)
+    tracing.record_memory(info['peak_bytes'])
+    return output, info
+
+
+def upscale_batch_item(index, image_url):
+    """upscale_source for one batch entry, as a result line (never raises)"""
+    try:
+        body, status = upscale_source(image_url if isinstance(image_url, str) else None)
+    except Exception as e:
+        body, status = {'success': False, 'error': str(e)}, 500
+    line = dict(body, index=index)
+    if status != 200:
+        line['status'] = status
+    return line
+
+
+def upscale_source(image_url):
+    """
+    Upscale an image (data URL, /static/ path or remote URL) by 2x.
+    The PNG is stored in the upscale cache and its /static/upscaled URL returned.
+    Blocking (network + CPU); the ASGI app calls it from a worker thread.
+    
+    Returns:
+        (response_body, status_code)
+    """
+    if not image_url:
+        return {'success': False, 'error': 'No image provided'}, 400
+    
+    # Handle base64, local file, or URL (byte-capped, then pixel-budget checked from the header)
+    try:
+        if image_url.startswith('data:image'):
+            # Base64
+            img_data = image_ingest.decode_data_url(image_url, 'upscale')
+        elif image_url.startswith('/static/generated/'):
+            # Generated image (output storage, or memory while its write is pending)
+            name = image_url[len('/static/generated/'):]
+            img_data = GENERATED_OUTPUTS.read(name) if '/' not in name and not name.startswith('.') else None
+            if img_data is None:
+                return {'success': False, 'error': f'File not found: {image_url}'}, 404
+            image_ingest.check_size(img_data, 'upscale')
+        elif image_url.startswith('/static/'):
+            # Local static file
+            # Remove leading slash and join with root path
+            local_path = os.path.join(app.root_path, image_url.lstrip('/'))
+            if not os.path.exists(local_path):
+                return {'success': False, 'error': f'File not found: {image_url}'}, 404
+            img_data = image_ingest.read_file(local_path, 'upscale')
+        else:
+            # URL download
+            response = image_ingest.fetch(image_url, 'upscale', timeout=15)
+            if response.status_code != 200:
+                return {'success': False, 'error': f'Failed to fetch image: {response.status_code}'}, 502
+            img_data = response.content
+        image_ingest.check_pixels(img_data, 'upscale')
+    except image_ingest.IngestError as e:
+        return {'success': False, 'error': str(e)}, e.status
+
+    # Same source, same scale and format: serve the stored result
+    cache_key = UPSCALE_CACHE.key(img_data, scale=2, fmt='png')
+    cached = UPSCALE_CACHE.get(cache_key)
+    if cached:
+        return {'success': True, 'image_url': cached['url'], 'new_size': cached['size'], 'cached': True}, 200
+
+    # 2x LANCZOS + sharpen + PNG encode on the image workers, written straight into the cache
+    try:
+        image_url, info = run_image_op(
+            'upscale_2x', img_data, consume=lambda encoded: UPSCALE_CACHE.write(cache_key, encoded)
+        )
+    except ImageOpError as e:
+        return {'success': False, 'error': str(e)}, 400
+    UPSCALE_CACHE.record(cache_key, info['cpu_seconds'])
+    for stage, seconds in info['stages'].items():
+        tracing.record_stage(stage, seconds)
+
+    return {
+        'success': True,
+        'image_url': image_url,
+        'new_size': tuple(info['size']),
+        'cached': False
+    }, 200
+
+
+def process_upload(img_data):
+    """
+    Validate, flatten and downsize an uploaded reference image.
+    
+    Returns:
+        (response_body, status_code)
+    """
+    if len(img_data) > MAX_FILE_SIZE:
+        return {
+            'success': False,
+            'error': f'File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB'
+        }, 400
+    
+    # Validate, flatten and resize (max 2048px on longest side) on the image workers
+    try:
+        image_ingest.check_pixels(img_data, 'upload')
+        img_base64, info = run_image_op('normalize_upload', img_data, consume=base64_text)
+    except image_ingest.IngestError as e:
+        return {'success': False, 'error': str(e)}, e.status
+    except ImageOpError as e:
+        return {'success': False, 'error': str(e)}, 400
+    for stage, seconds in info['stages'].items():
+        tracing.record_stage(stage, seconds)
+
+    return {
+        'success': True,
+        'image_data': f'data:image/jpeg;base64,{img_base64}',
+        'size': len(img_base64),
+        'dimensions': tuple(info['size'])
+    }, 200
+
+
+def proxy_request_cookies(image_url, psid=None, psidts=None):
+    """
+    Pick cookies for a proxied image download.
+    Only Google-hosted URLs get cookies; cookies passed by the frontend win over the defaults.
+    """
+    if 'googleusercontent.com' in image_url or 'google.com' in image_url:
+        if psid and psidts:
+            return {
+                '__Secure-1PSID': psid,
+                '__Secure-1PSIDTS': psidts
+            }
+        return GEMINI_COOKIES
+    return {}
+
+
+def apply_cookie_update(psid, psidts):
+    """Persist new default cookies to .env, hot-swap them and re-initialize the client (blocking)"""
+    # 1. Update .env file (Persistent)
+    env_path = os.path.join(os.path.dirname(__file__), '.env')
+    set_key(env_path, "GEMINI_COOKIE_1PSID", psid)
+    set_key(env_path, "GEMINI_COOKIE_1PSIDTS", psidts)
+
+    # 2. Share with the other workers/nodes; they swap in the stored pair when notified
+    SHARED_STATE.set('credentials', 'primary', {'__Secure-1PSID': psid, '__Secure-1PSIDTS': psidts})
+    SHARED_STATE.publish('credentials', {'name': 'primary'})
+
+    use_primary_cookies(psid, psidts)
+    print("✅ Cookies updated via Web Interface. Client re-initialized.")
+
+
+def use_primary_cookies(psid, psidts):
+    """Hot-swap the primary cookie pair in this process and re-initialize the client (blocking)"""
+    # Update current environment (Hot Swap)
+    os.environ["GEMINI_COOKIE_1PSID"] = psid
+    os.environ["GEMINI_COOKIE_1PSIDTS"] = psidts
+
+    # Update global dictionary used by proxy/downloader
+    GEMINI_COOKIES['__Secure-1PSID'] = psid
+    GEMINI_COOKIES['__Secure-1PSIDTS'] = psidts
+
+    # Reload Gemini Client
+    gemini_client.cookies['__Secure-1PSID'] = psid
+    gemini_client.cookies['__Secure-1PSIDTS'] = psidts
+    gemini_client._initialize_client()
+    COOKIE_POOL.reset('primary')
+
+
+def on_credentials_changed(message):
+    """Another worker stored new primary cookies (or the subscription reconnected): adopt them"""
+    stored = SHARED_STATE.get('credentials', 'primary')
+    if stored and stored != {name: GEMINI_COOKIES.get(name) for name in stored}:
+        use_primary_cookies(stored['__Secure-1PSID'], stored['__Secure-1PSIDTS'])
+        print("✅ Cookies updated by another worker. Client re-initialized.")
+
+
+SHARED_STATE.subscribe('credentials', on_credentials_changed)
+
+
 def enforce_aspect_ratio(image_url, target_aspect_ratio='square', cookies=None):
     """
     Downloads image, strictly enforces aspect ratio by smart cropping, 
@@ -582,11 +1445,14 @@ def enforce_aspect_ratio(image_url, target_aspect_ratio='square', cookies=None):
             request_cookies = cookies if cookies else GEMINI_COOKIES
         
         # Attempt 1: Requests with specific headers
-        response = requests.get(image_url, headers=headers, cookies=request_cookies, timeout=10)
+        with tracing.stage('image_download'):
+            response = image_ingest.fetch(image_url, 'download', headers=headers, cookies=request_cookies, timeout=10)
         
         # Attempt 2: Curl Fallback if 403 (Often bypasses TLS fingerprinting blocks)
         if response.status_code == 403:
-            print(f"⚠️ 403 with requests. Retrying with curl fallback...")
+            tracing.log('download_403', level='warning', msg='Retrying with curl fallback')
+            metrics.UPSTREAM_403.inc(source='download')
+            fallback_start = time.time()
             try:
                 import subprocess
                 # Build cookie string for curl
@@ -595,7 +1461,7 @@ def enforce_aspect_ratio(image_url, target_aspect_ratio='square', cookies=None):
                     cookie_str = "; ".join([f"{k}={v}" for k, v in request_cookies.items()])
                 
                 cmd = [
-                    'curl', '-L', '-s', 
+                    'curl', '-L', '-s', *image_ingest.curl_limit_args(),
                     '-H', f'User-Agent: {headers["User-Agent"]}',
                     '-H', f'Referer: {headers["Referer"]}',
                     image_url
@@ -612,122 +1478,75 @@ def enforce_aspect_ratio(image_url, target_aspect_ratio='square', cookies=None):
                         def __init__(self, content):
                             self.content = content
                             self.status_code = 200
-                    response = MockResponse(result.stdout)
-                    print("✅ Curl download successful")
+                    response = MockResponse(image_ingest.check_size(result.stdout, 'download'))
+                    metrics.CURL_FALLBACKS.inc(source='download', result='ok')
+                    tracing.log('curl_fallback_ok')
                 else:
-                    print(f"❌ Curl failed or returned empty/short content. Ret code: {result.returncode}, Size: {len(result.stdout) if result.stdout else 0}")
+                    metrics.CURL_FALLBACKS.inc(source='download', result='failed')
+                    tracing.log('curl_fallback_failed', level='error', returncode=result.returncode,
+                                size=len(result.stdout) if result.stdout else 0)
                     pass
 
             except Exception as e:
-                print(f"❌ Curl exception: {e}")
+                metrics.CURL_FALLBACKS.inc(source='download', result='error')
+                tracing.log('curl_fallback_failed', level='error', error=str(e))
+            finally:
+                tracing.record_stage('fallback_fetch', time.time() - fallback_start)
 
         if response.status_code != 200:
-            print(f"❌ Failed to download image: {response.status_code}")
+            tracing.log('download_failed', level='error', status=response.status_code)
             return None
         
         # Verify it's actually an image (check magic bytes)
         content = response.content
         if len(content) < 100:
-            print(f"❌ Downloaded content too small: {len(content)} bytes")
+            tracing.log('download_invalid', level='error', msg='Content too small', size=len(content))
             return None
             
         # JPEG (FF D8 FF), PNG (89 50 4E 47), WebP (RIFF...WEBP)
         if not (content.startswith(b'\xff\xd8') or 
                 content.startswith(b'\x89PNG') or 
                 (content.startswith(b'RIFF') and b'WEBP' in content[:16])):
-            print(f"❌ Downloaded content is not a valid image (likely HTML error page). First 50 bytes: {content[:50]}")
+            tracing.log('download_invalid', level='error', msg='Not an image (likely HTML error page)', head=content[:50])
             return None
 
-        # Open image with PIL
         try:
-            img = Image.open(BytesIO(content))
-        except Exception as e:
-             print(f"❌ PIL Open Error: {e}")
-             return None
-             
-        original_width, original_height = img.size
-        print(f"📏 Original dimensions: {original_width}x{original_height}")
-        
-        # Define target aspect ratios
-        aspect_ratios = {
-            'square': 1.0,      # 1:1
-            'landscape': 16/9,  # 16:9
-            'portrait': 9/16    # 9:16
-        }
-        
-        target_ratio = aspect_ratios.get(target_aspect_ratio, 1.0)
-        current_ratio = original_width / original_height
-        
-        # Calculate crop dimensions to KEEP MAX RESOLUTION
-        if abs(current_ratio - target_ratio) < 0.01:
-            # Already correct aspect ratio
-            cropped_img = img
-            print(f"✓ Image already has correct aspect ratio")
-        elif current_ratio > target_ratio:
-            # Image is too wide, crop width - Keep full height
-            new_width = int(original_height * target_ratio)
-            left = (original_width - new_width) // 2
-            cropped_img = img.crop((left, 0, left + new_width, original_height))
-            print(f"✂️ Cropped width: {original_width} → {new_width} (Height kept: {original_height})")
-        else:
-            # Image is too tall, crop height - Keep full width
-            new_height = int(original_width / target_ratio)
-            top = (original_height - new_height) // 2
-            cropped_img = img.crop((0, top, original_width, top + new_height))
-            print(f"✂️ Cropped height: {original_height} → {new_height} (Width kept: {original_width})")
-        
-        # --- QUALITY ENHANCEMENT (Safe now that we save to disk) ---
-        
-        # 1. High-Quality Upscaling (LANCZOS)
-        # Target at least 1080p equivalent
-        target_min_dim = 1080
-        width, height = cropped_img.size
-        
-        if min(width, height) < target_min_dim:
-            scale_factor = target_min_dim / min(width, height)
-            # Cap max upscale to avoid blurriness (e.g. max 4x)
-            scale_factor = min(scale_factor, 4.0)
-            
-            new_w = int(width * scale_factor)
-            new_h = int(height * scale_factor)
-            
-            print(f"🔍 Upscaling image: {width}x{height} -> {new_w}x{new_h}")
-            cropped_img = cropped_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-            
-        # 2. Smart Sharpening (Makes AI art pop)
-        enhancer = ImageEnhance.Sharpness(cropped_img)
-        cropped_img = enhancer.enhance(1.3) # 30% sharper
-            
-        # SAVE TO DISK STRATEGY
-        
-        # 1. Create directory if not exists
-        output_dir = os.path.join(app.root_path, 'static', 'generated')
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-            
-        # 2. Generate unique filename
+            image_ingest.check_pixels(content, 'download')
+        except image_ingest.IngestError as e:
+            tracing.log('download_invalid', level='error', msg=str(e))
+            return None
+
+        # SAVE STRATEGY: unique filename in the output store (static/generated, or object storage)
         import uuid
         filename = f"gen_{uuid.uuid4().hex}.jpg"
-        filepath = os.path.join(output_dir, filename)
-        
-        # 3. Save as HIGH QUALITY JPEG
-        # subsampling=0: Best color sampling (4:4:4)
-        # quality=98: Near lossless
-        cropped_img = cropped_img.convert("RGB")
-        cropped_img.save(filepath, format="JPEG", quality=98, subsampling=0)
-        
-        # Verify file size
-        if os.path.getsize(filepath) == 0:
-            os.remove(filepath)
-            raise Exception("Saved file is 0 bytes")
-            
-        print(f"💾 Saved HQ generated image to: {filename} ({os.path.getsize(filepath)} bytes)")
-        
-        # 4. Return URL path
+
+        def store_output(encoded):
+            if len(encoded) == 0:
+                raise Exception("Encoded image is 0 bytes")
+            started = time.perf_counter()
+            GENERATED_OUTPUTS.put(filename, encoded)
+            return time.perf_counter() - started, len(encoded)
+
+        # Crop to the target ratio, upscale, sharpen and encode on the image workers,
+        # then store the JPEG straight from the worker's output buffer (or queue it, with write-behind)
+        try:
+            (write_seconds, size), info = run_image_op(
+                'fit_aspect_ratio', content, consume=store_output, target_aspect_ratio=target_aspect_ratio
+            )
+        except ImageOpError as e:
+            tracing.log('decode_failed', level='error', error=str(e))
+            return None
+        info['stages']['encode_save'] += write_seconds
+        for stage, seconds in info['stages'].items():
+            tracing.record_stage(stage, seconds)
+
+        tracing.log('image_saved', file=filename, source='{}x{}'.format(*info['source_size']),
+                    output='{}x{}'.format(*info['size']), bytes=size)
+
         return f"/static/generated/{filename}"
 
     except Exception as e:
-        print(f"❌ Aspect ratio enforcement failed: {e}")
+        tracing.log('image_processing_failed', level='error', error=str(e))
         import traceback
         traceback.print_exc()
         return None
@@ -759,6 +1578,95 @@ def health_check():
     })
 
 
+@app.route('/api/stats', methods=['GET'])
+def runtime_stats():
+    """Expose internal runtime metrics (event loop lag, pending tasks)"""
+    return jsonify({
+        'event_loop': background_loop.stats(),
+        'chat_history': CHAT_HISTORY.stats(),
+        'accounts': COOKIE_POOL.stats(),
+        'admission': {name: gate.stats() for name, gate in ADMISSION_GATES.items()},
+        'image_workers': IMAGE_WORKERS.stats(),
+        'upscale_cache': UPSCALE_CACHE.stats(),
+        'history': HISTORY.stats(),
+        'image_variants': IMAGE_VARIANTS.stats(),
+        'outputs': GENERATED_OUTPUTS.stats(),
+        'attachments': CHAT_ATTACHMENTS.stats(),
+        'state': SHARED_STATE.stats(),
+        'timestamp': time.time()
+    })
+
+
+def collect_runtime_gauges():
+    """Point-in-time gauges for /metrics (loop, admission queues, accounts, image workers, chat store)"""
+    loop = background_loop.stats()
+    gauges = [
+        ('gemini_event_loop_lag_seconds', 'Background event loop wake-up lag', {(): loop['loop_lag_ms'] / 1000}),
+        ('gemini_event_loop_pending_tasks', 'Coroutines submitted to the background loop and not finished', {(): loop['pending_tasks']}),
+    ]
+    
+    admission = {name: gate.stats() for name, gate in ADMISSION_GATES.items()}
+    for key, documentation in (
+        ('running', 'Requests currently admitted'),
+        ('queue_depth', 'Requests waiting for admission'),
+        ('rejected_queue_full', 'Requests rejected because the queue was full'),
+        ('rejected_queue_timeout', 'Requests rejected after waiting too long'),
+        ('p95_wait_ms', 'p95 admission wait of recent requests (ms)'),
+    ):
+        gauges.append((
+            f'gemini_admission_{key}', documentation,
+            {(('endpoint', name),): stats[key] for name, stats in admission.items()}
+        ))
+    
+    accounts = COOKIE_POOL.stats()
+    for key, documentation in (
+        ('outstanding', 'In-flight requests per account'),
+        ('requests', 'Requests sent per account'),
+        ('failures', 'Failed requests per account'),
+        ('rate_limited', 'Rate-limited requests per account'),
+        ('avg_latency_ms', 'Average successful request latency per account (ms)'),
+    ):
+        gauges.append((
+            f'gemini_account_{key}', documentation,
+            {(('account', a['name']),): a[key] for a in accounts}
+        ))
+    gauges.append((
+        'gemini_account_circuit_open', 'Whether the account circuit breaker is open (1) or closed/half-open (0)',
+        {(('account', a['name']),): int(a['state'] == 'open') for a in accounts}
+    ))
+    
+    workers = IMAGE_WORKERS.stats()
+    gauges.append(('gemini_image_workers_active', 'Image worker threads busy', {(): workers['active']}))
+    gauges.append(('gemini_image_workers_queued', 'Image jobs waiting for a worker', {(): workers['queued']}))
+    gauges.append(('gemini_image_ops_in_flight', 'Image operations running', {(): workers['ops_in_flight']}))
+    gauges.append(('gemini_image_ops_queued', 'Image operations waiting for a CPU slot', {(): workers['ops_queued']}))
+    gauges.append(('gemini_image_cpu_seconds', 'CPU seconds spent in image operations', {(): workers['cpu_seconds']}))
+
+    outputs = GENERATED_OUTPUTS.stats()
+    gauges.append(('gemini_output_pending_writes', 'Generated images waiting to be persisted (write-behind)', {(): outputs['pending']}))
+    gauges.append(('gemini_output_pending_bytes', 'Bytes of generated images waiting to be persisted', {(): outputs['pending_bytes']}))
+    gauges.append(('gemini_output_failed_pending_writes', 'Generated images whose write failed, held in memory and retried',
+                   {(): outputs['failed_pending']}))
+    # ru_maxrss is in KB on Linux
+    gauges.append(('gemini_process_peak_rss_bytes', 'Resident memory high-water mark of this worker process',
+                   {(): resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}))
+    
+    chat = CHAT_HISTORY.stats()
+    gauges.append(('gemini_chat_sessions', 'Chat sessions held in the chat store', {(): chat['sessions']}))
+    if chat['total_tokens'] is not None:
+        gauges.append(('gemini_chat_history_tokens', 'Approximate tokens held across chat sessions', {(): chat['total_tokens']}))
+    return gauges
+
+
+metrics.REGISTRY.add_collector(collect_runtime_gauges)
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint (per worker process)"""
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+
 @app.route('/api/enhance', methods=['POST'])
 def enhance_prompt():
     """Enhance a prompt using Gemini"""
@@ -769,17 +1677,7 @@ def enhance_prompt():
         if not prompt:
             return jsonify({'success': False, 'error': 'Prompt is required'}), 400
             
-        # Construct meta-prompt
-        meta_prompt = (
-            f"Act as an expert prompt engineer for AI image generation. "
-            f"Rewrite the following simple idea into a detailed, high-quality image prompt. "
-            f"Focus on visual descriptions, lighting, texture, and style. "
-            f"Keep it under 3 sentences. "
-            f"Input: '{prompt}' "
-            f"Output:"
-        )
-        
-        result = gemini_client.generate_text(meta_prompt)
+        result = gemini_client.generate_text(build_enhance_prompt(prompt))
         
         if result['success']:
             return jsonify({'success': True, 'enhanced_prompt': result['text']})
@@ -791,6 +1689,7 @@ def enhance_prompt():
 
 
 @app.route('/api/generate', methods=['POST'])
+@admission_controlled('generate')
 def generate_images():
     """
     Generate images using Gemini
@@ -805,66 +1704,19 @@ def generate_images():
     """
     
     try:
-        data = request.json
+        params, error = parse_generation_request(request.json)
+        if error:
+            body, status = error
+            return jsonify(body), status
         
-        # Validate input
-        if not data:
-            return jsonify({'success': False, 'error': 'No data provided'}), 400
+        # Generate images, indexed in the history of the caller's browser session
+        session_id, is_new = resolve_chat_session(request.headers, request.cookies)
+        result = gemini_client.generate_images(**params, owner=history_owner(session_id))
         
-        prompt = data.get('prompt', '').strip()
-        if not prompt:
-            return jsonify({'success': False, 'error': 'Prompt is required'}), 400
-        
-        if len(prompt) < 3:
-            return jsonify({'success': False, 'error': 'Prompt too short (minimum 3 characters)'}), 400
-        
-        # Get parameters with defaults
-        aspect_ratio = data.get('aspect_ratio', 'square')
-        quantity = int(data.get('quantity', 4))
-        reference_image = data.get('reference_image')
-        selected_style = data.get('style') # New optional parameter
-        hd_mode = data.get('hd_mode', False) # New toggle parameter
-        
-        # Validate aspect ratio
-        if aspect_ratio not in ['square', 'landscape', 'portrait']:
-            return jsonify({'success': False, 'error': 'Invalid aspect ratio'}), 400
-        
-        # Validate quantity
-        if quantity < 1 or quantity > 4:
-            return jsonify({'success': False, 'error': 'Quantity must be between 1 and 4'}), 400
-        
-        # Extract user cookies if provided
-        user_cookies_data = data.get('cookies')
-        user_cookies = None
-        
-        if user_cookies_data and user_cookies_data.get('psid'):
-            user_cookies = {
-                '__Secure-1PSID': user_cookies_data.get('psid'),
-                '__Secure-1PSIDTS': user_cookies_data.get('psidts')
-            }
-
-        # Check cookies
-        is_valid, message = gemini_client.validate_cookies(cookies=user_cookies)
-        if not is_valid:
-            return jsonify({
-                'success': False,
-                'error': 'Cookie authentication failed',
-                'details': message,
-                'action': 'Please update your cookies in Settings'
-            }), 401
-        
-        # Generate images
-        result = gemini_client.generate_images(
-            prompt=prompt,
-            aspect_ratio=aspect_ratio,
-            quantity=quantity,
-            reference_image=reference_image,
-            style_preset=selected_style, # Pass the style
-            hd_mode=hd_mode, # Pass the toggle state
-            cookies=user_cookies # Pass user cookies
-        )
-        
-        return jsonify(result)
+        response = jsonify(attach_timings(result, request.json, request.args.get('timings')))
+        if is_new:
+            response.set_cookie(CHAT_SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+        return response
         
     except ValueError as e:
         return jsonify({'success': False, 'error': f'Invalid input: {str(e)}'}), 400
@@ -877,68 +1729,139 @@ def generate_images():
         }), 500
 
 
+@app.route('/api/generate/batch', methods=['POST'])
+def generate_batch():
+    """
+    Generate images for several prompts in one request.
+    Streams NDJSON: one line per item as it finishes, then a summary line.
+    
+    Expected JSON payload:
+    {
+        "items": [
+            {"prompt": "A red fox in snow", "aspect_ratio": "landscape", "quantity": 2},
+            {"prompt": "A lighthouse at dusk", "style": "watercolor"}
+        ],
+        "concurrency": 2,  # optional, items in flight for this batch
+        "quantity": 1      # any other /api/generate field is a default for every item
+    }
+    
+    Lines:
+        {"index": 0, "success": true, "images": [...], "meta": {...}}
+        {"index": 1, "success": false, "error": "..."}
+        {"done": true, "total": 2, "succeeded": 1, "failed": 1, "time": 41.3}
+    """
+    data = request.get_json(silent=True)
+    batch, error = parse_batch_request(data)
+    if error:
+        body, status = error
+        return jsonify(body), status
+    
+    identity = request_identity(data, request.remote_addr)
+    session_id, is_new = resolve_chat_session(request.headers, request.cookies)
+    items = background_loop.iterate(
+        gemini_client.generate_batch_async(batch['specs'], identity, batch['concurrency'],
+                                           owner=history_owner(session_id))
+    )
+    response = Response(
+        stream_with_context(json.dumps(item) + '\n' for item in items),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}  # let proxies pass lines through as they come
+    )
+    if is_new:
+        response.set_cookie(CHAT_SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return response
+
+
 @app.route('/api/upscale', methods=['POST'])
+@admission_controlled('upscale')
 def upscale_image():
     """Upscale an image by 2x"""
     try:
         data = request.json
-        image_url = data.get('image')
-        
-        if not image_url:
-            return jsonify({'success': False, 'error': 'No image provided'}), 400
-        
-        # Handle base64 or URL
-        # Handle base64, local file, or URL
-        if image_url.startswith('data:image'):
-            # Base64
-            img_data = base64.b64decode(image_url.split(',')[1])
-            img = Image.open(BytesIO(img_data))
-        elif image_url.startswith('/static/'):
-            # Local static file
-            # Remove leading slash and join with root path
-            local_path = os.path.join(app.root_path, image_url.lstrip('/'))
-            if not os.path.exists(local_path):
-                return jsonify({'success': False, 'error': f'File not found: {image_url}'}), 404
-            img = Image.open(local_path)
-        else:
-            # URL download
-            response = requests.get(image_url, timeout=15)
-            img = Image.open(BytesIO(response.content))
-            
-        # Get current size
-        width, height = img.size
-        
-        # Limit max size to avoid crashes (e.g., max 4K-8K)
-        max_dim = 4096
-        if max(width, height) >= max_dim:
-             return jsonify({'success': False, 'error': 'Image is already at maximum resolution'}), 400
-             
-        # Upscale 2x
-        new_size = (width * 2, height * 2)
-        upscaled_img = img.resize(new_size, Image.Resampling.LANCZOS)
-        
-        # Apply Sharpening to make the upscale look "higher quality"
-        # 1.0 is original, 1.5 is sharper
-        enhancer = ImageEnhance.Sharpness(upscaled_img)
-        upscaled_img = enhancer.enhance(1.5)
-        
-        # Convert back to base64
-        buffered = BytesIO()
-        upscaled_img.save(buffered, format="PNG", optimize=True)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return jsonify({
-            'success': True,
-            'image_url': f"data:image/png;base64,{img_base64}",
-            'new_size': new_size
-        })
+        body, status = upscale_source(data.get('image'))
+        return jsonify(body), status
 
     except Exception as e:
         app.logger.error(f"Upscale error: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/upscale/batch', methods=['POST'])
+def upscale_batch():
+    """
+    Upscale several images (2x) in parallel on the image worker pool.
+    Streams NDJSON: one line per image as it completes, then a summary line.
+    
+    Expected JSON payload:
+    {
+        "images": ["/static/generated/gen_1.jpg", "data:image/png;base64,...", "https://..."]
+    }
+    """
+    data = request.get_json(silent=True)
+    images, error = parse_upscale_batch(data)
+    if error:
+        body, status = error
+        return jsonify(body), status
+    
+    # The whole batch holds one 'upscale' slot, under the caller's fair share, until the stream ends
+    identity = request_identity(data, request.remote_addr)
+    admission = contextlib.ExitStack()
+    try:
+        admission.enter_context(ADMISSION_GATES['upscale'].admit(identity, FAIR_SHARE_WEIGHTS.get(identity, 1)))
+    except AdmissionRejected as e:
+        return rejection_response('upscale', e)
+    
+    start_time = time.time()
+    futures = [IMAGE_WORKERS.submit(upscale_batch_item, index, image) for index, image in enumerate(images)]
+    
+    def lines():
+        succeeded = 0
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                item = future.result()
+                succeeded += bool(item.get('success'))
+                yield json.dumps(item) + '\n'
+            yield json.dumps(batch_summary(len(images), succeeded, start_time)) + '\n'
+        finally:
+            # Client went away: drop images that haven't started yet
+            for future in futures:
+                future.cancel()
+    
+    response = Response(stream_with_context(lines()), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    # Runs even if the stream never started (client gone before the first line)
+    response.call_on_close(admission.close)
+    return response
+
+
+@app.route('/api/history')
+def generation_history():
+    """Generated images, newest first (cursor-paginated)"""
+    body, status = history_page(request.args, owner=history_read_owner(request.headers, request.cookies))
+    return jsonify(body), status
+
+
+@app.route('/api/export')
+def export_images():
+    """Download a set of generated images as one ZIP, streamed while it is built"""
+    entries, error = export_entries(request.args, owner=history_read_owner(request.headers, request.cookies))
+    if error:
+        body, status = error
+        return jsonify(body), status
+    filename = time.strftime('gemini-images-%Y%m%d-%H%M%S.zip')
+    return Response(stream_with_context(stream_zip(entries)), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@app.route('/api/history/search')
+def search_history():
+    """Generated images whose prompt matches ?q=, newest first (cursor-paginated)"""
+    body, status = history_page(request.args, search=True,
+                                owner=history_read_owner(request.headers, request.cookies))
+    return jsonify(body), status
+
+
 @app.route('/api/upload', methods=['POST'])
+@admission_controlled('upload')
 def upload_image():
     """Handle reference image uploads"""
     
@@ -957,44 +1880,11 @@ def upload_image():
                 'error': 'Invalid file type. Allowed: PNG, JPG, JPEG, WebP'
             }), 400
         
-        # Read and validate image
-        img_data = file.read()
-        
-        if len(img_data) > MAX_FILE_SIZE:
-            return jsonify({
-                'success': False,
-                'error': f'File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB'
-            }), 400
-        
-        # Open with PIL to validate and potentially resize
-        img = Image.open(BytesIO(img_data))
-        
-        # Convert to RGB if necessary
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-            img = background
-        
-        # Resize if too large (max 2048px on longest side)
-        max_dimension = 2048
-        if max(img.size) > max_dimension:
-            ratio = max_dimension / max(img.size)
-            new_size = tuple(int(dim * ratio) for dim in img.size)
-            img = img.resize(new_size, Image.Resampling.LANCZOS)
-        
-        # Convert to base64
-        buffered = BytesIO()
-        img.save(buffered, format='JPEG', quality=85)
-        img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        return jsonify({
-            'success': True,
-            'image_data': f'data:image/jpeg;base64,{img_base64}',
-            'size': len(img_base64),
-            'dimensions': img.size
-        })
+        body, status = process_upload(image_ingest.read_stream(file.stream, 'upload', MAX_FILE_SIZE))
+        return jsonify(body), status
+
+    except image_ingest.IngestError as e:
+        return jsonify({'success': False, 'error': str(e)}), e.status
         
     except Exception as e:
         app.logger.error(f"Upload error: {str(e)}")
@@ -1026,24 +1916,16 @@ def proxy_image():
         
         # Add cookies if the URL is from Google
         # Prioritize cookies passed in query params (frontend)
-        psid = request.args.get('psid')
-        psidts = request.args.get('psidts')
-        
-        request_cookies = {}
-        if 'googleusercontent.com' in image_url or 'google.com' in image_url:
-            if psid and psidts:
-                request_cookies = {
-                    '__Secure-1PSID': psid,
-                    '__Secure-1PSIDTS': psidts
-                }
-            else:
-                request_cookies = GEMINI_COOKIES
+        request_cookies = proxy_request_cookies(
+            image_url, request.args.get('psid'), request.args.get('psidts')
+        )
         
-        response = requests.get(image_url, headers=headers, cookies=request_cookies, timeout=15)
+        response = image_ingest.fetch(image_url, 'proxy', headers=headers, cookies=request_cookies, timeout=15)
         
         # Retry logic: If 403 Forbidden, try with curl (Fingerprint bypass)
         if response.status_code == 403:
              print(f"Proxy: 403 with requests. Retrying with curl...")
+             metrics.UPSTREAM_403.inc(source='proxy')
              try:
                 import subprocess
                 cookie_str = ""
@@ -1051,7 +1933,7 @@ def proxy_image():
                     cookie_str = "; ".join([f"{k}={v}" for k, v in request_cookies.items()])
                 
                 cmd = [
-                    'curl', '-L', '-s', 
+                    'curl', '-L', '-s', *image_ingest.curl_limit_args(),
                     '-H', f'User-Agent: {headers["User-Agent"]}',
                     '-H', f'Referer: {headers["Referer"]}',
                     image_url
@@ -1068,7 +1950,8 @@ def proxy_image():
                             self.content = content
                             self.status_code = 200
                             self.headers = {'Content-Type': 'image/jpeg'} # Guess type if curl
-                    response = MockResponse(result.stdout)
+                    response = MockResponse(image_ingest.check_size(result.stdout, 'proxy'))
+                    metrics.CURL_FALLBACKS.inc(source='proxy', result='ok')
                     print("✅ Proxy curl download successful")
              except Exception as e:
                 print(f"❌ Proxy curl failed: {e}")
@@ -1077,7 +1960,7 @@ def proxy_image():
         if response.status_code != 200:
              # Last ditch: try requests without verify (sometimes works for weird certs)
              try:
-                response = requests.get(image_url, verify=False, timeout=15)
+                response = image_ingest.fetch(image_url, 'proxy', verify=False, timeout=15)
              except:
                 pass
         
@@ -1097,7 +1980,9 @@ def proxy_image():
                 'Access-Control-Allow-Origin': '*'
             }
         )
-        
+
+    except image_ingest.IngestError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         app.logger.error(f"Proxy error: {str(e)}")
         import traceback
@@ -1113,8 +1998,22 @@ def proxy_image():
 
 @app.route('/static/<path:path>')
 def send_static(path):
-    """Serve static files"""
-    return send_from_directory('static', path)
+    """Serve static files (cache headers and offloading: see static_assets.py)"""
+    asset = STATIC_ASSETS.resolve(
+        path, request.headers.get('Accept-Encoding', ''), request.headers.get('If-None-Match', ''),
+        request.headers.get('Accept', '')
+    )
+    if asset is None:
+        abort(404)
+    if asset.body is not None:
+        # Generated image held in memory (write-behind) or fetched from object storage
+        return Response(asset.body, status=asset.status, headers=asset.headers)
+    if asset.path is None:
+        # 304, redirect, or the front proxy sends the file
+        return Response(status=asset.status, headers=asset.headers)
+    # wsgi.file_wrapper lets the server use sendfile() where it can
+    return Response(wrap_file(request.environ, open(asset.path, 'rb')), headers=asset.headers,
+                    direct_passthrough=True)
 
 
 @app.route('/api/update_cookies', methods=['POST'])
@@ -1128,25 +2027,7 @@ def update_cookies():
         if not psid or not psidts:
             return jsonify({'success': False, 'error': 'Both cookies are required'})
             
-        # 1. Update .env file (Persistent)
-        env_path = os.path.join(os.path.dirname(__file__), '.env')
-        set_key(env_path, "GEMINI_COOKIE_1PSID", psid)
-        set_key(env_path, "GEMINI_COOKIE_1PSIDTS", psidts)
-        
-        # 2. Update current environment (Hot Swap)
-        os.environ["GEMINI_COOKIE_1PSID"] = psid
-        os.environ["GEMINI_COOKIE_1PSIDTS"] = psidts
-        
-        # Update global dictionary used by proxy/downloader
-        GEMINI_COOKIES['__Secure-1PSID'] = psid
-        GEMINI_COOKIES['__Secure-1PSIDTS'] = psidts
-        
-        # 3. Reload Gemini Client
-        gemini_client.cookies['__Secure-1PSID'] = psid
-        gemini_client.cookies['__Secure-1PSIDTS'] = psidts
-        gemini_client._initialize_client()
-             
-        print("✅ Cookies updated via Web Interface. Client re-initialized.")
+        apply_cookie_update(psid, psidts)
         
         return jsonify({'success': True, 'message': 'Cookies updated successfully!'})
         
@@ -1157,6 +2038,7 @@ def update_cookies():
 
 
 @app.route('/api/chat/send', methods=['POST'])
+@admission_controlled('chat')
 def send_chat_message():
     """Handle chat messages"""
     try:
@@ -1168,27 +2050,18 @@ def send_chat_message():
             return jsonify({'success': False, 'error': 'Message or image is required'}), 400
             
         # Extract user cookies if provided
-        user_cookies_data = data.get('cookies')
-        user_cookies = None
-        
-        if user_cookies_data and user_cookies_data.get('psid'):
-            user_cookies = {
-                '__Secure-1PSID': user_cookies_data.get('psid'),
-                '__Secure-1PSIDTS': user_cookies_data.get('psidts')
-            }
+        user_cookies = extract_user_cookies(data)
+        session_id, is_new = resolve_chat_session(request.headers, request.cookies)
         
-        # Run async method in sync context
+        # Run async method on the background event loop
         # If user_cookies contains PSID/PSIDTS, temporary client will use them
-        if user_cookies:
-            # Better approach: Pass cookies to send_message
-            result = asyncio.run(gemini_client.send_message(message, image, cookies=user_cookies))
-        else:
-            result = asyncio.run(gemini_client.send_message(message, image))
+        result = run_async(gemini_client.send_message(message, image, cookies=user_cookies, session_id=session_id))
         
-        if result['success']:
-            return jsonify(result)
-        else:
-            return jsonify(result), 500
+        response = jsonify(result)
+        if is_new:
+            response.set_cookie(CHAT_SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+        
+        return response, 200 if result['success'] else 500
             
     except Exception as e:
         app.logger.error(f"Chat API error: {e}")
@@ -1197,10 +2070,10 @@ def send_chat_message():
 
 @app.route('/api/chat/reset', methods=['POST'])
 def reset_chat_history():
-    """Reset the global chat history"""
+    """Reset the caller's chat history"""
     try:
-        global CHAT_HISTORY
-        CHAT_HISTORY.clear()
+        session_id, _ = resolve_chat_session(request.headers, request.cookies)
+        CHAT_HISTORY.reset(session_id)
         print("🧹 Chat history cleared via API")
         return jsonify({'success': True, 'message': 'Chat history cleared'})
     except Exception as e:
@@ -0,0 +1,560 @@
+"""
+Gemini Web Integration - ASGI Entry Point
+Async alternative to the Flask app for high-concurrency deployments:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Exposes the same routes as app.py. Upstream Gemini calls are awaited on the
+shared background loop and blocking image work runs in worker threads, so a
+single process can hold hundreds of pending generations without tying up a
+worker per request.
+"""
+
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import time
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, HTMLResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.routing import Route
+
+# Importing app shares its configuration, client and chat state with this process
+import app as flask_app
+import image_ingest
+import metrics
+import tracing
+from admission import AdmissionRejected
+from async_runtime import background_loop
+from zip_stream import stream_zip
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROXY_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Referer': 'https://gemini.google.com/',
+    'Accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+}
+
+# Shared async HTTP client for the image proxy (created in lifespan)
+http_client = None
+
+
+async def read_json(request):
+    """Parse a JSON body, returning None for empty or invalid payloads (like Flask's request.json)"""
+    try:
+        return await request.json()
+    except Exception:
+        return None
+
+
+class TraceMiddleware:
+    """Start a trace per HTTP request and return its id in X-Trace-Id"""
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.application(scope, receive, send)
+
+        header = tracing.TRACE_HEADER.lower().encode('latin-1')
+        incoming = dict(scope.get('headers') or []).get(header)
+        trace = tracing.start_trace(incoming.decode('latin-1') if incoming else None)
+
+        async def send_with_trace(message):
+            if message['type'] == 'http.response.start':
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(header, trace.trace_id.encode('latin-1'))]
+            await send(message)
+
+        try:
+            await self.application(scope, receive, send_with_trace)
+        finally:
+            endpoint = scope.get('endpoint')
+            tracing.finish_trace(getattr(endpoint, '__name__', None))
+
+
+def client_address(request):
+    """
+    The peer's address. Behind a proxy, uvicorn rewrites it from X-Forwarded-For
+    only for proxies listed in --forwarded-allow-ips (FORWARDED_ALLOW_IPS).
+    """
+    return request.client.host if request.client else None
+
+
+def admission_controlled(gate_name):
+    """Async counterpart of app.admission_controlled"""
+    gate = flask_app.ADMISSION_GATES[gate_name]
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            data = await read_json(request) if request.headers.get('content-type', '').startswith('application/json') else None
+            identity = flask_app.request_identity(data, client_address(request))
+            try:
+                async with gate.admit_async(identity, flask_app.FAIR_SHARE_WEIGHTS.get(identity, 1)):
+                    return await handler(request)
+            except AdmissionRejected as e:
+                return rejection_response(gate_name, e)
+        return wrapper
+    return decorator
+
+
+def rejection_response(gate_name, error):
+    """Async counterpart of app.rejection_response"""
+    tracing.log('admission_rejected', level='warning', gate=gate_name,
+                reason=error.reason, retry_after=error.retry_after)
+    return JSONResponse(
+        flask_app.rejection_body(error), error.status,
+        headers={'Retry-After': str(error.retry_after)}
+    )
+
+
+def render_page(name):
+    # Same Jinja environment (and asset_url global) as the Flask app
+    return HTMLResponse(flask_app.app.jinja_env.get_template(name).render())
+
+
+async def home(request):
+    """Serve the main interface"""
+    return render_page('index.html')
+
+
+async def settings(request):
+    """Serve the settings page for cookie management"""
+    return render_page('settings.html')
+
+
+async def static_file(request):
+    """Serve static files (cache headers and offloading: see static_assets.py)"""
+    # Off the event loop: a generated image's first WebP/AVIF request transcodes it
+    asset = await asyncio.to_thread(
+        flask_app.STATIC_ASSETS.resolve,
+        request.path_params['path'],
+        request.headers.get('accept-encoding', ''),
+        request.headers.get('if-none-match', ''),
+        request.headers.get('accept', '')
+    )
+    if asset is None:
+        return Response('Not Found', 404, media_type='text/plain')
+    if asset.body is not None:
+        # Generated image held in memory (write-behind) or fetched from object storage
+        return Response(asset.body, asset.status, headers=asset.headers)
+    if asset.path is None:
+        # 304, redirect, or the front proxy sends the file
+        return Response(status_code=asset.status, headers=asset.headers)
+    return FileResponse(asset.path, headers=asset.headers)
+
+
+async def health_check(request):
+    """Check system health and cookie validity"""
+    is_valid, message = flask_app.gemini_client.validate_cookies()
+
+    return JSONResponse({
+        'status': 'healthy' if is_valid else 'unhealthy',
+        'cookie_valid': is_valid,
+        'message': message,
+        'timestamp': time.time()
+    })
+
+
+async def runtime_stats(request):
+    """Expose internal runtime metrics (event loop lag, pending tasks)"""
+    return JSONResponse({
+        'event_loop': background_loop.stats(),
+        'chat_history': flask_app.CHAT_HISTORY.stats(),
+        'accounts': flask_app.COOKIE_POOL.stats(),
+        'admission': {name: gate.stats() for name, gate in flask_app.ADMISSION_GATES.items()},
+        'image_workers': flask_app.IMAGE_WORKERS.stats(),
+        'upscale_cache': flask_app.UPSCALE_CACHE.stats(),
+        'history': flask_app.HISTORY.stats(),
+        'image_variants': flask_app.IMAGE_VARIANTS.stats(),
+        'outputs': flask_app.GENERATED_OUTPUTS.stats(),
+        'attachments': flask_app.CHAT_ATTACHMENTS.stats(),
+        'state': flask_app.SHARED_STATE.stats(),
+        'timestamp': time.time()
+    })
+
+
+async def prometheus_metrics(request):
+    """Prometheus scrape endpoint (per worker process)"""
+    return Response(metrics.REGISTRY.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def enhance_prompt(request):
+    """Enhance a prompt using Gemini"""
+    try:
+        data = await read_json(request) or {}
+        prompt = data.get('prompt', '').strip()
+
+        if not prompt:
+            return JSONResponse({'success': False, 'error': 'Prompt is required'}, 400)
+
+        result = await background_loop.arun(
+            flask_app.gemini_client.generate_text_async(flask_app.build_enhance_prompt(prompt))
+        )
+
+        if result['success']:
+            return JSONResponse({'success': True, 'enhanced_prompt': result['text']})
+        return JSONResponse(result, 500)
+
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, 500)
+
+
+@admission_controlled('generate')
+async def generate_images(request):
+    """Generate images using Gemini (see app.generate_images for the payload)"""
+    try:
+        data = await read_json(request)
+        params, error = flask_app.parse_generation_request(data)
+        if error:
+            body, status = error
+            return JSONResponse(body, status)
+
+        session_id, is_new = flask_app.resolve_chat_session(request.headers, request.cookies)
+        result = await background_loop.arun(
+            flask_app.gemini_client.generate_images_async(**params, owner=flask_app.history_owner(session_id))
+        )
+        response = JSONResponse(flask_app.attach_timings(result, data, request.query_params.get('timings')))
+        if is_new:
+            response.set_cookie(flask_app.CHAT_SESSION_COOKIE, session_id, httponly=True, samesite='lax')
+        return response
+
+    except ValueError as e:
+        return JSONResponse({'success': False, 'error': f'Invalid input: {str(e)}'}, 400)
+    except Exception as e:
+        print(f"❌ Generation error: {str(e)}")
+        return JSONResponse({
+            'success': False,
+            'error': 'Failed to generate images',
+            'details': str(e)
+        }, 500)
+
+
+async def generate_batch(request):
+    """Generate images for several prompts, streaming NDJSON (see app.generate_batch)"""
+    data = await read_json(request)
+    batch, error = flask_app.parse_batch_request(data)
+    if error:
+        body, status = error
+        return JSONResponse(body, status)
+
+    identity = flask_app.request_identity(data, client_address(request))
+    session_id, is_new = flask_app.resolve_chat_session(request.headers, request.cookies)
+    items = background_loop.aiterate(
+        flask_app.gemini_client.generate_batch_async(batch['specs'], identity, batch['concurrency'],
+                                                     owner=flask_app.history_owner(session_id))
+    )
+
+    async def lines():
+        async for item in items:
+            yield json.dumps(item) + '\n'
+
+    response = StreamingResponse(lines(), media_type='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    if is_new:
+        response.set_cookie(flask_app.CHAT_SESSION_COOKIE, session_id, httponly=True, samesite='lax')
+    return response
+
+
+@admission_controlled('upscale')
+async def upscale_image(request):
+    """Upscale an image by 2x (download in a thread, CPU work on the image workers)"""
+    try:
+        data = await read_json(request) or {}
+        body, status = await asyncio.to_thread(flask_app.upscale_source, data.get('image'))
+        return JSONResponse(body, status)
+    except Exception as e:
+        print(f"❌ Upscale error: {str(e)}")
+        return JSONResponse({'success': False, 'error': str(e)}, 500)
+
+
+async def upscale_batch(request):
+    """Upscale several images in parallel, streaming NDJSON (see app.upscale_batch)"""
+    data = await read_json(request)
+    images, error = flask_app.parse_upscale_batch(data)
+    if error:
+        body, status = error
+        return JSONResponse(body, status)
+
+    # The whole batch holds one 'upscale' slot, under the caller's fair share, until the stream ends
+    identity = flask_app.request_identity(data, client_address(request))
+    admission = contextlib.AsyncExitStack()
+    try:
+        await admission.enter_async_context(
+            flask_app.ADMISSION_GATES['upscale'].admit_async(identity, flask_app.FAIR_SHARE_WEIGHTS.get(identity, 1))
+        )
+    except AdmissionRejected as e:
+        return rejection_response('upscale', e)
+
+    start_time = time.time()
+    futures = [
+        asyncio.wrap_future(flask_app.IMAGE_WORKERS.submit(flask_app.upscale_batch_item, index, image))
+        for index, image in enumerate(images)
+    ]
+
+    async def lines():
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(futures):
+                item = await next_done
+                succeeded += bool(item.get('success'))
+                yield json.dumps(item) + '\n'
+            yield json.dumps(flask_app.batch_summary(len(images), succeeded, start_time)) + '\n'
+        finally:
+            for future in futures:
+                future.cancel()
+            await admission.aclose()
+
+    # Also released after the response if the stream never started (aclose is idempotent)
+    return StreamingResponse(lines(), media_type='application/x-ndjson', headers={'X-Accel-Buffering': 'no'},
+                             background=BackgroundTask(admission.aclose))
+
+
+async def generation_history(request):
+    """Generated images, newest first (cursor-paginated)"""
+    owner = flask_app.history_read_owner(request.headers, request.cookies)
+    body, status = await asyncio.to_thread(flask_app.history_page, request.query_params, False, owner)
+    return JSONResponse(body, status)
+
+
+async def search_history(request):
+    """Generated images whose prompt matches ?q=, newest first (cursor-paginated)"""
+    owner = flask_app.history_read_owner(request.headers, request.cookies)
+    body, status = await asyncio.to_thread(flask_app.history_page, request.query_params, True, owner)
+    return JSONResponse(body, status)
+
+
+async def export_images(request):
+    """Download a set of generated images as one ZIP, streamed while it is built"""
+    owner = flask_app.history_read_owner(request.headers, request.cookies)
+    entries, error = await asyncio.to_thread(flask_app.export_entries, request.query_params, owner)
+    if error:
+        return JSONResponse(*error)
+    filename = time.strftime('gemini-images-%Y%m%d-%H%M%S.zip')
+    # A sync iterator: Starlette pulls it from a worker thread (file reads stay off the loop)
+    return StreamingResponse(stream_zip(entries), media_type='application/zip',
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+@admission_controlled('upload')
+async def upload_image(request):
+    """Handle reference image uploads"""
+    try:
+        form = await request.form()
+        file = form.get('file')
+
+        if file is None or not hasattr(file, 'filename'):
+            return JSONResponse({'success': False, 'error': 'No file provided'}, 400)
+
+        if file.filename == '':
+            return JSONResponse({'success': False, 'error': 'No file selected'}, 400)
+
+        if not flask_app.allowed_file(file.filename):
+            return JSONResponse({
+                'success': False,
+                'error': 'Invalid file type. Allowed: PNG, JPG, JPEG, WebP'
+            }, 400)
+
+        img_data = await image_ingest.aread_upload(file, 'upload', flask_app.MAX_FILE_SIZE)
+        body, status = await asyncio.to_thread(flask_app.process_upload, img_data)
+        return JSONResponse(body, status)
+
+    except image_ingest.IngestError as e:
+        return JSONResponse({'success': False, 'error': str(e)}, e.status)
+
+    except Exception as e:
+        print(f"❌ Upload error: {str(e)}")
+        return JSONResponse({
+            'success': False,
+            'error': 'Failed to process image',
+            'details': str(e)
+        }, 500)
+
+
+async def curl_fetch(image_url, request_cookies):
+    """Curl fallback for 403s (often bypasses TLS fingerprinting blocks)"""
+    cmd = [
+        'curl', '-L', '-s', *image_ingest.curl_limit_args(),
+        '-H', f'User-Agent: {PROXY_HEADERS["User-Agent"]}',
+        '-H', f'Referer: {PROXY_HEADERS["Referer"]}',
+        image_url
+    ]
+    if request_cookies:
+        cmd.extend(['-b', "; ".join([f"{k}={v}" for k, v in request_cookies.items()])])
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=15)
+    except asyncio.TimeoutError:
+        proc.kill()
+        return None
+
+    if proc.returncode == 0 and stdout:
+        return image_ingest.check_size(stdout, 'proxy')
+    return None
+
+
+async def proxy_image(request):
+    """
+    Proxy endpoint to download and serve Google-hosted images
+    This bypasses CORS/SameSite security restrictions
+    """
+    image_url = request.query_params.get('url')
+
+    if not image_url:
+        return JSONResponse({'error': 'No URL provided'}, 400)
+
+    try:
+        request_cookies = flask_app.proxy_request_cookies(
+            image_url, request.query_params.get('psid'), request.query_params.get('psidts')
+        )
+
+        response = await image_ingest.afetch(http_client, image_url, 'proxy', headers=PROXY_HEADERS, cookies=request_cookies)
+        content = response.content
+        status = response.status_code
+        content_type = response.headers.get('Content-Type', 'image/png')
+
+        # Retry logic: If 403 Forbidden, try with curl (Fingerprint bypass)
+        if status == 403:
+            print(f"Proxy: 403 with httpx. Retrying with curl...")
+            metrics.UPSTREAM_403.inc(source='proxy')
+            curl_content = await curl_fetch(image_url, request_cookies)
+            if curl_content:
+                content, status, content_type = curl_content, 200, 'image/jpeg'
+                metrics.CURL_FALLBACKS.inc(source='proxy', result='ok')
+                print("✅ Proxy curl download successful")
+
+        if status != 200:
+            print(f"❌ Failed to fetch image: {status}")
+            return JSONResponse({'error': f'Failed to fetch image: {status}'}, 500)
+
+        return Response(
+            content,
+            media_type=content_type,
+            headers={
+                'Cache-Control': 'public, max-age=3600',
+                'Access-Control-Allow-Origin': '*'
+            }
+        )
+
+    except image_ingest.IngestError as e:
+        return JSONResponse({'error': str(e)}, e.status)
+    except Exception as e:
+        print(f"❌ Proxy error: {str(e)}")
+        return JSONResponse({'error': str(e)}, 500)
+
+
+async def update_cookies(request):
+    """Updates the Gemini cookies in .env and re-initializes the client."""
+    try:
+        data = await read_json(request) or {}
+
+        if not data.get('psid') or not data.get('psidts'):
+            return JSONResponse({'success': False, 'error': 'Both cookies are required'})
+
+        # Persists to .env and re-verifies the client (blocking)
+        await asyncio.to_thread(flask_app.apply_cookie_update, data['psid'], data['psidts'])
+
+        return JSONResponse({'success': True, 'message': 'Cookies updated successfully!'})
+
+    except Exception as e:
+        print(f"❌ Error updating cookies: {str(e)}")
+        return JSONResponse({'success': False, 'error': str(e)}, 500)
+
+
+@admission_controlled('chat')
+async def send_chat_message(request):
+    """Handle chat messages"""
+    try:
+        data = await read_json(request) or {}
+        message = data.get('message', '').strip()
+        image = data.get('image')
+
+        if not message and not image:
+            return JSONResponse({'success': False, 'error': 'Message or image is required'}, 400)
+
+        user_cookies = flask_app.extract_user_cookies(data)
+        session_id, is_new = flask_app.resolve_chat_session(request.headers, request.cookies)
+
+        result = await background_loop.arun(
+            flask_app.gemini_client.send_message(message, image, cookies=user_cookies, session_id=session_id)
+        )
+
+        response = JSONResponse(result, 200 if result['success'] else 500)
+        if is_new:
+            response.set_cookie(flask_app.CHAT_SESSION_COOKIE, session_id, httponly=True, samesite='lax')
+        return response
+
+    except Exception as e:
+        print(f"❌ Chat API error: {e}")
+        return JSONResponse({'success': False, 'error': str(e)}, 500)
+
+
+async def reset_chat_history(request):
+    """Reset the caller's chat history"""
+    try:
+        session_id, _ = flask_app.resolve_chat_session(request.headers, request.cookies)
+        flask_app.CHAT_HISTORY.reset(session_id)
+        print("🧹 Chat history cleared via API")
+        return JSONResponse({'success': True, 'message': 'Chat history cleared'})
+    except Exception as e:
+        return JSONResponse({'success': False, 'error': str(e)}, 500)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    global http_client
+    http_client = httpx.AsyncClient(
+        timeout=15,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50)
+    )
+    print("🚀 ASGI app ready")
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+
+
+routes = [
+    Route('/', home),
+    Route('/settings', settings),
+    Route('/api/health', health_check, methods=['GET']),
+    Route('/api/stats', runtime_stats, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+    Route('/api/enhance', enhance_prompt, methods=['POST']),
+    Route('/api/generate', generate_images, methods=['POST']),
+    Route('/api/generate/batch', generate_batch, methods=['POST']),
+    Route('/api/upscale', upscale_image, methods=['POST']),
+    Route('/api/upscale/batch', upscale_batch, methods=['POST']),
+    Route('/api/history', generation_history, methods=['GET']),
+    Route('/api/history/search', search_history, methods=['GET']),
+    Route('/api/export', export_images, methods=['GET']),
+    Route('/api/upload', upload_image, methods=['POST']),
+    Route('/api/proxy-image', proxy_image, methods=['GET']),
+    Route('/api/update_cookies', update_cookies, methods=['POST']),
+    Route('/api/chat/send', send_chat_message, methods=['POST']),
+    Route('/api/chat/reset', reset_chat_history, methods=['POST']),
+    Route('/static/{path:path}', static_file, methods=['GET', 'HEAD']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(TraceMiddleware),
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=[tracing.TRACE_HEADER]),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,203 @@
+"""
+Background Event Loop Runtime
+Keeps one long-lived asyncio loop per worker process so synchronous Flask
+handlers can submit coroutines without creating (and tearing down) a new
+event loop on every request.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+
+class BackgroundLoop:
+    """
+    A single asyncio event loop running forever on a daemon thread.
+
+    Async clients, connection pools and caches created on this loop stay
+    usable across requests. The loop is recreated lazily after a fork so
+    each worker process owns its own thread.
+    """
+
+    def __init__(self, name='gemini-loop', lag_interval=0.5):
+        self.name = name
+        self.lag_interval = lag_interval
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._pending = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._lag = 0.0
+        self._max_lag = 0.0
+
+    @property
+    def loop(self):
+        """The running loop, starting it on first use"""
+        self._ensure_running()
+        return self._loop
+
+    def _ensure_running(self):
+        if self._loop is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+
+            # After a fork the parent's thread does not exist in this process,
+            # so the inherited loop object is unusable. Start fresh.
+            self._reset_stats()
+            self._loop = asyncio.new_event_loop()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            print(f"🔁 Background event loop started (pid {self._pid})")
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.create_task(self._monitor_lag())
+        self._loop.run_forever()
+
+    async def _monitor_lag(self):
+        """Measure how late the loop wakes up compared to the requested sleep"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+            lag = max(0.0, time.perf_counter() - started - self.lag_interval)
+            self._lag = lag
+            self._max_lag = max(self._max_lag, lag)
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the background loop.
+
+        Returns:
+            concurrent.futures.Future resolving to the coroutine result
+        """
+        loop = self.loop
+        with self._lock:
+            self._pending += 1
+            self._submitted += 1
+
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._failed += 1
+            else:
+                self._completed += 1
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the background loop and block until it finishes"""
+        if self._thread is not None and threading.current_thread() is self._thread:
+            raise RuntimeError("BackgroundLoop.run() cannot be called from the loop thread")
+
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def arun(self, coro):
+        """
+        Await a coroutine on the background loop from a different event loop
+        (e.g. the ASGI server's), without blocking that loop.
+        """
+        return await asyncio.wrap_future(self.submit(coro))
+
+    def _pump(self, agen, put):
+        """Drain an async generator on the background loop, handing each item to put()"""
+        async def pump():
+            try:
+                async for item in agen:
+                    put((False, item))
+            except BaseException as e:
+                put((True, e))
+                raise
+            put((True, None))
+        return self.submit(pump())
+
+    def iterate(self, agen):
+        """
+        Consume an async generator running on the background loop from sync code,
+        yielding items as they are produced (e.g. to stream a Flask response).
+        Closing the iterator early cancels the generator.
+        """
+        items = queue.Queue()
+        future = self._pump(agen, items.put)
+        try:
+            while True:
+                done, value = items.get()
+                if done:
+                    if isinstance(value, BaseException):
+                        raise value
+                    return
+                yield value
+        finally:
+            future.cancel()
+
+    async def aiterate(self, agen):
+        """Async counterpart of iterate() for use from another event loop"""
+        caller = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        future = self._pump(agen, lambda entry: caller.call_soon_threadsafe(items.put_nowait, entry))
+        try:
+            while True:
+                done, value = await items.get()
+                if done:
+                    if isinstance(value, BaseException):
+                        raise value
+                    return
+                yield value
+        finally:
+            future.cancel()
+
+    def stats(self):
+        """Loop health snapshot for the stats endpoint"""
+        running = self._loop is not None and self._pid == os.getpid() and self._thread.is_alive()
+        return {
+            'running': running,
+            'pid': self._pid,
+            'pending_tasks': self._pending,
+            'submitted': self._submitted,
+            'completed': self._completed,
+            'failed': self._failed,
+            'loop_lag_ms': round(self._lag * 1000, 2),
+            'max_loop_lag_ms': round(self._max_lag * 1000, 2),
+        }
+
+    def stop(self, timeout=5):
+        """Stop the loop and join its thread"""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                return
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+        loop.close()
+
+
+# Shared per-process loop used by the Flask handlers
+background_loop = BackgroundLoop()
+
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared background loop (sync entry point)"""
+    return background_loop.run(coro, timeout=timeout)
@@ -0,0 +1,211 @@
+"""
+Chat Attachment Cache
+Users tend to keep talking about the same picture for several turns, and the
+browser sends it along with every message. Instead of decoding it to a fresh
+temp file and uploading it to Gemini each time, attachments are keyed by a
+hash of their base64 payload and kept for the length of a chat session:
+
+    files    the decoded image, written once to the cache directory
+             (att_<digest>.jpg). Shared by every worker process; a file's
+             mtime is its LRU position, and files idle for longer than a chat
+             session or past the size budget are deleted.
+
+    uploads  the identifier Gemini returned when the file was uploaded,
+             remembered per account (upload ids belong to the account that
+             uploaded them) in the shared state backend, for less than the
+             upload's own lifetime. Follow-up turns send that id instead of
+             the image bytes.
+
+gemini_webapi doesn't take upload ids directly, so install() wraps its
+upload step: uploads of cached files made inside uploads_for(account) are
+looked up first, everything else goes to Gemini as before.
+"""
+
+import base64
+import contextlib
+import contextvars
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import metrics
+
+
+NAMESPACE = 'attachment_uploads'
+
+# Account whose upload ids may be reused by the current task (None: don't cache)
+_upload_scope = contextvars.ContextVar('attachment_upload_scope', default=None)
+
+
+class AttachmentCache:
+    """Decoded chat attachments on disk plus their Gemini upload ids"""
+
+    def __init__(self, directory, backend, max_bytes=256 * 1024 * 1024, idle_ttl=1800, upload_ttl=6 * 3600):
+        """
+        Args:
+            backend: state backend (state_backend.py) holding upload ids
+            idle_ttl: seconds an unused file is kept (a chat session's idle timeout)
+            upload_ttl: seconds an upload id is reused (Gemini keeps uploads for a day)
+        """
+        os.makedirs(directory, exist_ok=True)
+        # Resolved once so _digest_of recognises relative, symlinked or differently spelled paths
+        self.directory = os.path.realpath(directory)
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.upload_ttl = upload_ttl
+        self._lock = threading.Lock()
+        self._file_hits = 0
+        self._file_misses = 0
+        self._upload_hits = 0
+        self._upload_misses = 0
+        self._bytes_not_uploaded = 0
+        self._evictions = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f"att_{digest}.jpg")
+
+    def _digest_of(self, file):
+        """Digest of a path inside the cache directory (None for anything else)"""
+        if not isinstance(file, (str, os.PathLike)):
+            return None
+        file = os.path.realpath(os.fspath(file))
+        name = os.path.basename(file)
+        if os.path.dirname(file) != self.directory or not name.startswith('att_'):
+            return None
+        return name[len('att_'):].partition('.')[0]
+
+    def file_for(self, image):
+        """
+        Local file holding a base64 (or data URL) attachment, decoded only the first time.
+
+        Returns:
+            (path, digest)
+        """
+        payload = image.split("base64,", 1)[1] if "base64," in image else image
+        digest = hashlib.sha256(payload.encode('ascii')).hexdigest()[:32]
+        path = self._path(digest)
+        try:
+            os.utime(path)
+            metrics.ATTACHMENT_CACHE_LOOKUPS.inc(kind='file', result='hit')
+            with self._lock:
+                self._file_hits += 1
+            return path, digest
+        except FileNotFoundError:
+            pass
+
+        data = base64.b64decode(payload)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        # Atomic: concurrent turns (and other workers) never upload a partial file
+        os.replace(temp_path, path)
+        metrics.ATTACHMENT_CACHE_LOOKUPS.inc(kind='file', result='miss')
+        with self._lock:
+            self._file_misses += 1
+        self._evict()
+        return path, digest
+
+    @contextlib.contextmanager
+    def uploads_for(self, account):
+        """Within this block, uploads of cached files reuse `account`'s earlier upload ids"""
+        token = _upload_scope.set(account)
+        try:
+            yield
+        finally:
+            _upload_scope.reset(token)
+
+    def forget_uploads(self, account, digests):
+        """Drop upload ids that may have been rejected, so the next turn uploads again"""
+        for digest in digests:
+            self.backend.delete(NAMESPACE, f"{account}:{digest}")
+
+    def install(self, client_module):
+        """Route gemini_webapi's uploads (client_module.upload_file) through the cache"""
+        upload = getattr(client_module, 'upload_file', None)
+        if upload is None:
+            print("⚠️ gemini_webapi has no upload_file hook; attachment uploads won't be reused")
+            return
+
+        async def upload_file(file, *args, **kwargs):
+            account = _upload_scope.get()
+            digest = self._digest_of(file) if account else None
+            if digest is None:
+                return await upload(file, *args, **kwargs)
+
+            key = f"{account}:{digest}"
+            upload_id = self.backend.get(NAMESPACE, key)
+            if upload_id is not None:
+                metrics.ATTACHMENT_CACHE_LOOKUPS.inc(kind='upload', result='hit')
+                try:
+                    size = os.path.getsize(file)
+                except OSError:
+                    size = 0
+                with self._lock:
+                    self._upload_hits += 1
+                    self._bytes_not_uploaded += size
+                return upload_id
+
+            upload_id = await upload(file, *args, **kwargs)
+            self.backend.set(NAMESPACE, key, upload_id, ttl=self.upload_ttl)
+            metrics.ATTACHMENT_CACHE_LOOKUPS.inc(kind='upload', result='miss')
+            with self._lock:
+                self._upload_misses += 1
+            return upload_id
+
+        client_module.upload_file = upload_file
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        # Idle files first (their sessions are gone), then LRU down to the size budget
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.idle_ttl
+        evicted = 0
+        for mtime, size, path in sorted(entries):
+            if mtime >= cutoff and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker got there first
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._evictions += evicted
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            return {
+                'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'file_hits': self._file_hits,
+                'file_misses': self._file_misses,
+                'upload_hits': self._upload_hits,
+                'upload_misses': self._upload_misses,
+                'bytes_not_uploaded': self._bytes_not_uploaded,
+                'evictions': self._evictions,
+            }
+
+
+def cache_from_env(instance_path, backend):
+    """ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MB, ATTACHMENT_UPLOAD_TTL; files idle past CHAT_SESSION_TTL are dropped"""
+    return AttachmentCache(
+        os.getenv('ATTACHMENT_CACHE_DIR') or os.path.join(instance_path, 'attachments'),
+        backend,
+        max_bytes=int(float(os.getenv('ATTACHMENT_CACHE_MB', '256')) * 1024 * 1024),
+        idle_ttl=int(os.getenv('CHAT_SESSION_TTL', '1800')),
+        upload_ttl=int(os.getenv('ATTACHMENT_UPLOAD_TTL', str(6 * 3600))),
+    )
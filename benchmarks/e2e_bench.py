@@ -0,0 +1,266 @@
+"""
+End-to-end Benchmark: /api/generate against an offline Gemini backend
+
+Starts the fake Gemini API + image CDN from benchmarks/fake_gemini.py, boots
+each deployment (gunicorn app / uvicorn asgi) pointed at it through
+benchmarks/offline_app.py, and drives the real /api/generate endpoint at each
+concurrency level. The whole pipeline runs: admission, cookie pool, retries,
+image download, crop/resize/sharpen and the JPEG save.
+
+Reports requests/sec, p50/p95/p99 latency, status breakdown and the peak RSS
+of the server process tree. Runs are reproducible for a given --seed, so two
+configurations can be compared by changing only --env or --workers:
+
+    python benchmarks/e2e_bench.py --concurrency 1,8,32 --requests 64
+    python benchmarks/e2e_bench.py --env ADMISSION_GENERATE_CONCURRENCY=32 --json tuned.json
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_gemini import FAKE_URL_ENV, FakeBackendConfig, start_fake_backend  # noqa: E402
+from benchmarks.load_test import free_port, percentile  # noqa: E402
+
+GENERATED_DIR = os.path.join(ROOT, 'static', 'generated')
+
+
+def process_tree(pid):
+    """pid plus all descendants (Linux /proc)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def tree_rss_bytes(pid):
+    total = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler:
+    """Samples the server tree's combined RSS in the background and keeps the peak"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, tree_rss_bytes(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def start_target(mode, port, workers, threads, env):
+    """Boot the offline deployment and wait until it answers /api/health"""
+    if mode == 'sync':
+        cmd = [sys.executable, '-m', 'gunicorn', 'benchmarks.offline_app:app',
+               '--workers', str(workers), '--threads', str(threads), '--timeout', '600',
+               '--bind', f'127.0.0.1:{port}', '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'benchmarks.offline_app:asgi_app',
+               '--workers', str(workers), '--port', str(port),
+               '--log-level', 'warning', '--no-access-log']
+
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/api/health', timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+
+    proc.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+
+async def drive(base_url, payload, total, concurrency, clients, timeout):
+    """
+    POST `total` generation requests with at most `concurrency` in flight,
+    spread over `clients` simulated callers (X-Forwarded-For) for fair-share admission
+    """
+    latencies = []
+    statuses = {}
+    images = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        async def one(index):
+            nonlocal images
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(
+                        '/api/generate',
+                        json=dict(payload, prompt=f"{payload['prompt']} #{index}"),
+                        headers={'X-Forwarded-For': f'10.0.{index % clients // 256}.{index % clients % 256}'}
+                    )
+                    status = str(response.status_code)
+                    if response.status_code == 200 and response.json().get('success'):
+                        latencies.append(time.perf_counter() - started)
+                        images += response.json().get('count', 0)
+                    elif response.status_code == 200:
+                        status = 'failed'
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        'requests': total,
+        'ok': len(latencies),
+        'images': images,
+        'elapsed_s': round(elapsed, 2),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'statuses': statuses,
+    }
+
+
+def parse_size(text):
+    width, _, height = text.lower().partition('x')
+    return int(width), int(height or width)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='sync,asgi', help='Comma separated: sync, asgi')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes per deployment')
+    parser.add_argument('--threads', type=int, default=1, help='Threads per gunicorn worker (sync mode)')
+    parser.add_argument('--concurrency', default='1,8,32', help='Comma separated concurrency levels')
+    parser.add_argument('--clients', type=int, default=64, help='Distinct simulated client addresses')
+    parser.add_argument('--requests', type=int, default=32, help='Requests per concurrency level')
+    parser.add_argument('--quantity', type=int, default=2, help='Images per generation request')
+    parser.add_argument('--aspect-ratio', default='landscape')
+    parser.add_argument('--gemini-latency', type=float, default=2.0, help='Mean fake Gemini latency (s)')
+    parser.add_argument('--gemini-jitter', type=float, default=0.5, help='Uniform +/- jitter on that latency (s)')
+    parser.add_argument('--cdn-latency', type=float, default=0.1, help='Fake image CDN latency (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of Gemini calls that fail (429/500)')
+    parser.add_argument('--empty-rate', type=float, default=0.0, help='Share of Gemini calls with no images')
+    parser.add_argument('--images-per-response', type=int, default=2)
+    parser.add_argument('--image-size', default='1024x1024', help='Fake CDN image size, WxH')
+    parser.add_argument('--accounts', type=int, default=1, help='Fake pooled Gemini accounts')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment for the server (repeatable)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--json', help='Also write results to this file')
+    parser.add_argument('--keep-outputs', action='store_true', help='Keep images written to static/generated')
+    args = parser.parse_args()
+
+    config = FakeBackendConfig(
+        gemini_latency=args.gemini_latency,
+        gemini_jitter=args.gemini_jitter,
+        cdn_latency=args.cdn_latency,
+        failure_rate=args.failure_rate,
+        empty_rate=args.empty_rate,
+        images_per_response=args.images_per_response,
+        image_size=parse_size(args.image_size),
+        seed=args.seed,
+    )
+    backend_port = free_port()
+    backend, counters = start_fake_backend(backend_port, config)
+
+    env = dict(os.environ)
+    env[FAKE_URL_ENV] = f'http://127.0.0.1:{backend_port}'
+    env['PYTHONUNBUFFERED'] = '1'
+    for index in range(1, args.accounts + 1):
+        suffix = '' if index == 1 else f'_{index}'
+        env[f'GEMINI_COOKIE_1PSID{suffix}'] = f'fake-psid-{index}'
+        env[f'GEMINI_COOKIE_1PSIDTS{suffix}'] = f'fake-psidts-{index}'
+    for item in args.env:
+        key, _, value = item.partition('=')
+        env[key] = value
+
+    payload = {'prompt': 'benchmark scene', 'quantity': args.quantity, 'aspect_ratio': args.aspect_ratio}
+    levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+    existing_outputs = set(glob.glob(os.path.join(GENERATED_DIR, '*')))
+
+    print(f"📊 {args.requests} requests per level, concurrency {levels}, {args.quantity} image(s) each, "
+          f"Gemini {args.gemini_latency}s±{args.gemini_jitter}s, CDN {args.cdn_latency}s, "
+          f"failures {args.failure_rate:.0%}, {args.workers} worker(s)\n")
+
+    results = []
+    try:
+        for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+            port = free_port()
+            proc = start_target(mode, port, args.workers, args.threads, env)
+            try:
+                for concurrency in levels:
+                    with RssSampler(proc.pid) as sampler:
+                        result = asyncio.run(drive(
+                            f'http://127.0.0.1:{port}', payload, args.requests, concurrency, max(1, args.clients), args.timeout
+                        ))
+                    result.update(mode=mode, concurrency=concurrency,
+                                  peak_rss_mb=round(sampler.peak / 1024 / 1024, 1))
+                    results.append(result)
+                    print(f"   {mode} c={concurrency}: {result['rps']} rps, p95 {result['p95_ms']} ms")
+            finally:
+                proc.terminate()
+                proc.wait(10)
+    finally:
+        backend.shutdown()
+        if not args.keep_outputs:
+            for path in set(glob.glob(os.path.join(GENERATED_DIR, '*'))) - existing_outputs:
+                os.remove(path)
+
+    columns = ['concurrency', 'ok', 'images', 'elapsed_s', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb']
+    print()
+    print(f"{'mode':<6}" + ''.join(f"{c:>13}" for c in columns) + '  statuses')
+    for result in results:
+        print(f"{result['mode']:<6}" + ''.join(f"{result[c]:>13}" for c in columns) + f"  {result['statuses']}")
+    print(f"\nFake backend served: {counters}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results, 'backend': counters}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
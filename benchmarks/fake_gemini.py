@@ -0,0 +1,201 @@
+"""
+Offline Gemini Fakes for Benchmarks
+A local stand-in for the Gemini web API and for googleusercontent image
+hosting, plus a drop-in replacement for gemini_webapi.GeminiClient that
+talks to it over HTTP. Nothing here needs cookies or network access.
+
+The fake server exposes:
+
+    POST /generate        -> {"text": ..., "images": [{"url", "title", "alt"}]}
+    GET  /cdn/<name>.jpg  -> JPEG of the configured size
+
+Latency, failure/empty rates and image size are set when the server starts.
+Failures come back as HTTP 429 (rate limit) or 500, which the fake client
+raises as the same exception types gemini_webapi would. The startup handshake
+is exempt from failure injection so it can't disable the app's client.
+
+install() swaps the fake client into gemini_webapi so a later `import app`
+picks it up (see benchmarks/offline_app.py).
+"""
+
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+
+FAKE_URL_ENV = 'FAKE_GEMINI_URL'
+HANDSHAKE_PROMPT = 'Hello'
+
+
+class FakeBackendConfig:
+    """Behaviour of the fake Gemini API and image CDN"""
+
+    def __init__(self, gemini_latency=2.0, gemini_jitter=0.5, cdn_latency=0.1, failure_rate=0.0,
+                 rate_limit_share=0.5, empty_rate=0.0, images_per_response=2,
+                 image_size=(1024, 1024), seed=None):
+        self.gemini_latency = gemini_latency
+        self.gemini_jitter = gemini_jitter
+        self.cdn_latency = cdn_latency
+        self.failure_rate = failure_rate
+        # Fraction of failures reported as 429 rather than 500
+        self.rate_limit_share = rate_limit_share
+        self.empty_rate = empty_rate
+        self.images_per_response = images_per_response
+        self.image_size = image_size
+        self.seed = seed
+
+
+def make_jpeg(size, quality=90):
+    """Noisy JPEG so encode/decode costs resemble a real generated image"""
+    width, height = size
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    buffered = BytesIO()
+    Image.blend(noise, gradient, 0.5).save(buffered, format='JPEG', quality=quality)
+    return buffered.getvalue()
+
+
+def start_fake_backend(port, config):
+    """
+    Serve the fake Gemini API and CDN on 127.0.0.1:port in a background thread
+    Returns:
+        (server, counters) - counters is a live dict of requests served per kind
+    """
+    payload = make_jpeg(config.image_size)
+    rng = random.Random(config.seed)
+    rng_lock = threading.Lock()
+    counters = {'generate': 0, 'rate_limited': 0, 'errors': 0, 'empty': 0, 'cdn': 0}
+    base_url = f'http://127.0.0.1:{port}'
+
+    def draw():
+        with rng_lock:
+            return rng.random(), rng.random(), rng.uniform(-1, 1)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status, body, content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            fail_roll, empty_roll, jitter = draw()
+            time.sleep(max(0.0, config.gemini_latency + jitter * config.gemini_jitter))
+            counters['generate'] += 1
+
+            # app.py verifies its client with a "Hello" at startup; never fail that one
+            handshake = request.get('prompt') == HANDSHAKE_PROMPT
+            if fail_roll < config.failure_rate and not handshake:
+                if fail_roll < config.failure_rate * config.rate_limit_share:
+                    counters['rate_limited'] += 1
+                    return self._send(429, b'{"error": "usage limit exceeded"}')
+                counters['errors'] += 1
+                return self._send(500, b'{"error": "internal error"}')
+
+            images = []
+            if request.get('images', True):
+                if empty_roll < config.empty_rate:
+                    counters['empty'] += 1
+                else:
+                    images = [
+                        {'url': f'{base_url}/cdn/{uuid.uuid4().hex}.jpg', 'title': 'Generated Image',
+                         'alt': str(request.get('prompt', ''))[:100]}
+                        for _ in range(config.images_per_response)
+                    ]
+            body = {'text': f"Echo: {str(request.get('prompt', ''))[:200]}", 'images': images}
+            self._send(200, json.dumps(body).encode('utf-8'))
+
+        def do_GET(self):
+            if not self.path.startswith('/cdn/'):
+                return self._send(404, b'{}')
+            time.sleep(config.cdn_latency)
+            counters['cdn'] += 1
+            self._send(200, payload, 'image/jpeg')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counters
+
+
+# --- gemini_webapi stand-in ---
+
+class FakeImage:
+    def __init__(self, url, title, alt):
+        self.url = url
+        self.title = title
+        self.alt = alt
+
+
+class FakeResponse:
+    def __init__(self, text, images):
+        self.text = text
+        self.images = images
+
+
+class FakeChatSession:
+    def __init__(self, client, metadata=None):
+        self.client = client
+        self.metadata = metadata or [uuid.uuid4().hex[:12], uuid.uuid4().hex[:12], uuid.uuid4().hex[:12]]
+
+    async def send_message(self, prompt, files=None, **kwargs):
+        return await self.client._call(prompt, images=False)
+
+
+class FakeGeminiClient:
+    """Same surface as gemini_webapi.GeminiClient for the calls app.py makes"""
+
+    def __init__(self, secure_1psid=None, secure_1psidts=None, proxy=None, **kwargs):
+        self.base_url = os.environ[FAKE_URL_ENV]
+        self._http = None
+
+    async def init(self, timeout=30, auto_close=False, **kwargs):
+        import httpx
+        if self._http is None:
+            self._http = httpx.AsyncClient(base_url=self.base_url, timeout=timeout)
+
+    async def close(self, *args, **kwargs):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _call(self, prompt, images=True):
+        from gemini_webapi.exceptions import APIError, UsageLimitExceededError
+        await self.init()
+        response = await self._http.post('/generate', json={'prompt': prompt, 'images': images}, timeout=None)
+        if response.status_code == 429:
+            raise UsageLimitExceededError('429 Too Many Requests (fake backend)')
+        if response.status_code != 200:
+            raise APIError(f'Fake backend returned {response.status_code}')
+        data = response.json()
+        return FakeResponse(data['text'], [FakeImage(**image) for image in data['images']])
+
+    async def generate_content(self, prompt, files=None, **kwargs):
+        return await self._call(prompt)
+
+    def start_chat(self, metadata=None, **kwargs):
+        return FakeChatSession(self, metadata)
+
+
+def install():
+    """Replace gemini_webapi.GeminiClient with the fake (call before importing app)"""
+    if not os.getenv(FAKE_URL_ENV):
+        raise RuntimeError(f'{FAKE_URL_ENV} must point at a running fake backend')
+    import gemini_webapi
+    gemini_webapi.GeminiClient = FakeGeminiClient
@@ -0,0 +1,278 @@
+"""
+Image Processing Micro-benchmarks
+
+Times the image hot paths on synthetic inputs of several sizes, aspect ratios,
+formats (JPEG/PNG/WebP) and modes (RGB/RGBA/palette):
+
+    enforce_aspect_ratio  download + crop + LANCZOS upscale + sharpen + JPEG q98 save
+    upscale_source        2x LANCZOS + sharpen + optimized PNG (the /api/upscale body, cache misses)
+    process_upload        flatten alpha + downsize + JPEG q85 (the /api/upload body)
+
+Each case runs in a freshly spawned process so memory numbers aren't polluted by
+earlier cases (or the parent's heap). Reported per case:
+
+    ms_op        median wall time per call
+    py_alloc_kb  peak Python-level allocations during one call (tracemalloc)
+    peak_rss_mb  resident memory high-water above the RSS before the first call
+                 (includes Pillow's C-side image buffers; Linux only)
+
+Regression check against a stored baseline (exit status 1 on regression):
+
+    python benchmarks/image_bench.py --save-baseline benchmarks/image_baseline.json
+    python benchmarks/image_bench.py --check benchmarks/image_baseline.json --tolerance 0.25
+
+Timings are machine-specific; regenerate the baseline on the machine that runs the check.
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+
+from benchmarks.load_test import free_port  # noqa: E402
+
+# (function, width, height, format, mode, target aspect ratio)
+CASES = [
+    ('enforce_aspect_ratio', 1024, 1024, 'JPEG', 'RGB', 'square'),
+    ('enforce_aspect_ratio', 1024, 1024, 'JPEG', 'RGB', 'landscape'),
+    ('enforce_aspect_ratio', 1536, 1024, 'JPEG', 'RGB', 'portrait'),
+    ('enforce_aspect_ratio', 2048, 2048, 'JPEG', 'RGB', 'square'),
+    ('enforce_aspect_ratio', 1024, 1024, 'PNG', 'RGB', 'square'),
+    ('enforce_aspect_ratio', 1024, 1024, 'WEBP', 'RGB', 'square'),
+    ('enforce_aspect_ratio', 512, 512, 'JPEG', 'RGB', 'square'),
+    ('upscale_source', 512, 512, 'JPEG', 'RGB', None),
+    ('upscale_source', 1024, 1024, 'JPEG', 'RGB', None),
+    ('upscale_source', 1024, 576, 'PNG', 'RGBA', None),
+    ('upscale_source', 1024, 1024, 'WEBP', 'RGB', None),
+    ('process_upload', 1024, 1024, 'JPEG', 'RGB', None),
+    ('process_upload', 3000, 2000, 'JPEG', 'RGB', None),
+    ('process_upload', 1600, 1600, 'PNG', 'RGBA', None),
+    ('process_upload', 1600, 1600, 'PNG', 'P', None),
+    ('process_upload', 2400, 1600, 'WEBP', 'RGB', None),
+]
+
+
+def case_name(case):
+    function, width, height, fmt, mode, aspect = case
+    name = f'{function}[{width}x{height} {fmt} {mode}'
+    return name + (f' -> {aspect}]' if aspect else ']')
+
+
+def make_image(width, height, fmt, mode):
+    """Noise blended with a gradient: compresses like a photo, not like a flat fill"""
+    noise = Image.effect_noise((width, height), 48).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    img = Image.blend(noise, gradient, 0.6)
+    if mode == 'RGBA':
+        img = img.convert('RGBA')
+        img.putalpha(Image.linear_gradient('L').resize((width, height)))
+    elif mode == 'P':
+        img = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=128)
+
+    buffered = BytesIO()
+    options = {'quality': 90} if fmt in ('JPEG', 'WEBP') else {}
+    img.save(buffered, format=fmt, **options)
+    return buffered.getvalue()
+
+
+def start_image_server(port, payloads):
+    """Serves /<index> -> payloads[index] with zero latency (stands in for the CDN)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = payloads[int(self.path.strip('/'))]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def proc_status_kb(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def reset_peak_rss():
+    """Reset VmHWM to the current RSS (Linux >= 4.0); returns False if unsupported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def load_app():
+    # Empty cookies: skip the Gemini handshake on import (no network needed)
+    os.environ['GEMINI_COOKIE_1PSID'] = ''
+    os.environ['GEMINI_COOKIE_1PSIDTS'] = ''
+    import app
+    app.tracing.log = lambda *args, **kwargs: None
+    return app
+
+
+def make_call(app, case, source, url):
+    function, _, _, fmt, _, aspect = case
+    if function == 'enforce_aspect_ratio':
+        def call():
+            path = app.enforce_aspect_ratio(url, aspect)
+            if not path:
+                raise RuntimeError('enforce_aspect_ratio failed')
+            os.remove(os.path.join(app.app.root_path, path.lstrip('/')))
+    elif function == 'upscale_source':
+        data_url = f'data:image/{fmt.lower()};base64,' + base64.b64encode(source).decode('ascii')
+
+        def call():
+            body, status = app.upscale_source(data_url)
+            if status != 200:
+                raise RuntimeError(body.get('error'))
+            # Drop the cached result so every call measures a real upscale
+            os.remove(os.path.join(app.app.root_path, body['image_url'].lstrip('/')))
+    else:
+        def call():
+            body, status = app.process_upload(source)
+            if status != 200:
+                raise RuntimeError(body.get('error'))
+    return call
+
+
+def run_case(case, iterations, url, results):
+    """Child process body: time one case and report through the queue"""
+    try:
+        import contextlib
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            app = load_app()
+        _, width, height, fmt, mode, _ = case
+        source = make_image(width, height, fmt, mode)
+        call = make_call(app, case, source, url)
+
+        # Memory is measured on the first call: freed image buffers stay mapped in the
+        # process afterwards, so later calls would reuse them and show no growth
+        reset_peak_rss()
+        start_rss = proc_status_kb('VmRSS')
+        tracemalloc.start()
+        call()
+        _, py_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak_rss = max(0, proc_status_kb('VmHWM') - start_rss)
+
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - started)
+
+        results.put({
+            'case': case_name(case),
+            'ms_op': round(statistics.median(timings) * 1000, 2),
+            'ms_min': round(min(timings) * 1000, 2),
+            'py_alloc_kb': round(py_peak / 1024, 1),
+            'peak_rss_mb': round(peak_rss / 1024, 1),
+            'input_kb': round(len(source) / 1024, 1),
+        })
+    except Exception as e:
+        results.put({'case': case_name(case), 'error': str(e)})
+
+
+def compare(results, baseline, tolerance, rss_slack_mb):
+    """Returns a list of regression messages"""
+    reference = {entry['case']: entry for entry in baseline['results']}
+    regressions = []
+    for result in results:
+        base = reference.get(result['case'])
+        if base is None or 'error' in base:
+            continue
+        if 'error' in result:
+            regressions.append(f"{result['case']}: failed ({result['error']})")
+            continue
+        if result['ms_op'] > base['ms_op'] * (1 + tolerance):
+            regressions.append(f"{result['case']}: {result['ms_op']} ms/op vs baseline {base['ms_op']}")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance) + rss_slack_mb:
+            regressions.append(f"{result['case']}: peak RSS {result['peak_rss_mb']} MB vs baseline {base['peak_rss_mb']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5, help='Timed calls per case')
+    parser.add_argument('--filter', default='', help='Only run cases whose name contains this')
+    parser.add_argument('--json', help='Write results to this file')
+    parser.add_argument('--save-baseline', metavar='PATH', help='Store results as the new baseline')
+    parser.add_argument('--check', metavar='PATH', help='Compare against a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown / memory growth')
+    parser.add_argument('--rss-slack', type=float, default=8.0, help='Extra allowed peak RSS growth (MB)')
+    args = parser.parse_args()
+
+    cases = [case for case in CASES if args.filter in case_name(case)]
+
+    # Sources for enforce_aspect_ratio are served over loopback HTTP, like the real CDN
+    payloads = [make_image(w, h, fmt, mode) for _, w, h, fmt, mode, _ in cases]
+    port = free_port()
+    server = start_image_server(port, payloads)
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    print(f"{'case':<58}{'ms/op':>10}{'min':>10}{'py_alloc_kb':>13}{'peak_rss_mb':>13}")
+    for index, case in enumerate(cases):
+        queue = context.Queue()
+        child = context.Process(target=run_case, args=(case, args.iterations, f'http://127.0.0.1:{port}/{index}', queue))
+        child.start()
+        result = queue.get()
+        child.join()
+        results.append(result)
+        if 'error' in result:
+            print(f"{result['case']:<58}  ERROR: {result['error']}")
+        else:
+            print(f"{result['case']:<58}{result['ms_op']:>10}{result['ms_min']:>10}"
+                  f"{result['py_alloc_kb']:>13}{result['peak_rss_mb']:>13}")
+    server.shutdown()
+
+    report = {'iterations': args.iterations, 'python': sys.version.split()[0],
+              'pillow': Image.__version__, 'results': results}
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"\n💾 Wrote {path}")
+
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.rss_slack)
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s) vs {args.check} (tolerance {args.tolerance:.0%}):")
+            for message in regressions:
+                print(f"   {message}")
+            sys.exit(1)
+        print(f"\n✅ No regressions vs {args.check} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Load Test: sync (gunicorn app:app) vs async (uvicorn asgi:app)
+
+Starts a local "slow upstream" image server, boots each deployment against
+it and drives /api/proxy-image at a fixed concurrency. Each request holds an
+upstream wait of --latency seconds, which is exactly what a pending Gemini call
+looks like to the web tier.
+
+Usage:
+    python benchmarks/load_test.py --concurrency 200 --requests 1000 --latency 1.0
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import httpx
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_jpeg(size=512):
+    buffered = BytesIO()
+    Image.new('RGB', (size, size), (120, 80, 200)).save(buffered, format='JPEG', quality=85)
+    return buffered.getvalue()
+
+
+def start_slow_upstream(port, latency, payload):
+    """Image server that sleeps `latency` seconds before answering"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_target(mode, port, workers):
+    """Boot the deployment under test and wait until it answers /api/health"""
+    if mode == 'sync':
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app',
+               '--workers', str(workers), '--timeout', '600',
+               '--bind', f'127.0.0.1:{port}', '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'asgi:app',
+               '--workers', str(workers), '--port', str(port),
+               '--log-level', 'warning', '--no-access-log']
+
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/api/health', timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+
+    proc.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def drive(base_url, path, total, concurrency, timeout):
+    """Fire `total` GETs with at most `concurrency` in flight"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        async def one():
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    if response.status_code != 200:
+                        errors += 1
+                        return
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        'requests': total,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 2),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='sync,asgi', help='Comma separated: sync, asgi')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes per deployment')
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=1.0, help='Upstream latency in seconds')
+    parser.add_argument('--timeout', type=float, default=600)
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    upstream = start_slow_upstream(upstream_port, args.latency, make_jpeg())
+    path = f'/api/proxy-image?url=http://127.0.0.1:{upstream_port}/image.jpg'
+
+    print(f"📊 {args.requests} requests, concurrency {args.concurrency}, "
+          f"upstream latency {args.latency}s, {args.workers} worker(s)\n")
+
+    results = {}
+    for mode in [m.strip() for m in args.modes.split(',') if m.strip()]:
+        port = free_port()
+        proc = start_target(mode, port, args.workers)
+        try:
+            results[mode] = asyncio.run(drive(
+                f'http://127.0.0.1:{port}', path, args.requests, args.concurrency, args.timeout
+            ))
+        finally:
+            proc.terminate()
+            proc.wait(10)
+
+    upstream.shutdown()
+
+    columns = ['requests', 'errors', 'elapsed_s', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms']
+    print(f"{'mode':<6}" + ''.join(f"{c:>11}" for c in columns))
+    for mode, result in results.items():
+        print(f"{mode:<6}" + ''.join(f"{result[c]:>11}" for c in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+"""
+app.py / asgi.py wired to the fake Gemini backend (FAKE_GEMINI_URL)
+
+    FAKE_GEMINI_URL=http://127.0.0.1:9000 gunicorn benchmarks.offline_app:app
+    FAKE_GEMINI_URL=http://127.0.0.1:9000 uvicorn benchmarks.offline_app:asgi_app
+"""
+
+from benchmarks.fake_gemini import install
+
+install()
+
+from app import app  # noqa: E402
+from asgi import app as asgi_app  # noqa: E402
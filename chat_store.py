@@ -0,0 +1,316 @@
+"""
+Per-Session Chat History Store
+Keeps each browser session's conversation separately, trims by an
+approximate token budget instead of a turn count, and evicts idle or
+least-recently-used sessions to stay within a global memory cap.
+
+Alongside the transcript, each session remembers the native Gemini chat
+ids ([cid, rid, rcid]) so follow-up turns only send the new message. The
+transcript is kept as a replay fallback for when that chat expires.
+
+With a shared state backend (STATE_BACKEND=redis, see state_backend.py)
+sessions live in the backend instead, so every worker and node sees the
+same conversation.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# Rough size heuristic: ~4 characters per token for English text
+CHARS_PER_TOKEN = 4
+
+CONTEXT_HEADER = "Previous conversation:\n"
+CONTEXT_FOOTER = "\nCurrent message:\n"
+
+
+def estimate_tokens(text):
+    """Cheap token estimate used for budgeting (no tokenizer dependency)"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def render_turn(user, bot):
+    return f"User: {user}\nGemini: {bot}\n"
+
+
+class ChatHistory:
+    """
+    One session's turns plus a cached "Previous conversation" prefix.
+
+    Each turn is rendered to transcript text once when it is added; the
+    joined prefix is cached until the next append or trim.
+    """
+
+    def __init__(self):
+        self.turns = deque()       # (user, bot, rendered, tokens)
+        self.tokens = 0
+        self.last_used = time.time()
+        self.chat_metadata = None  # native Gemini chat ids
+        self.chat_owner = None     # credential the chat belongs to
+        self._context = None
+
+    def append(self, user, bot):
+        rendered = render_turn(user, bot)
+        tokens = estimate_tokens(rendered)
+        self.turns.append((user, bot, rendered, tokens))
+        self.tokens += tokens
+        self._context = None
+        return tokens
+
+    def trim(self, budget):
+        """Drop oldest turns until the history fits the token budget. Returns tokens freed."""
+        freed = 0
+        while self.turns and self.tokens > budget:
+            freed += self._pop_oldest()
+        return freed
+
+    def _pop_oldest(self):
+        _, _, _, tokens = self.turns.popleft()
+        self.tokens -= tokens
+        self._context = None
+        return tokens
+
+    def context(self):
+        """Transcript prefix for the next prompt ('' when there is no history)"""
+        if not self.turns:
+            return ""
+        if self._context is None:
+            self._context = CONTEXT_HEADER + "".join(turn[2] for turn in self.turns) + CONTEXT_FOOTER
+        return self._context
+
+    def as_list(self):
+        return [{'user': user, 'bot': bot} for user, bot, _, _ in self.turns]
+
+
+class ChatHistoryStore:
+    """
+    Bounded, thread-safe map of session id -> ChatHistory.
+
+    Sessions are kept in least-recently-used order so idle-timeout and
+    global-cap eviction only ever look at the front of the map.
+    """
+
+    def __init__(self, session_token_budget=6000, total_token_budget=2_000_000,
+                 idle_ttl=1800, max_sessions=5000):
+        self.session_token_budget = session_token_budget
+        self.total_token_budget = total_token_budget
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+        self._evicted = 0
+
+    def _touch(self, session_id, create=False):
+        history = self._sessions.get(session_id)
+        if history is None:
+            if not create:
+                return None
+            history = ChatHistory()
+            self._sessions[session_id] = history
+        else:
+            self._sessions.move_to_end(session_id)
+        history.last_used = time.time()
+        return history
+
+    def _evict_idle(self, now):
+        cutoff = now - self.idle_ttl
+        while self._sessions:
+            session_id, history = next(iter(self._sessions.items()))
+            if history.last_used >= cutoff:
+                break
+            self._drop(session_id)
+
+    def _drop(self, session_id):
+        history = self._sessions.pop(session_id)
+        self._total_tokens -= history.tokens
+        self._evicted += 1
+
+    def _enforce_global_caps(self, keep):
+        # Evict whole LRU sessions first, never the one being written
+        while self._sessions and (
+            self._total_tokens > self.total_token_budget or len(self._sessions) > self.max_sessions
+        ):
+            oldest = next(iter(self._sessions))
+            if oldest == keep:
+                break
+            self._drop(oldest)
+
+    def context(self, session_id):
+        """Cached transcript prefix for a session ('' if unknown or empty)"""
+        with self._lock:
+            self._evict_idle(time.time())
+            history = self._touch(session_id)
+            return history.context() if history else ""
+
+    def chat_metadata(self, session_id, owner):
+        """Native Gemini chat metadata for a session, if it belongs to this credential"""
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None or history.chat_owner != owner:
+                return None
+            return history.chat_metadata
+
+    def chat_owner(self, session_id):
+        """Credential id that owns the session's native chat (None if there is none)"""
+        with self._lock:
+            history = self._sessions.get(session_id)
+            return history.chat_owner if history else None
+
+    def set_chat_metadata(self, session_id, owner, metadata):
+        """Remember (or forget, with metadata=None) the native chat for a session"""
+        with self._lock:
+            history = self._touch(session_id, create=metadata is not None)
+            if history is None:
+                return
+            history.chat_metadata = list(metadata) if metadata else None
+            history.chat_owner = owner if metadata else None
+
+    def turn_count(self, session_id):
+        with self._lock:
+            history = self._sessions.get(session_id)
+            return len(history.turns) if history else 0
+
+    def append(self, session_id, user, bot):
+        """Record a turn, then trim the session and the store to their budgets"""
+        with self._lock:
+            self._evict_idle(time.time())
+            history = self._touch(session_id, create=True)
+            self._total_tokens += history.append(user, bot)
+            self._total_tokens -= history.trim(self.session_token_budget)
+            self._enforce_global_caps(keep=session_id)
+            return history.as_list()
+
+    def history(self, session_id):
+        with self._lock:
+            history = self._sessions.get(session_id)
+            return history.as_list() if history else []
+
+    def reset(self, session_id):
+        with self._lock:
+            if session_id in self._sessions:
+                history = self._sessions.pop(session_id)
+                self._total_tokens -= history.tokens
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._total_tokens = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'total_tokens': self._total_tokens,
+                'total_token_budget': self.total_token_budget,
+                'session_token_budget': self.session_token_budget,
+                'evicted_sessions': self._evicted,
+                'native_sessions': sum(1 for h in self._sessions.values() if h.chat_metadata),
+            }
+
+
+class SharedChatHistoryStore:
+    """
+    ChatHistoryStore's interface over a shared state backend.
+
+    Each session is one record ({turns, tokens, chat_metadata, chat_owner})
+    updated atomically and expiring after idle_ttl. The per-session token
+    budget is applied on every append; the global caps are left to the
+    backend server's own memory policy (e.g. Redis maxmemory with
+    volatile-lru).
+    """
+
+    NAMESPACE = 'chat'
+
+    def __init__(self, backend, session_token_budget=6000, idle_ttl=1800):
+        self.backend = backend
+        self.session_token_budget = session_token_budget
+        self.idle_ttl = idle_ttl
+
+    def _get(self, session_id, touch=False):
+        record = self.backend.get(self.NAMESPACE, session_id)
+        if record is not None and touch:
+            self.backend.touch(self.NAMESPACE, session_id, self.idle_ttl)
+        return record
+
+    def context(self, session_id):
+        """Transcript prefix for a session ('' if unknown or empty)"""
+        record = self._get(session_id, touch=True)
+        if not record or not record['turns']:
+            return ""
+        return CONTEXT_HEADER + "".join(render_turn(user, bot) for user, bot, _ in record['turns']) + CONTEXT_FOOTER
+
+    def chat_metadata(self, session_id, owner):
+        """Native Gemini chat metadata for a session, if it belongs to this credential"""
+        record = self._get(session_id)
+        if record is None or record['chat_owner'] != owner:
+            return None
+        return record['chat_metadata']
+
+    def chat_owner(self, session_id):
+        """Credential id that owns the session's native chat (None if there is none)"""
+        record = self._get(session_id)
+        return record['chat_owner'] if record else None
+
+    def set_chat_metadata(self, session_id, owner, metadata):
+        """Remember (or forget, with metadata=None) the native chat for a session"""
+        def apply(record):
+            if record is None:
+                if metadata is None:
+                    return None
+                record = {'turns': [], 'tokens': 0}
+            record['chat_metadata'] = list(metadata) if metadata else None
+            record['chat_owner'] = owner if metadata else None
+            return record
+        self.backend.update(self.NAMESPACE, session_id, apply, ttl=self.idle_ttl)
+
+    def turn_count(self, session_id):
+        record = self._get(session_id)
+        return len(record['turns']) if record else 0
+
+    def append(self, session_id, user, bot):
+        """Record a turn, then trim the session to its budget"""
+        def apply(record):
+            record = record or {'turns': [], 'tokens': 0, 'chat_metadata': None, 'chat_owner': None}
+            tokens = estimate_tokens(render_turn(user, bot))
+            record['turns'].append([user, bot, tokens])
+            record['tokens'] += tokens
+            while record['turns'] and record['tokens'] > self.session_token_budget:
+                record['tokens'] -= record['turns'].pop(0)[2]
+            return record
+        record = self.backend.update(self.NAMESPACE, session_id, apply, ttl=self.idle_ttl)
+        return [{'user': user, 'bot': bot} for user, bot, _ in record['turns']]
+
+    def history(self, session_id):
+        record = self._get(session_id)
+        return [{'user': user, 'bot': bot} for user, bot, _ in record['turns']] if record else []
+
+    def reset(self, session_id):
+        self.backend.delete(self.NAMESPACE, session_id)
+
+    def stats(self):
+        return {
+            'backend': self.backend.name,
+            'sessions': self.backend.count(self.NAMESPACE),
+            'total_tokens': None,  # not tracked across processes
+            'session_token_budget': self.session_token_budget,
+            'idle_ttl': self.idle_ttl,
+        }
+
+
+def store_from_env(backend=None):
+    """Build the store from CHAT_* environment variables (in the backend if it is shared)"""
+    if backend is not None and backend.shared:
+        return SharedChatHistoryStore(
+            backend,
+            session_token_budget=int(os.getenv('CHAT_SESSION_TOKEN_BUDGET', '6000')),
+            idle_ttl=int(os.getenv('CHAT_SESSION_TTL', '1800')),
+        )
+    return ChatHistoryStore(
+        session_token_budget=int(os.getenv('CHAT_SESSION_TOKEN_BUDGET', '6000')),
+        total_token_budget=int(os.getenv('CHAT_TOTAL_TOKEN_BUDGET', '2000000')),
+        idle_ttl=int(os.getenv('CHAT_SESSION_TTL', '1800')),
+        max_sessions=int(os.getenv('CHAT_MAX_SESSIONS', '5000')),
+    )
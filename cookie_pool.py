@@ -0,0 +1,246 @@
+"""
+Gemini Cookie Pool
+Spreads server-side traffic over several Gemini accounts (cookie pairs).
+
+Accounts are configured with numbered environment variables next to the
+primary pair:
+
+    GEMINI_COOKIE_1PSID / GEMINI_COOKIE_1PSIDTS         (primary)
+    GEMINI_COOKIE_1PSID_2 / GEMINI_COOKIE_1PSIDTS_2     (second account)
+    GEMINI_COOKIE_1PSID_3 / ...
+
+Requests go to the healthy account with the fewest outstanding requests.
+Each account has a circuit breaker: repeated failures or a rate limit open
+it for a cooldown, after which a single half-open trial decides whether it
+closes again.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def credential_id(cookies):
+    """Short, non-reversible identifier for a cookie pair (safe to log and use as a key)"""
+    psid = (cookies or {}).get('__Secure-1PSID') or ''
+    return hashlib.sha256(psid.encode('utf-8')).hexdigest()[:16]
+
+
+def is_rate_limit_error(error):
+    """True for upstream usage-limit / 429 style failures"""
+    name = type(error).__name__
+    if name in ('UsageLimitExceededError', 'TemporarilyBlockedError'):
+        return True
+    message = str(error).lower()
+    return '429' in message or 'too many requests' in message or 'usage limit' in message
+
+
+class Account:
+    """One cookie pair plus its breaker state and counters"""
+
+    def __init__(self, name, cookies):
+        self.name = name
+        self.cookies = cookies
+        self.state = CLOSED
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+        self.trial_in_flight = False
+
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.latency_total = 0.0
+        self.last_error = None
+        self.recent = deque()  # request start times for the per-minute rate
+
+    @property
+    def id(self):
+        # Derived on access: the primary pair can be hot-swapped via /api/update_cookies
+        return credential_id(self.cookies)
+
+    @property
+    def configured(self):
+        return bool(self.cookies.get('__Secure-1PSID') and self.cookies.get('__Secure-1PSIDTS'))
+
+
+class CookiePool:
+    """
+    Least-outstanding-requests balancer with per-account circuit breakers.
+    Thread-safe; callers acquire() an account, record results, then release() it.
+    """
+
+    def __init__(self, accounts, failure_threshold=3, cooldown=60, rate_limit_cooldown=300, max_cooldown=1800):
+        self.accounts = accounts
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+
+    def _available(self, account, now):
+        if not account.configured:
+            return False
+        if account.state == CLOSED:
+            return True
+        if account.state == OPEN and now - account.opened_at >= account.cooldown:
+            account.state = HALF_OPEN
+            account.trial_in_flight = False
+        # Half-open: exactly one trial request at a time
+        return account.state == HALF_OPEN and not account.trial_in_flight
+
+    def acquire(self, prefer=None):
+        """
+        Pick an account for a request.
+        Args:
+            prefer: credential id to stick to when that account is healthy (e.g. chat owner)
+        Returns:
+            Account, or None when every account is cooling down
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [a for a in self.accounts if self._available(a, now)]
+            if not candidates:
+                return None
+
+            chosen = None
+            if prefer:
+                chosen = next((a for a in candidates if a.id == prefer), None)
+            if chosen is None:
+                chosen = min(candidates, key=lambda a: a.outstanding)
+
+            if chosen.state == HALF_OPEN:
+                chosen.trial_in_flight = True
+            chosen.outstanding += 1
+            chosen.requests += 1
+            chosen.recent.append(now)
+            return chosen
+
+    def release(self, account):
+        """Return an account acquired with acquire() (None is ignored)"""
+        if account is None:
+            return
+        with self._lock:
+            account.outstanding = max(0, account.outstanding - 1)
+            if account.state == HALF_OPEN:
+                # Trial ended without a verdict; let the next request try
+                account.trial_in_flight = False
+
+    def record_success(self, account, latency):
+        if account is None:
+            return
+        with self._lock:
+            account.successes += 1
+            account.latency_total += latency
+            account.consecutive_failures = 0
+            if account.state != CLOSED:
+                print(f"✅ Account '{account.name}' recovered, circuit closed")
+            account.state = CLOSED
+            account.cooldown = 0.0
+            account.trial_in_flight = False
+
+    def record_failure(self, account, error):
+        """
+        Count a failed upstream call.
+        Returns:
+            True if the account's circuit is now open (caller should stop using it)
+        """
+        if account is None:
+            return False
+
+        rate_limited = is_rate_limit_error(error)
+        with self._lock:
+            account.failures += 1
+            account.consecutive_failures += 1
+            account.last_error = str(error)[:200]
+            if rate_limited:
+                account.rate_limited += 1
+
+            if account.state == HALF_OPEN or rate_limited or account.consecutive_failures >= self.failure_threshold:
+                if rate_limited:
+                    cooldown = self.rate_limit_cooldown
+                elif account.state == HALF_OPEN:
+                    # Failed trial: back off harder each time
+                    cooldown = min(max(account.cooldown * 2, self.base_cooldown), self.max_cooldown)
+                else:
+                    cooldown = self.base_cooldown
+                account.state = OPEN
+                account.opened_at = time.time()
+                account.cooldown = cooldown
+                account.trial_in_flight = False
+                print(f"⛔ Account '{account.name}' circuit open for {int(cooldown)}s: {account.last_error}")
+                return True
+            return False
+
+    def reset(self, name):
+        """Close an account's circuit (e.g. after its cookies were updated)"""
+        with self._lock:
+            for account in self.accounts:
+                if account.name == name:
+                    account.state = CLOSED
+                    account.consecutive_failures = 0
+                    account.cooldown = 0.0
+                    account.trial_in_flight = False
+
+    def retry_after(self):
+        """Seconds until the next open circuit may be retried"""
+        now = time.time()
+        with self._lock:
+            waits = [a.opened_at + a.cooldown - now for a in self.accounts if a.configured and a.state == OPEN]
+        return max(1, int(min(waits))) if waits else 1
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            accounts = []
+            for account in self.accounts:
+                while account.recent and now - account.recent[0] > 60:
+                    account.recent.popleft()
+                accounts.append({
+                    'name': account.name,
+                    'id': account.id,
+                    'configured': account.configured,
+                    'state': account.state,
+                    'outstanding': account.outstanding,
+                    'requests': account.requests,
+                    'requests_per_min': len(account.recent),
+                    'successes': account.successes,
+                    'failures': account.failures,
+                    'rate_limited': account.rate_limited,
+                    'avg_latency_ms': round(account.latency_total / account.successes * 1000, 1) if account.successes else 0.0,
+                    'cooldown_remaining_s': max(0, int(account.opened_at + account.cooldown - now)) if account.state == OPEN else 0,
+                    'last_error': account.last_error,
+                })
+            return accounts
+
+
+def pool_from_env(primary_cookies):
+    """
+    Build the pool from GEMINI_COOKIE_1PSID[_N] / GEMINI_COOKIE_1PSIDTS[_N].
+    The primary account shares the given dict so hot-swapped cookies apply immediately.
+    """
+    accounts = [Account('primary', primary_cookies)]
+
+    index = 2
+    while os.getenv(f'GEMINI_COOKIE_1PSID_{index}'):
+        accounts.append(Account(f'account_{index}', {
+            '__Secure-1PSID': os.getenv(f'GEMINI_COOKIE_1PSID_{index}', ''),
+            '__Secure-1PSIDTS': os.getenv(f'GEMINI_COOKIE_1PSIDTS_{index}', '')
+        }))
+        index += 1
+
+    return CookiePool(
+        accounts,
+        failure_threshold=int(os.getenv('COOKIE_POOL_FAILURE_THRESHOLD', '3')),
+        cooldown=int(os.getenv('COOKIE_POOL_COOLDOWN', '60')),
+        rate_limit_cooldown=int(os.getenv('COOKIE_POOL_RATE_LIMIT_COOLDOWN', '300')),
+    )
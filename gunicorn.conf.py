@@ -0,0 +1,122 @@
+"""
+Gunicorn Production Profile
+Loaded automatically by `gunicorn app:app` from the project root.
+
+    gthread workers   each request thread mostly waits on Gemini, so threads
+                      serve far more concurrent requests than sync workers.
+                      For the async app:
+                      gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+    worker count      one process, unless state is shared (STATE_BACKEND=redis)
+                      and write-behind is off: chat sessions, cookie updates and
+                      pending outputs are otherwise per process, and a request
+                      landing on another worker wouldn't see them. Then one
+                      worker per core. WEB_CONCURRENCY always wins.
+    preload           the app (PIL, gemini_webapi, numpy, ...) is imported and
+                      the cookies verified once in the master; workers share
+                      those pages copy-on-write instead of importing it all again.
+    post_fork         each worker builds its own network clients (app.after_fork);
+                      pools, writer threads and the event loop are per-process
+                      already and start lazily.
+    recycling         a worker exits gracefully after max_requests, or once its
+                      memory passes GUNICORN_MAX_WORKER_MB, and is replaced.
+
+Every setting can be overridden on the command line or with the environment
+variables below (WEB_CONCURRENCY, GUNICORN_THREADS, GUNICORN_TIMEOUT, ...).
+"""
+
+import gc
+import math
+import os
+import sys
+
+from dotenv import load_dotenv
+
+
+# The app reads .env when it is imported; the worker count needs it before that
+load_dotenv()
+
+
+def available_cores():
+    """CPUs this process may use: affinity mask and cgroup (container) quota"""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cores = min(cores, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, cores)
+
+
+CORES = available_cores()
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# Per-process state (see above) only works with a single worker
+SHARED_STATE = (os.getenv('STATE_BACKEND', 'local').strip().lower() != 'local'
+                and os.getenv('OUTPUT_WRITE_BEHIND', '0').lower() not in ('1', 'true', 'yes'))
+workers = int(os.getenv('WEB_CONCURRENCY') or (max(2, CORES) if SHARED_STATE else 1))
+threads = int(os.getenv('GUNICORN_THREADS') or max(4, 2 * CORES))
+
+# Image operations get one CPU slot per core across all workers, not per worker
+os.environ.setdefault('IMAGE_WORKERS', str(max(1, CORES // workers)))
+
+preload_app = True
+
+# Generation (with retries) can legitimately take minutes
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '600'))
+# A recycled or restarted worker gets this long to finish in-flight generations
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '180'))
+keepalive = 5
+
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = max_requests // 10
+MAX_WORKER_BYTES = int(float(os.getenv('GUNICORN_MAX_WORKER_MB', '1024')) * 1024 * 1024)
+
+# Heartbeat files on tmpfs: a slow container disk can't get workers killed
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def _rss_bytes():
+    """Current resident set size (0 where /proc isn't available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def when_ready(server):
+    app = sys.modules.get('app')
+    if app is not None:  # preloaded
+        app.before_fork()
+    cfg = server.cfg
+    server.log.info(f"{cfg.workers} x {cfg.worker_class_str} workers, {cfg.threads} threads each ({CORES} cores)")
+    if cfg.workers > 1 and not SHARED_STATE:
+        server.log.warning("Several workers with per-process state: chat sessions, cookie updates and "
+                           "write-behind outputs are not shared between them (see STATE_BACKEND)")
+
+
+def pre_fork(server, worker):
+    # Keep the preloaded objects out of the collector so refcount-only work
+    # doesn't touch (and copy) their pages in every worker
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    app = sys.modules.get('app')
+    if app is not None:  # preloaded; otherwise the worker imports it fresh
+        app.after_fork()
+
+
+def post_request(worker, req, environ, resp):
+    # Not called by the uvicorn worker class; there only max_requests applies
+    if MAX_WORKER_BYTES and worker.alive:
+        rss = _rss_bytes()
+        if rss > MAX_WORKER_BYTES:
+            worker.log.info(f"Worker {worker.pid} at {rss // (1024 * 1024)}MB RSS; recycling after in-flight requests")
+            worker.alive = False
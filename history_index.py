@@ -0,0 +1,267 @@
+"""
+Generation History Index
+An SQLite database (WAL mode) with one row per generated image: where it is
+served from, the prompt, aspect ratio, style and how long generation took.
+It lets the gallery be listed and searched without scanning static/generated.
+
+Writes never block a generation: record() only queues the row, and a writer
+thread inserts queued rows in batches, one transaction per batch. Reads use
+one connection per thread; WAL lets them run while the writer commits.
+
+Each row records its owner (an opaque caller key, e.g. a hashed browser
+session), and reads given an owner only see that owner's rows. Rows
+written without one are only visible to owner-less (global) reads.
+
+Listing is keyset-paginated on the row id (newest first), so page N costs
+the same as page 1 however large the table grows. Prompt search goes through
+an FTS5 index (falling back to LIKE when SQLite lacks FTS5).
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    url TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    aspect_ratio TEXT,
+    style TEXT,
+    hd INTEGER NOT NULL DEFAULT 0,
+    generation_seconds REAL,
+    trace_id TEXT,
+    owner TEXT
+);
+CREATE INDEX IF NOT EXISTS images_aspect_ratio ON images (aspect_ratio, id);
+"""
+
+OWNER_INDEX = "CREATE INDEX IF NOT EXISTS images_owner ON images (owner, id);"
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(prompt, content='images', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS images_fts_insert AFTER INSERT ON images BEGIN
+    INSERT INTO images_fts (rowid, prompt) VALUES (new.id, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS images_fts_delete AFTER DELETE ON images BEGIN
+    INSERT INTO images_fts (images_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt);
+END;
+"""
+
+# Returned by reads (owner is deliberately not exposed)
+COLUMNS = ('id', 'created_at', 'url', 'prompt', 'aspect_ratio', 'style', 'hd', 'generation_seconds', 'trace_id')
+INSERT_COLUMNS = COLUMNS[1:] + ('owner',)
+MAX_PAGE_SIZE = 200
+WRITE_BATCH = 500
+
+
+def _fts_query(text):
+    """User text -> FTS5 query: every word must match, the last one as a prefix"""
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+class HistoryIndex:
+    """SQLite-backed generation history with a background batch writer"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self.fts = False
+        self._written = 0
+        self._write_errors = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            # Databases created before rows had owners
+            if 'owner' not in {row[1] for row in conn.execute('PRAGMA table_info(images)')}:
+                conn.execute('ALTER TABLE images ADD COLUMN owner TEXT')
+            conn.executescript(OWNER_INDEX)
+            try:
+                conn.executescript(FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                pass  # SQLite built without FTS5: search falls back to LIKE
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _reader(self):
+        # Connections can't cross a fork; each thread of each process opens its own
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    # --- writes ---
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._writer.is_alive():
+                return
+            self._queue = queue.Queue()
+            self._written = 0
+            self._write_errors = 0
+            self._writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+            self._pid = os.getpid()
+            self._writer.start()
+
+    def record(self, url, prompt, aspect_ratio=None, style=None, hd=False, generation_seconds=None, trace_id=None,
+               owner=None):
+        """Queue one image for the index (returns immediately)"""
+        self._ensure_writer()
+        self._queue.put((time.time(), url, prompt, aspect_ratio, style, int(bool(hd)), generation_seconds, trace_id,
+                         owner))
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            rows = [self._queue.get()]
+            while len(rows) < WRITE_BATCH:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    conn.executemany(
+                        f"INSERT INTO images ({', '.join(INSERT_COLUMNS)}) VALUES ({', '.join('?' * len(INSERT_COLUMNS))})",
+                        rows
+                    )
+                self._written += len(rows)
+            except sqlite3.Error as e:
+                self._write_errors += len(rows)
+                print(f"⚠️ History index write failed ({len(rows)} rows): {e}")
+            finally:
+                for _ in rows:
+                    self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued record is written"""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    # --- reads ---
+
+    @staticmethod
+    def _page(rows, limit):
+        items = [dict(zip(COLUMNS, row)) for row in rows[:limit]]
+        for item in items:
+            item['hd'] = bool(item['hd'])
+        next_cursor = str(items[-1]['id']) if len(rows) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+    @staticmethod
+    def _bounds(limit, cursor):
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        before = int(cursor) if cursor else None
+        return limit, before
+
+    def list(self, limit=50, cursor=None, aspect_ratio=None, style=None, owner=None):
+        """
+        Newest-first page of images.
+
+        Args:
+            cursor: next_cursor from the previous page (None for the first page)
+            owner: only this owner's images (None: everyone's)
+        Returns:
+            {'items': [...], 'next_cursor': str or None}
+        """
+        limit, before = self._bounds(limit, cursor)
+        clauses, params = [], []
+        if owner is not None:
+            clauses.append('owner = ?')
+            params.append(owner)
+        if before is not None:
+            clauses.append('id < ?')
+            params.append(before)
+        if aspect_ratio:
+            clauses.append('aspect_ratio = ?')
+            params.append(aspect_ratio)
+        if style:
+            clauses.append('style = ?')
+            params.append(style)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self._reader().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM images {where} ORDER BY id DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        return self._page(rows, limit)
+
+    def get(self, ids, owner=None):
+        """Images by id ({id: item}; unknown ids, and other owners' images, are left out)"""
+        ids = [int(image_id) for image_id in ids]
+        if not ids:
+            return {}
+        sql = f"SELECT {', '.join(COLUMNS)} FROM images WHERE id IN ({', '.join('?' * len(ids))})"
+        if owner is not None:
+            sql += " AND owner = ?"
+            ids.append(owner)
+        rows = self._reader().execute(sql, ids).fetchall()
+        return {item['id']: item for item in self._page(rows, len(rows))['items']}
+
+    def search(self, text, limit=50, cursor=None, owner=None):
+        """Newest-first page of images whose prompt contains every word of `text` (owner as in list)"""
+        limit, before = self._bounds(limit, cursor)
+        match = _fts_query(text)
+        if match is None:
+            return {'items': [], 'next_cursor': None}
+
+        columns = ', '.join(f'images.{column}' for column in COLUMNS)
+        before = before if before is not None else 2 ** 63 - 1
+        if self.fts and owner is None:
+            # FTS5 walks its rowids in descending order and stops after limit + 1 matches
+            sql = (f"SELECT {columns} FROM images JOIN ("
+                   f"SELECT rowid FROM images_fts WHERE images_fts MATCH ? AND rowid < ? "
+                   f"ORDER BY rowid DESC LIMIT ?) AS hits ON images.id = hits.rowid ORDER BY images.id DESC")
+            params = [match, before, limit + 1]
+        elif self.fts:
+            # The owner filter has to apply before the limit, so join instead of limiting the matches
+            sql = (f"SELECT {columns} FROM images JOIN images_fts ON images.id = images_fts.rowid "
+                   f"WHERE images_fts MATCH ? AND images.id < ? AND images.owner = ? "
+                   f"ORDER BY images.id DESC LIMIT ?")
+            params = [match, before, owner, limit + 1]
+        else:
+            words = text.split()
+            sql = (f"SELECT {columns} FROM images WHERE images.id < ? "
+                   + (' AND owner = ?' if owner is not None else '')
+                   + ''.join(' AND prompt LIKE ?' for _ in words)
+                   + " ORDER BY images.id DESC LIMIT ?")
+            params = ([before] + ([owner] if owner is not None else [])
+                      + [f'%{word}%' for word in words] + [limit + 1])
+        rows = self._reader().execute(sql, params).fetchall()
+        return self._page(rows, limit)
+
+    def stats(self):
+        return {
+            'fts': self.fts,
+            'written': self._written,
+            'write_errors': self._write_errors,
+            'queued': self._queue.qsize() if self._pid == os.getpid() else 0,
+        }
+
+
+def index_from_env(instance_path):
+    """HISTORY_DB overrides the database location (default <instance>/history.db)"""
+    return HistoryIndex(os.getenv('HISTORY_DB') or os.path.join(instance_path, 'history.db'))
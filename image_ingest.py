@@ -0,0 +1,172 @@
+"""
+Image Ingestion
+Bounded reads for every image the server takes in: generated image downloads,
+proxied images, upscale sources and uploads.
+
+Bodies are streamed in chunks and refused as soon as they pass the byte cap
+(or up front when Content-Length already says so), instead of being loaded
+whole into memory. Before an image is handed to the image workers, only its
+header is parsed and the dimensions are checked against a pixel budget, so a
+small file that decodes to a huge bitmap is rejected without decoding it.
+
+Limits (env):
+    MAX_IMAGE_BYTES   largest image body read from anywhere (default 25MB)
+    MAX_IMAGE_PIXELS  largest width x height accepted for processing (default 40M)
+"""
+
+import base64
+import collections
+import os
+from io import BytesIO
+
+import requests
+from PIL import Image
+
+import metrics
+
+
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', str(25 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', '40000000'))
+CHUNK_SIZE = 64 * 1024
+
+# What a download returns: the same fields the handlers used from requests/httpx responses
+Fetched = collections.namedtuple('Fetched', 'status_code headers content')
+
+
+class IngestError(ValueError):
+    """An image was refused; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _reject(source, reason, message):
+    metrics.INGEST_REJECTED.inc(source=source, reason=reason)
+    raise IngestError(message, 413)
+
+
+def _too_many_bytes(source, limit):
+    _reject(source, 'bytes', f'File too large. Maximum size: {limit / 1024 / 1024}MB')
+
+
+class _LimitedBuffer:
+    """Collects body chunks, failing as soon as the total passes the limit"""
+
+    def __init__(self, source, limit, declared_length=None):
+        self.source = source
+        self.limit = limit or MAX_IMAGE_BYTES
+        self.size = 0
+        self.chunks = []
+        if declared_length and declared_length.isdigit() and int(declared_length) > self.limit:
+            _too_many_bytes(source, self.limit)
+
+    def add(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            _too_many_bytes(self.source, self.limit)
+        self.chunks.append(chunk)
+
+    def getvalue(self):
+        metrics.INGEST_BYTES.observe(self.size, source=self.source)
+        return b''.join(self.chunks)
+
+
+def check_size(data, source, limit=None):
+    """Apply the byte cap to data that was read elsewhere (e.g. curl output)"""
+    limit = limit or MAX_IMAGE_BYTES
+    if len(data) > limit:
+        _too_many_bytes(source, limit)
+    metrics.INGEST_BYTES.observe(len(data), source=source)
+    return data
+
+
+def curl_limit_args(limit=None):
+    """curl options that abort a transfer larger than the byte cap"""
+    return ['--max-filesize', str(limit or MAX_IMAGE_BYTES)]
+
+
+def fetch(url, source, limit=None, **kwargs):
+    """
+    GET an image with requests, streaming the body under the byte cap.
+    Bodies of non-200 responses are not read.
+
+    Returns:
+        Fetched(status_code, headers, content)
+    """
+    with requests.get(url, stream=True, **kwargs) as response:
+        if response.status_code != 200:
+            return Fetched(response.status_code, response.headers, b'')
+        buffer = _LimitedBuffer(source, limit, response.headers.get('Content-Length'))
+        for chunk in response.iter_content(CHUNK_SIZE):
+            buffer.add(chunk)
+        return Fetched(response.status_code, response.headers, buffer.getvalue())
+
+
+async def afetch(client, url, source, limit=None, **kwargs):
+    """fetch() for an httpx.AsyncClient"""
+    async with client.stream('GET', url, **kwargs) as response:
+        if response.status_code != 200:
+            return Fetched(response.status_code, response.headers, b'')
+        buffer = _LimitedBuffer(source, limit, response.headers.get('Content-Length'))
+        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+            buffer.add(chunk)
+        return Fetched(response.status_code, response.headers, buffer.getvalue())
+
+
+def read_stream(stream, source, limit=None):
+    """Read a file-like object (e.g. an uploaded file) under the byte cap"""
+    buffer = _LimitedBuffer(source, limit)
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        buffer.add(chunk)
+    return buffer.getvalue()
+
+
+async def aread_upload(upload, source, limit=None):
+    """read_stream() for a Starlette UploadFile"""
+    buffer = _LimitedBuffer(source, limit)
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            return buffer.getvalue()
+        buffer.add(chunk)
+
+
+def read_file(path, source, limit=None):
+    """Read a local image, checking its size before loading it"""
+    limit = limit or MAX_IMAGE_BYTES
+    if os.path.getsize(path) > limit:
+        _too_many_bytes(source, limit)
+    with open(path, 'rb') as f:
+        return check_size(f.read(), source, limit)
+
+
+def decode_data_url(data_url, source, limit=None):
+    """Decode a base64 data URL, checking the decoded size before decoding"""
+    limit = limit or MAX_IMAGE_BYTES
+    encoded = data_url.split(',', 1)[1] if ',' in data_url else ''
+    if len(encoded) * 3 // 4 > limit:
+        _too_many_bytes(source, limit)
+    return check_size(base64.b64decode(encoded), source, limit)
+
+
+def check_pixels(data, source, max_pixels=None):
+    """
+    Parse only the image header and refuse images over the pixel budget,
+    before anything decodes them.
+
+    Returns:
+        (width, height)
+    """
+    max_pixels = max_pixels or MAX_IMAGE_PIXELS
+    try:
+        with Image.open(BytesIO(data)) as img:
+            width, height = img.size
+    except Image.DecompressionBombError:
+        _reject(source, 'pixels', f'Image too large. Maximum: {max_pixels / 1e6:g} megapixels')
+    except Exception:
+        raise IngestError('Cannot decode image') from None
+
+    if width * height > max_pixels:
+        _reject(source, 'pixels', f'Image too large ({width}x{height}). Maximum: {max_pixels / 1e6:g} megapixels')
+    return width, height
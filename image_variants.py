@@ -0,0 +1,212 @@
+"""
+Image Format Variants
+Generated images are stored as quality=98 JPEGs. Browsers that accept WebP or
+AVIF (per the Accept header) get a transcode instead, usually a fraction of
+the size.
+
+Each transcode is produced on first request, on the image workers, and
+written next to its original (gen_<id>.jpg -> gen_<id>.jpg.avif). Later
+requests are served straight from that file. Like the upscale cache, the
+files are the cache: every worker process shares them, mtime is the LRU
+position, and the least recently used variants are deleted once they pass
+the size budget. Originals are never touched.
+
+A variant that came out larger than its original is kept (so it isn't
+transcoded again) but never served.
+"""
+
+import os
+import threading
+import uuid
+
+from PIL import features
+
+import metrics
+
+
+# Preference order when the client accepts several formats equally
+FORMATS = ('avif', 'webp')
+CONTENT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+SOURCE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def _accepted(accept, fmt):
+    """q-value the Accept header gives the image type explicitly (wildcards don't count)"""
+    for part in accept.lower().split(','):
+        media_type, *params = part.strip().split(';')
+        if media_type.strip() != CONTENT_TYPES[fmt]:
+            continue
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    return float(value)
+                except ValueError:
+                    return 0.0
+        return 1.0
+    return 0.0
+
+
+class ImageVariants:
+    """Size-bounded LRU store of WebP/AVIF transcodes kept next to their originals"""
+
+    def __init__(self, max_bytes, transcode, formats=FORMATS):
+        """
+        Args:
+            transcode: transcode(data, fmt, consume) -> (consume(encoded), info),
+                       i.e. the 'transcode' image operation on the image workers
+        """
+        self.max_bytes = max_bytes
+        self.transcode = transcode
+        # Drop formats this Pillow build can't encode
+        self.formats = tuple(fmt for fmt in formats if fmt in FORMATS and features.check(fmt))
+        self._lock = threading.Lock()
+        self._inflight = {}       # variant path -> lock held while it is transcoded
+        self._directories = set()
+        self._bytes = None        # variant bytes on disk (None: not scanned yet)
+        self._served = 0
+        self._transcodes = 0
+        self._failures = 0
+        self._evictions = 0
+        self._bytes_saved = 0
+
+    def negotiate(self, accept):
+        """Best variant format for an Accept header, or None for the original"""
+        best, best_q = None, 0.0
+        for fmt in self.formats:
+            q = _accepted(accept, fmt)
+            if q > best_q:
+                best, best_q = fmt, q
+        return best
+
+    def select(self, path, accept):
+        """
+        Pick what to send for the original image at `path`.
+
+        Returns:
+            (path to send, format or None). Falls back to the original when the
+            client accepts no variant format or the variant would be larger.
+        """
+        fmt = self.negotiate(accept) if path.lower().endswith(SOURCE_EXTENSIONS) else None
+        if fmt is None:
+            return path, None
+
+        variant = f"{path}.{fmt}"
+        try:
+            os.utime(variant)
+            result = 'hit'
+        except FileNotFoundError:
+            result = self._create(path, variant, fmt)
+            if result == 'failed':
+                metrics.IMAGE_VARIANT_RESPONSES.inc(format=fmt, result=result)
+                return path, None
+
+        original_size = os.path.getsize(path)
+        try:
+            variant_size = os.path.getsize(variant)
+        except FileNotFoundError:
+            # Evicted in the meantime (budget smaller than what is being served)
+            return path, None
+        if variant_size >= original_size:
+            metrics.IMAGE_VARIANT_RESPONSES.inc(format=fmt, result='larger')
+            return path, None
+
+        metrics.IMAGE_VARIANT_RESPONSES.inc(format=fmt, result=result)
+        metrics.IMAGE_VARIANT_BYTES_SAVED.inc(original_size - variant_size)
+        with self._lock:
+            self._served += 1
+            self._bytes_saved += original_size - variant_size
+        return variant, fmt
+
+    def _create(self, path, variant, fmt):
+        # One transcode per variant: concurrent requests for it wait for the first
+        with self._lock:
+            lock = self._inflight.setdefault(variant, threading.Lock())
+        try:
+            with lock:
+                if os.path.exists(variant):
+                    return 'hit'
+                with open(path, 'rb') as f:
+                    data = f.read()
+                try:
+                    size, _ = self.transcode(data, fmt, lambda encoded: self._write(variant, encoded))
+                except Exception as e:
+                    with self._lock:
+                        self._failures += 1
+                    print(f"⚠️ {fmt} transcode of {os.path.basename(path)} failed: {e}")
+                    return 'failed'
+        finally:
+            with self._lock:
+                self._inflight.pop(variant, None)
+
+        with self._lock:
+            self._transcodes += 1
+            self._directories.add(os.path.dirname(variant))
+            if self._bytes is not None:
+                self._bytes += size
+        self._evict()
+        return 'transcoded'
+
+    @staticmethod
+    def _write(variant, encoded):
+        temp_path = f"{variant}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(encoded)
+        # Atomic: concurrent readers (and other workers) never see a partial file
+        os.replace(temp_path, variant)
+        return len(encoded)
+
+    def _entries(self):
+        entries = []
+        for directory in list(self._directories):
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext[1:] in FORMATS and stem.lower().endswith(SOURCE_EXTENSIONS) and entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        # Other workers write variants too, so the running total is only a hint:
+        # rescan whenever it says the budget may be exceeded
+        if self._bytes is not None and self._bytes <= self.max_bytes:
+            return
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker got there first
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._bytes = total
+            self._evictions += evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'formats': list(self.formats),
+                'max_bytes': self.max_bytes,
+                'bytes': self._bytes,
+                'served': self._served,
+                'transcodes': self._transcodes,
+                'failures': self._failures,
+                'evictions': self._evictions,
+                'bytes_saved': self._bytes_saved,
+            }
+
+
+def variants_from_env(transcode):
+    """IMAGE_VARIANT_FORMATS (default avif,webp) and IMAGE_VARIANT_CACHE_MB (default 1024)"""
+    formats = [fmt.strip().lower() for fmt in os.getenv('IMAGE_VARIANT_FORMATS', ','.join(FORMATS)).split(',')]
+    return ImageVariants(
+        int(float(os.getenv('IMAGE_VARIANT_CACHE_MB', '1024')) * 1024 * 1024),
+        transcode,
+        formats=tuple(fmt for fmt in formats if fmt),
+    )
@@ -0,0 +1,270 @@
+"""
+Image Worker Pool
+Runs the CPU-bound Pillow operations from image_ops.py under a per-process
+CPU budget, in one of two modes (IMAGE_WORKER_MODE):
+
+    thread   (default) operations run in the calling thread, at most
+             `max_workers` at once. Pillow releases the GIL inside its C
+             operations, so these overlap, but the Python-level parts and
+             the request handling still share the web worker.
+
+    process  operations run in a dedicated pool of worker processes. Source
+             bytes and encoded results are handed over through shared memory
+             blocks (multiprocessing.shared_memory) instead of being pickled
+             through the pool's pipes; only the block names travel.
+
+The pool also has a small thread executor (submit/arun) used to fan out
+batch jobs. Everything is created lazily and recreated after a fork so
+each web worker owns its own threads and processes.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+
+import image_ops
+
+
+def _attach(name):
+    return shared_memory.SharedMemory(name=name)
+
+
+def _process_task(op, source_name, source_size, params):
+    """
+    Worker process entry point: read the source from shared memory, run the
+    operation and publish the encoded result in a new shared memory block.
+    Returns (result_block_name, result_size, info); the caller unlinks the block.
+    """
+    started_cpu = time.process_time()
+    source = _attach(source_name)
+    view = source.buf[:source_size]
+    try:
+        encoded, info = image_ops.OPERATIONS[op](view, **params)
+    except Exception as e:
+        # Re-raise without the traceback: its frames pin the shared memory view
+        raise type(e)(*e.args) from None
+    finally:
+        view.release()
+        source.close()
+
+    size = len(encoded)
+    result = shared_memory.SharedMemory(create=True, size=max(1, size))
+    try:
+        result.buf[:size] = encoded
+    finally:
+        encoded.release()
+        result.close()
+    info['cpu_seconds'] = time.process_time() - started_cpu
+    return result.name, size, info
+
+
+def _preload():
+    # Runs once per worker process: pay for PIL's codec imports up front
+    from PIL import Image
+    Image.init()
+
+
+class ImageWorkerPool:
+    """CPU budget for image operations plus a thread executor for fan-out"""
+
+    def __init__(self, max_workers=None, mode='thread', name='image-worker'):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"Unknown image worker mode: {mode}")
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.mode = mode
+        self.name = name
+        self._lock = threading.Lock()
+        self._executor = None
+        self._processes = None
+        self._slots = None
+        self._pid = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._queued = 0
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+        self._busy_seconds = 0.0
+        self._op_pending = 0
+        self._op_completed = 0
+        self._op_failed = 0
+        self._cpu_seconds = 0.0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Threads and pool processes don't survive a fork; start fresh
+            self._reset_stats()
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix=self.name
+            )
+            self._slots = threading.BoundedSemaphore(self.max_workers)
+            self._processes = None
+            if self.mode == 'process':
+                # forkserver/spawn: never fork a process that has an event loop thread running
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                context = multiprocessing.get_context(method)
+                if method == 'forkserver':
+                    context.set_forkserver_preload(['image_ops'])
+                self._processes = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=context, initializer=_preload,
+                )
+            self._pid = os.getpid()
+
+    @property
+    def executor(self):
+        self._ensure_started()
+        return self._executor
+
+    # --- image operations ---
+
+    def run_op(self, op, data, consume=bytes, **params):
+        """
+        Run an image_ops operation on `data` (bytes-like) under the CPU budget.
+
+        Args:
+            op: name in image_ops.OPERATIONS
+            consume: called with the encoded result (a bytes-like buffer that is only
+                     valid during the call) - e.g. write it to a file or base64 it
+        Returns:
+            (consume(result), info)
+        Raises:
+            image_ops.ImageOpError for inputs the operation rejects
+        """
+        self._ensure_started()
+        with self._lock:
+            self._op_pending += 1
+        try:
+            if self.mode == 'process':
+                output, info = self._run_in_process(op, data, consume, params)
+            else:
+                output, info = self._run_in_thread(op, data, consume, params)
+        except BaseException:
+            with self._lock:
+                self._op_pending -= 1
+                self._op_failed += 1
+            raise
+        with self._lock:
+            self._op_pending -= 1
+            self._op_completed += 1
+            self._cpu_seconds += info.get('cpu_seconds', 0.0)
+        return output, info
+
+    def _run_in_thread(self, op, data, consume, params):
+        with self._slots:
+            started_cpu = time.thread_time()
+            encoded, info = image_ops.OPERATIONS[op](data, **params)
+            info['cpu_seconds'] = time.thread_time() - started_cpu
+        try:
+            return consume(encoded), info
+        finally:
+            encoded.release()
+
+    def _run_in_process(self, op, data, consume, params):
+        source = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            source.buf[:len(data)] = data
+            result_name, result_size, info = self._processes.submit(
+                _process_task, op, source.name, len(data), params
+            ).result()
+        finally:
+            source.close()
+            source.unlink()
+
+        result = _attach(result_name)
+        try:
+            view = result.buf[:result_size]
+            try:
+                return consume(view), info
+            finally:
+                view.release()
+        finally:
+            result.close()
+            result.unlink()
+
+    # --- fan-out executor (batch jobs) ---
+
+    def _run(self, fn, args, kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._busy_seconds += time.perf_counter() - started
+                if failed:
+                    self._failed += 1
+                else:
+                    self._completed += 1
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) on the executor; returns a concurrent.futures.Future"""
+        executor = self.executor
+        with self._lock:
+            self._queued += 1
+        future = executor.submit(self._run, fn, args, kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        # Cancelled while still queued: _run never started, so it never un-counted it
+        if future.cancelled():
+            with self._lock:
+                self._queued -= 1
+
+    def run(self, fn, *args, **kwargs):
+        """Run on the executor and block for the result (sync handlers)"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def arun(self, fn, *args, **kwargs):
+        """Run on the executor without blocking the calling event loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'workers': self.max_workers,
+                'active': self._active,
+                'queued': self._queued,
+                'completed': self._completed,
+                'failed': self._failed,
+                'busy_seconds': round(self._busy_seconds, 2),
+                'ops_in_flight': min(self._op_pending, self.max_workers),
+                'ops_queued': max(0, self._op_pending - self.max_workers),
+                'ops_completed': self._op_completed,
+                'ops_failed': self._op_failed,
+                'cpu_seconds': round(self._cpu_seconds, 3),
+                'avg_cpu_ms': round(self._cpu_seconds / self._op_completed * 1000, 1) if self._op_completed else 0.0,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            processes, executor = self._processes, self._executor
+            self._pid = None
+        # Outside the lock: cancelling queued futures runs _on_done, which takes it
+        if processes is not None:
+            processes.shutdown(wait=True, cancel_futures=True)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def pool_from_env():
+    """IMAGE_WORKERS sets the pool size (default: CPU cores), IMAGE_WORKER_MODE thread|process"""
+    workers = os.getenv('IMAGE_WORKERS')
+    return ImageWorkerPool(int(workers) if workers else None, mode=os.getenv('IMAGE_WORKER_MODE', 'thread'))
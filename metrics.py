@@ -0,0 +1,263 @@
+"""
+Metrics Registry (Prometheus text format)
+Small dependency-free counters and histograms for the generation pipeline,
+rendered at /metrics. Metrics are per worker process; scrape each worker
+(or run a single worker) to aggregate.
+"""
+
+import contextlib
+import threading
+import time
+
+
+# Latency buckets in seconds: covers sub-ms image ops up to multi-minute generations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# Size buckets in bytes: 64KB .. 1GB
+BYTE_BUCKETS = tuple(2 ** exponent for exponent in range(16, 31, 2))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _format_labels(self.label_names, key), value) for key, value in items]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+
+        samples = []
+        for key, series in items:
+            for index, bound in enumerate(self.buckets):
+                labels = _format_labels(self.label_names, key, ('le', _format_value(bound)))
+                samples.append((f'{self.name}_bucket', labels, series[index]))
+            labels = _format_labels(self.label_names, key)
+            samples.append((f'{self.name}_sum', labels, series[-2]))
+            samples.append((f'{self.name}_count', labels, series[-1]))
+        return samples
+
+
+class Registry:
+    """Holds metrics plus collector callbacks that export point-in-time gauges"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """
+        Register a callable returning [(name, documentation, {labels: value})]
+        whose values are exported as gauges on every scrape.
+        """
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+
+        for collect in self._collectors:
+            try:
+                gauges = collect()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+                continue
+            for name, documentation, series in gauges:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} gauge')
+                for labels, value in series.items():
+                    label_text = _format_labels([k for k, _ in labels], [v for _, v in labels])
+                    lines.append(f'{name}{label_text} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REGISTRY = Registry()
+
+# --- Generation pipeline ---
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'gemini_stage_seconds',
+    'Time spent in each generation pipeline stage '
+    '(client_init, generate_content, image_download, fallback_fetch, crop_resize, sharpen, encode_save, '
+    'upscale_resize, upscale_sharpen, upscale_encode, upload_resize, upload_encode, transcode_encode)',
+    labels=('stage',)
+)
+GENERATION_ATTEMPTS = REGISTRY.counter(
+    'gemini_generation_attempts_total',
+    'generate_content attempts by outcome (images, empty, or failure class)',
+    labels=('outcome',)
+)
+EMPTY_RESPONSES = REGISTRY.counter(
+    'gemini_empty_responses_total',
+    'generate_content responses that contained no images'
+)
+UPSTREAM_403 = REGISTRY.counter(
+    'gemini_upstream_403_total',
+    'HTTP 403 responses when downloading images',
+    labels=('source',)
+)
+CURL_FALLBACKS = REGISTRY.counter(
+    'gemini_curl_fallbacks_total',
+    'curl fallback downloads after a 403, by result',
+    labels=('source', 'result')
+)
+PROXY_FALLBACKS = REGISTRY.counter(
+    'gemini_proxy_fallbacks_total',
+    'Generated images served through /api/proxy-image because local processing failed'
+)
+
+# --- Image ingestion and memory ---
+
+INGEST_BYTES = REGISTRY.histogram(
+    'gemini_ingest_bytes',
+    'Size of image bodies read, by source (download, proxy, upscale, upload)',
+    labels=('source',), buckets=BYTE_BUCKETS
+)
+INGEST_REJECTED = REGISTRY.counter(
+    'gemini_ingest_rejected_total',
+    'Images refused by the ingestion limits, by source and reason (bytes, pixels)',
+    labels=('source', 'reason')
+)
+IMAGE_OP_PEAK_BYTES = REGISTRY.histogram(
+    'gemini_image_op_peak_bytes',
+    'Estimated peak memory of one image operation (source + decoded bitmaps + encoded output)',
+    labels=('operation',), buckets=BYTE_BUCKETS
+)
+REQUEST_PEAK_BYTES = REGISTRY.histogram(
+    'gemini_request_image_peak_bytes',
+    'Estimated peak image memory held by one request, by endpoint',
+    labels=('endpoint',), buckets=BYTE_BUCKETS
+)
+
+# --- Upscale cache ---
+
+UPSCALE_CACHE_LOOKUPS = REGISTRY.counter(
+    'gemini_upscale_cache_lookups_total',
+    'Upscale cache lookups by result (hit, miss)',
+    labels=('result',)
+)
+UPSCALE_CACHE_CPU_SAVED = REGISTRY.counter(
+    'gemini_upscale_cache_cpu_saved_seconds_total',
+    'Image worker CPU seconds not spent thanks to upscale cache hits'
+)
+
+# --- Chat attachments ---
+
+ATTACHMENT_CACHE_LOOKUPS = REGISTRY.counter(
+    'gemini_attachment_cache_lookups_total',
+    'Chat attachment cache lookups by kind (file, upload) and result (hit, miss)',
+    labels=('kind', 'result')
+)
+
+# --- Output storage ---
+
+OUTPUT_WRITE_SECONDS = REGISTRY.histogram(
+    'gemini_output_write_seconds',
+    'Time to persist one generated image, by storage backend (local, s3)',
+    labels=('backend',)
+)
+OUTPUT_WRITES = REGISTRY.counter(
+    'gemini_output_writes_total',
+    'Generated image writes by result (ok, retried, failed)',
+    labels=('result',)
+)
+
+# --- Image format negotiation ---
+
+IMAGE_VARIANT_RESPONSES = REGISTRY.counter(
+    'gemini_image_variant_responses_total',
+    'Generated images served by negotiated format and result (hit, transcoded, larger, failed)',
+    labels=('format', 'result')
+)
+IMAGE_VARIANT_BYTES_SAVED = REGISTRY.counter(
+    'gemini_image_variant_bytes_saved_total',
+    'Bytes not sent thanks to serving WebP/AVIF instead of the original'
+)
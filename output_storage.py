@@ -0,0 +1,321 @@
+"""
+Output Storage
+Where generated images are persisted (OUTPUT_STORAGE):
+
+    local  (default) files in static/generated, served by the app (and
+           its WebP/AVIF variants, sendfile offload, ...).
+
+    s3     objects in an S3-compatible bucket (AWS S3, MinIO, R2, ...),
+           so every worker and node sees every output. Needs `boto3`.
+           /static/generated/<name> redirects to OUTPUT_S3_PUBLIC_URL when
+           the bucket (or a CDN in front of it) is public, and is proxied
+           through the app otherwise.
+
+With write-behind (OUTPUT_WRITE_BEHIND=1) put() only queues the encoded
+image; writer threads persist it in the background, and until then the
+image is served (and read back, e.g. by /api/upscale) from memory. Queued
+bytes are capped: past OUTPUT_WRITE_BEHIND_MB, put() writes synchronously
+instead. Pending writes are flushed at interpreter exit.
+
+A write that still fails after its retries is not dropped: the image stays
+in memory (and servable) and is retried every FAILED_RETRY_INTERVAL seconds
+until storage accepts it. Such writes are counted as failed_pending.
+
+Pending bytes live in the memory of the worker that produced them. With
+several workers, other workers 404 the image until it is written, so run
+write-behind with a single worker or sticky routing.
+"""
+
+import atexit
+import collections
+import mimetypes
+import os
+import queue
+import threading
+import time
+import uuid
+
+import metrics
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+WRITE_ATTEMPTS = 3
+FAILED_RETRY_INTERVAL = 30.0
+
+
+class LocalStorage:
+    """Files in one directory"""
+
+    name = 'local'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, name, data):
+        path = os.path.join(self.directory, name)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        # Atomic: readers never see a partial file
+        os.replace(temp_path, path)
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, name):
+        return os.path.isfile(os.path.join(self.directory, name))
+
+    def local_path(self, name):
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    def public_url(self, name):
+        return None
+
+
+class S3Storage:
+    """Objects under a key prefix in an S3-compatible bucket"""
+
+    name = 's3'
+
+    def __init__(self, bucket, prefix='generated/', endpoint_url=None, region=None, public_url=None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("OUTPUT_STORAGE=s3 needs the boto3 package: pip install boto3") from None
+        self._boto3 = boto3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.base_url = public_url.rstrip('/') if public_url else None
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # boto3 clients are thread-safe but their connection pools don't survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._client = self._boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region)
+                    self._pid = os.getpid()
+        return self._client
+
+    def put(self, name, data):
+        self.client.put_object(
+            Bucket=self.bucket, Key=self.prefix + name, Body=bytes(data),
+            ContentType=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            CacheControl=IMMUTABLE,
+        )
+
+    def read(self, name):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + name)
+            return True
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def local_path(self, name):
+        return None
+
+    def public_url(self, name):
+        return f"{self.base_url}/{self.prefix}{name}" if self.base_url else None
+
+
+class OutputStore:
+    """A storage backend, optionally behind an in-memory write-behind queue"""
+
+    def __init__(self, storage, write_behind=False, max_pending_bytes=256 * 1024 * 1024, writers=4):
+        self.storage = storage
+        self.write_behind = write_behind
+        self.max_pending_bytes = max_pending_bytes
+        self.writers = writers
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()  # name -> bytes not yet persisted
+        self._pending_bytes = 0
+        self._failed_pending = set()  # names whose retries ran out; kept in _pending and retried later
+        self._queue = None
+        self._pid = None
+        self._reset_stats()
+        if write_behind:
+            atexit.register(self.flush)
+
+    def _reset_stats(self):
+        self._writes = 0
+        self._sync_writes = 0
+        self._retries = 0
+        self._failures = 0
+        self._write_seconds = 0.0
+        self._max_lag = 0.0
+
+    def _ensure_writers(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Writer threads don't survive a fork (and the parent's queue is theirs)
+            self._pending.clear()
+            self._pending_bytes = 0
+            self._failed_pending.clear()
+            self._reset_stats()
+            self._queue = queue.Queue()
+            for index in range(self.writers):
+                threading.Thread(target=self._write_loop, name=f'output-writer-{index}', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _persist(self, name, data):
+        started = time.perf_counter()
+        self.storage.put(name, data)
+        elapsed = time.perf_counter() - started
+        metrics.OUTPUT_WRITE_SECONDS.observe(elapsed, backend=self.storage.name)
+        metrics.OUTPUT_WRITES.inc(result='ok')
+        with self._lock:
+            self._writes += 1
+            self._write_seconds += elapsed
+
+    def put(self, name, data):
+        """Store an encoded output (bytes-like, copied if queued)"""
+        if not self.write_behind:
+            self._persist(name, data)
+            return
+        self._ensure_writers()
+        data = bytes(data)
+        with self._lock:
+            queued = self._pending_bytes + len(data) <= self.max_pending_bytes
+            if queued:
+                self._pending[name] = data
+                self._pending_bytes += len(data)
+            else:
+                self._sync_writes += 1
+        if queued:
+            self._queue.put((name, time.perf_counter()))
+        else:
+            # Backlog full: the writers can't keep up, so this caller waits for its own write
+            self._persist(name, data)
+
+    def _write_loop(self):
+        while True:
+            name, queued_at = self._queue.get()
+            written = False
+            try:
+                with self._lock:
+                    data = self._pending.get(name)
+                for attempt in range(WRITE_ATTEMPTS):
+                    try:
+                        self._persist(name, data)
+                        written = True
+                        break
+                    except Exception as e:
+                        if attempt + 1 == WRITE_ATTEMPTS:
+                            metrics.OUTPUT_WRITES.inc(result='failed')
+                            with self._lock:
+                                self._failures += 1
+                                self._failed_pending.add(name)
+                            print(f"❌ Writing {name} to {self.storage.name} storage failed ({e}); "
+                                  f"keeping it in memory, retrying in {FAILED_RETRY_INTERVAL:.0f}s")
+                        else:
+                            metrics.OUTPUT_WRITES.inc(result='retried')
+                            with self._lock:
+                                self._retries += 1
+                            time.sleep(0.5 * 2 ** attempt)
+            finally:
+                with self._lock:
+                    if written:
+                        data = self._pending.pop(name, None)
+                        if data is not None:
+                            self._pending_bytes -= len(data)
+                        self._failed_pending.discard(name)
+                        self._max_lag = max(self._max_lag, time.perf_counter() - queued_at)
+                if not written:
+                    # Its URL is already out there: keep serving it from memory and try again later
+                    retry = threading.Timer(FAILED_RETRY_INTERVAL, self._queue.put, ((name, queued_at),))
+                    retry.daemon = True
+                    retry.start()
+                self._queue.task_done()
+
+    def flush(self):
+        """Block until every queued output is written once (failed ones stay pending)"""
+        if self.write_behind and self._pid == os.getpid():
+            self._queue.join()
+            with self._lock:
+                failed = len(self._failed_pending)
+            if failed:
+                print(f"❌ {failed} generated image(s) could not be written to {self.storage.name} storage")
+
+    def pending(self, name):
+        """Bytes of an output that is queued but not yet persisted (None otherwise)"""
+        with self._lock:
+            return self._pending.get(name)
+
+    def read(self, name):
+        """An output's bytes from memory or storage (None if there is no such output)"""
+        data = self.pending(name)
+        return data if data is not None else self.storage.read(name)
+
+    def exists(self, name):
+        """Whether an output is stored or still queued"""
+        return self.pending(name) is not None or self.storage.exists(name)
+
+    def local_path(self, name):
+        """Filesystem path of a persisted output, when the backend is local"""
+        return self.storage.local_path(name)
+
+    def public_url(self, name):
+        """Where clients can fetch a persisted output directly (None: serve it through the app)"""
+        return self.storage.public_url(name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.storage.name,
+                'write_behind': self.write_behind,
+                'pending': len(self._pending),
+                'pending_bytes': self._pending_bytes,
+                'max_pending_bytes': self.max_pending_bytes,
+                'writes': self._writes,
+                'sync_writes': self._sync_writes,
+                'retries': self._retries,
+                'failures': self._failures,
+                'failed_pending': len(self._failed_pending),
+                'avg_write_ms': round(self._write_seconds / self._writes * 1000, 1) if self._writes else 0.0,
+                'max_lag_ms': round(self._max_lag * 1000, 1),
+            }
+
+
+def store_from_env(static_root):
+    """OUTPUT_STORAGE local|s3, OUTPUT_S3_*, OUTPUT_WRITE_BEHIND, OUTPUT_WRITE_BEHIND_MB, OUTPUT_WRITERS"""
+    kind = os.getenv('OUTPUT_STORAGE', 'local').strip().lower()
+    if kind == 'local':
+        storage = LocalStorage(os.path.join(static_root, 'generated'))
+    elif kind == 's3':
+        storage = S3Storage(
+            os.environ['OUTPUT_S3_BUCKET'],
+            prefix=os.getenv('OUTPUT_S3_PREFIX', 'generated/'),
+            endpoint_url=os.getenv('OUTPUT_S3_ENDPOINT') or None,
+            region=os.getenv('OUTPUT_S3_REGION') or None,
+            public_url=os.getenv('OUTPUT_S3_PUBLIC_URL') or None,
+        )
+    else:
+        raise ValueError(f"Unknown OUTPUT_STORAGE: {kind}")
+    return OutputStore(
+        storage,
+        write_behind=os.getenv('OUTPUT_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes'),
+        max_pending_bytes=int(float(os.getenv('OUTPUT_WRITE_BEHIND_MB', '256')) * 1024 * 1024),
+        writers=int(os.getenv('OUTPUT_WRITERS', '4')),
+    )
@@ -0,0 +1,102 @@
+"""
+Retry Policy for Gemini Generation
+Classifies upstream failures and computes jittered exponential backoff per
+failure class, bounded by a request deadline.
+"""
+
+import asyncio
+import os
+import random
+import time
+
+
+# Failure classes
+RATE_LIMIT = 'rate_limit'
+EMPTY = 'empty'
+NETWORK = 'network'
+AUTH = 'auth'
+ERROR = 'error'
+
+# Why a generation loop stopped (reported in the response meta)
+STOP_COMPLETED = 'completed'
+STOP_DEADLINE = 'deadline'
+STOP_MAX_ATTEMPTS = 'max_attempts'
+STOP_AUTH = 'auth_failed'
+STOP_CIRCUIT_OPEN = 'circuit_open'
+
+
+def classify_failure(error):
+    """Map an exception from gemini-webapi / httpx to a failure class"""
+    name = type(error).__name__
+    message = str(error).lower()
+
+    if name in ('UsageLimitExceededError', 'TemporarilyBlockedError') or '429' in message or 'too many requests' in message:
+        return RATE_LIMIT
+    if name == 'AuthError' or '401' in message or 'expired' in message or 'initialize client' in message:
+        return AUTH
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError, OSError)) or name in (
+        'TimeoutError', 'ConnectError', 'ReadTimeout', 'ConnectTimeout', 'RemoteProtocolError', 'ReadError'
+    ):
+        return NETWORK
+    return ERROR
+
+
+class Deadline:
+    """Absolute point in time a request must finish by"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+class RetryPolicy:
+    """
+    Per-class exponential backoff with jitter.
+
+    Delay after the n-th failure of a class (n >= 1) is drawn uniformly from
+    [c / 2, c] with c = min(base * 2**(n-1), max_delay): the first retry
+    waits up to `base`, each further one up to twice as long.
+    """
+
+    # Base delay (seconds) per failure class; AUTH is never retried
+    DEFAULT_BASE_DELAYS = {
+        RATE_LIMIT: 8.0,
+        EMPTY: 1.0,
+        NETWORK: 0.5,
+        ERROR: 1.0,
+    }
+
+    def __init__(self, base_delays=None, max_delay=30.0, min_attempt_time=5.0):
+        self.base_delays = dict(self.DEFAULT_BASE_DELAYS, **(base_delays or {}))
+        self.max_delay = max_delay
+        # Don't start an attempt with less time left than this
+        self.min_attempt_time = min_attempt_time
+
+    def retryable(self, failure_class):
+        return failure_class != AUTH
+
+    def delay(self, failure_class, failures_so_far):
+        """Backoff before the next attempt after `failures_so_far` failures of this class"""
+        base = self.base_delays.get(failure_class, self.base_delays[ERROR])
+        ceiling = min(self.max_delay, base * (2 ** max(0, failures_so_far - 1)))
+        return random.uniform(ceiling / 2, ceiling)
+
+
+def policy_from_env():
+    """Build the generation retry policy from RETRY_* environment variables"""
+    return RetryPolicy(
+        base_delays={
+            RATE_LIMIT: float(os.getenv('RETRY_RATE_LIMIT_BASE', '8')),
+            EMPTY: float(os.getenv('RETRY_EMPTY_BASE', '1')),
+            NETWORK: float(os.getenv('RETRY_NETWORK_BASE', '0.5')),
+            ERROR: float(os.getenv('RETRY_ERROR_BASE', '1')),
+        },
+        max_delay=float(os.getenv('RETRY_MAX_DELAY', '30')),
+        min_attempt_time=float(os.getenv('RETRY_MIN_ATTEMPT_TIME', '5')),
+    )
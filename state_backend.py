@@ -0,0 +1,296 @@
+"""
+Shared State Backend
+Key-value storage plus pub/sub for state that every worker process (and
+every node) must agree on: chat sessions and the primary Gemini cookies.
+
+    local  (default) a dict in this process. Right for a single worker;
+           with several workers each one has its own.
+
+    redis  a Redis-compatible server (Redis, Valkey, KeyDB) reached over the
+           network; needs the `redis` package. Values are stored as JSON,
+           read-modify-write updates are optimistic (WATCH/MULTI), and
+           published messages reach every process subscribed to the channel.
+           A local `redis-server` is enough to try it out.
+
+Published messages are invalidations for the other processes (the
+publisher has already applied the change itself): they say what changed,
+and subscribers re-read the value from the store. After the subscriber
+connection drops and comes back, callbacks are invoked with None so they
+can resync whatever they may have missed.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class LocalBackend:
+    """In-process store; there are no other processes to publish to"""
+
+    shared = False
+    name = 'local'
+    # Expired keys are dropped when read, and in a full sweep every this many writes
+    # (keys that are never read again would otherwise stay forever)
+    SWEEP_EVERY = 256
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}           # (namespace, key) -> (value, expires_at or None)
+        self._subscribers = {}    # channel -> [callback]
+        self._published = 0
+        self._writes = 0
+
+    def _live(self, item_key, now):
+        item = self._data.get(item_key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= now:
+            del self._data[item_key]
+            return None
+        return item
+
+    def _store(self, item_key, value, ttl):
+        # Caller holds the lock
+        now = time.time()
+        self._data[item_key] = (value, now + ttl if ttl else None)
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            for expired in [k for k, (_, expires_at) in self._data.items()
+                            if expires_at is not None and expires_at <= now]:
+                del self._data[expired]
+
+    def get(self, namespace, key):
+        with self._lock:
+            item = self._live((namespace, key), time.time())
+            return item[0] if item else None
+
+    def set(self, namespace, key, value, ttl=None):
+        with self._lock:
+            self._store((namespace, key), value, ttl)
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data.pop((namespace, key), None)
+
+    def touch(self, namespace, key, ttl):
+        """Restart a key's time to live (no-op for missing keys)"""
+        with self._lock:
+            item = self._live((namespace, key), time.time())
+            if item:
+                self._data[(namespace, key)] = (item[0], time.time() + ttl)
+
+    def update(self, namespace, key, fn, ttl=None):
+        """Atomically replace the value with fn(current value or None); None deletes it"""
+        with self._lock:
+            item = self._live((namespace, key), time.time())
+            value = fn(item[0] if item else None)
+            if value is None:
+                self._data.pop((namespace, key), None)
+            else:
+                self._store((namespace, key), value, ttl)
+            return value
+
+    def count(self, namespace):
+        now = time.time()
+        with self._lock:
+            return sum(1 for item_key in list(self._data) if item_key[0] == namespace and self._live(item_key, now))
+
+    def publish(self, channel, message):
+        with self._lock:
+            self._published += 1
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.name,
+                'keys': len(self._data),
+                'channels': len(self._subscribers),
+                'published': self._published,
+            }
+
+
+class RedisBackend:
+    """Redis-compatible server store with cross-process pub/sub"""
+
+    shared = True
+    name = 'redis'
+
+    def __init__(self, url, prefix='gemini'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package: pip install redis") from None
+        self._redis = redis
+        self.url = url
+        self.prefix = prefix
+        # redis-py's connection pool reconnects by itself after a fork
+        self.client = redis.Redis.from_url(url, health_check_interval=30)
+        self.origin = uuid.uuid4().hex   # tags our own messages so we can skip them
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._listener = None
+        self._pubsub = None
+        self._pid = None
+        self._published = 0
+        self._received = 0
+        self._conflicts = 0
+        self._reconnects = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}:{namespace}:{key}"
+
+    def _channel(self, channel):
+        return f"{self.prefix}:{channel}"
+
+    # --- key-value ---
+
+    def get(self, namespace, key):
+        raw = self.client.get(self._key(namespace, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, namespace, key, value, ttl=None):
+        self.client.set(self._key(namespace, key), json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, namespace, key):
+        self.client.delete(self._key(namespace, key))
+
+    def touch(self, namespace, key, ttl):
+        """Restart a key's time to live (no-op for missing keys)"""
+        self.client.expire(self._key(namespace, key), int(ttl))
+
+    def update(self, namespace, key, fn, ttl=None):
+        """Atomically replace the value with fn(current value or None); None deletes it"""
+        name = self._key(namespace, key)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(name)
+                    raw = pipe.get(name)
+                    value = fn(json.loads(raw) if raw is not None else None)
+                    pipe.multi()
+                    if value is None:
+                        pipe.delete(name)
+                    else:
+                        pipe.set(name, json.dumps(value), ex=int(ttl) if ttl else None)
+                    pipe.execute()
+                    return value
+                except self._redis.WatchError:
+                    # Another worker wrote the key in between: recompute from its value
+                    with self._lock:
+                        self._conflicts += 1
+
+    def count(self, namespace):
+        """Keys in a namespace (walks the keyspace with SCAN; meant for stats)"""
+        return sum(1 for _ in self.client.scan_iter(match=self._key(namespace, '*'), count=1000))
+
+    # --- pub/sub ---
+
+    def publish(self, channel, message):
+        """Send to every subscriber of channel in every process except this one"""
+        self.client.publish(self._channel(channel), json.dumps({'origin': self.origin, 'message': message}))
+        with self._lock:
+            self._published += 1
+
+    def subscribe(self, channel, callback):
+        """callback(message) for messages from other processes; callback(None) after a reconnect"""
+        with self._lock:
+            new_channel = channel not in self._subscribers
+            self._subscribers.setdefault(channel, []).append(callback)
+            pubsub = self._pubsub
+        if new_channel and pubsub is not None and self._pid == os.getpid():
+            pubsub.subscribe(self._channel(channel))
+        self._ensure_listener()
+
+    def _after_fork(self):
+        # The listener thread didn't survive the fork; the child needs its own origin and listener
+        self.origin = uuid.uuid4().hex
+        self._listener = None
+        self._pubsub = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if self._subscribers:
+            self._ensure_listener()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._listener = threading.Thread(target=self._listen, name='state-subscriber', daemon=True)
+            self._pid = os.getpid()
+            self._listener.start()
+
+    def _listen(self):
+        resync = False
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                with self._lock:
+                    channels = [self._channel(channel) for channel in self._subscribers]
+                    self._pubsub = pubsub
+                pubsub.subscribe(*channels)
+                if resync:
+                    for callbacks in list(self._subscribers.values()):
+                        for callback in list(callbacks):
+                            self._deliver(callback, None)
+                for item in pubsub.listen():
+                    payload = json.loads(item['data'])
+                    if payload.get('origin') == self.origin:
+                        continue
+                    channel = item['channel'].decode()[len(self.prefix) + 1:]
+                    with self._lock:
+                        self._received += 1
+                        callbacks = list(self._subscribers.get(channel, ()))
+                    for callback in callbacks:
+                        self._deliver(callback, payload.get('message'))
+            except self._redis.RedisError as e:
+                print(f"⚠️ State subscriber disconnected ({e}); reconnecting")
+                with self._lock:
+                    self._reconnects += 1
+                resync = True
+                time.sleep(1)
+            finally:
+                with self._lock:
+                    self._pubsub = None
+                pubsub.close()
+
+    @staticmethod
+    def _deliver(callback, message):
+        try:
+            callback(message)
+        except Exception as e:
+            print(f"⚠️ State subscriber callback failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.name,
+                'channels': len(self._subscribers),
+                'listening': bool(self._listener and self._listener.is_alive() and self._pid == os.getpid()),
+                'published': self._published,
+                'received': self._received,
+                'update_conflicts': self._conflicts,
+                'reconnects': self._reconnects,
+            }
+
+
+def backend_from_env():
+    """STATE_BACKEND local|redis; STATE_REDIS_URL and STATE_PREFIX configure redis"""
+    kind = os.getenv('STATE_BACKEND', 'local').strip().lower()
+    if kind == 'local':
+        return LocalBackend()
+    if kind == 'redis':
+        return RedisBackend(
+            os.getenv('STATE_REDIS_URL', 'redis://localhost:6379/0'),
+            prefix=os.getenv('STATE_PREFIX', 'gemini'),
+        )
+    raise ValueError(f"Unknown STATE_BACKEND: {kind}")
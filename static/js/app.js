@@ -792,6 +792,17 @@ async function downloadAllImages() {
         return;
     }
 
+    // Images served by this app: one ZIP, streamed by the server
+    if (state.generatedImages.every(image => image.url.startsWith('/static/'))) {
+        const query = state.generatedImages.map(image => `url=${encodeURIComponent(image.url)}`).join('&');
+        const link = document.createElement('a');
+        link.href = `/api/export?${query}`;
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+        return;
+    }
+
     // Download each image
     for (let i = 0; i < state.generatedImages.length; i++) {
         await downloadImage(state.generatedImages[i].url, i);
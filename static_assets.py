@@ -0,0 +1,273 @@
+"""
+Static Asset Delivery
+Cache-friendly serving of everything under static/, shared by the Flask and
+ASGI apps:
+
+    css/js and other bundled assets
+        Templates link them through fingerprinted URLs (asset_url), e.g.
+        /static/css/styles.3f2a9c1b7e4d.css. The hash changes whenever the
+        content does, so those URLs are cached for a year as immutable.
+        Text assets are precompressed once at startup (.gz, plus .br when the
+        optional `brotli` package is installed) into a separate directory
+        (STATIC_PRECOMPRESS_DIR, instance/static-compressed by default), so
+        static/ itself may be read-only, and served to clients that accept
+        the encoding. If that directory can't be written, the uncompressed
+        files are served.
+
+    generated/, upscaled/
+        Write-once outputs whose names are already unique, so they are
+        immutable as well. Generated images are negotiated on the Accept
+        header (Vary: Accept) and sent as WebP/AVIF where the client takes
+        them (see image_variants.py). Generated images that are not local
+        files (write-behind still pending, or object storage) come from
+        their output store (see output_storage.py).
+
+    anything else (including unfingerprinted asset URLs)
+        Served with `no-cache` so browsers revalidate with the strong ETag.
+
+Transmission can be handed to the front proxy (STATIC_SENDFILE):
+
+    x-accel-redirect  nginx: the response carries X-Accel-Redirect pointing at
+                      STATIC_ACCEL_PREFIX + path (an `internal` location with
+                      `alias .../static/;`). For `gzip_static on;` point
+                      STATIC_PRECOMPRESS_DIR at static/ so the .gz files sit
+                      next to the originals.
+    x-sendfile        Apache mod_xsendfile / lighttpd: X-Sendfile with the
+                      absolute file path
+"""
+
+import collections
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli for .br variants
+    brotli = None
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Write-once output directories
+GENERATED_DIRS = ('generated', 'upscaled')
+# Served as WebP/AVIF when accepted (upscales stay lossless PNGs)
+NEGOTIATED_DIRS = ('generated',)
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+MIN_COMPRESS_SIZE = 1024
+SENDFILE_MODES = ('x-accel-redirect', 'x-sendfile')
+
+# (file suffix, Content-Encoding) in order of preference
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+# Send the file at path, or body (bytes) if given; neither for 304s, redirects
+# and responses the front proxy completes
+StaticFile = collections.namedtuple('StaticFile', 'status path headers body', defaults=(None,))
+
+
+def _accepts(accept_encoding, coding):
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip() == coding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+def _write_atomic(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class StaticAssets:
+    """Fingerprint manifest, precompressed variants and response headers for static/"""
+
+    def __init__(self, root, url_prefix='/static', sendfile=None, accel_prefix='/_static/', variants=None,
+                 outputs=None, compressed_root=None):
+        """
+        Args:
+            compressed_root: directory for the .gz/.br variants (mirrors root's layout);
+                None to serve uncompressed files only
+        """
+        if sendfile and sendfile not in SENDFILE_MODES:
+            raise ValueError(f"Unknown STATIC_SENDFILE mode: {sendfile}")
+        self.root = os.path.abspath(root)
+        self.compressed_root = os.path.abspath(compressed_root) if compressed_root else None
+        self.url_prefix = url_prefix.rstrip('/')
+        self.sendfile = sendfile or None
+        self.accel_prefix = '/' + accel_prefix.strip('/') + '/'
+        self.variants = variants  # image_variants.ImageVariants, or None to always send originals
+        self.outputs = outputs or {}  # directory -> output_storage.OutputStore
+        self._fingerprinted = {}  # fingerprinted path -> (real path, digest)
+        self._urls = {}           # real path -> fingerprinted URL
+        self.build()
+
+    def build(self):
+        """Hash every bundled asset and write missing/stale compressed variants"""
+        for directory, subdirs, files in os.walk(self.root):
+            if directory == self.root:
+                subdirs[:] = [name for name in subdirs if name not in GENERATED_DIRS]
+            for name in files:
+                if name.endswith(('.gz', '.br', '.tmp')):
+                    continue
+                path = os.path.join(directory, name)
+                relpath = os.path.relpath(path, self.root).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                stem, ext = os.path.splitext(relpath)
+                fingerprinted = f"{stem}.{digest}{ext}"
+                self._fingerprinted[fingerprinted] = (relpath, digest)
+                self._urls[relpath] = f"{self.url_prefix}/{fingerprinted}"
+                if self.compressed_root and ext in COMPRESSIBLE and len(data) >= MIN_COMPRESS_SIZE:
+                    try:
+                        self._precompress(path, relpath, data)
+                    except OSError as e:
+                        # An optimisation only: serve the originals rather than fail to start
+                        print(f"⚠️ Can't write precompressed static files to {self.compressed_root} ({e}); "
+                              f"serving them uncompressed")
+                        self.compressed_root = None
+
+    def _compressed_path(self, relpath):
+        return os.path.join(self.compressed_root, *relpath.split('/'))
+
+    def _precompress(self, path, relpath, data):
+        target_base = self._compressed_path(relpath)
+        os.makedirs(os.path.dirname(target_base), exist_ok=True)
+        variants = [('.gz', lambda raw: gzip.compress(raw, 9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', lambda raw: brotli.compress(raw, quality=11)))
+        for suffix, compress in variants:
+            target = target_base + suffix
+            if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                continue
+            _write_atomic(target, compress(data))
+
+    def url(self, relpath):
+        """URL for a bundled asset (fingerprinted when known), for templates"""
+        relpath = relpath.lstrip('/')
+        return self._urls.get(relpath, f"{self.url_prefix}/{relpath}")
+
+    def resolve(self, relpath, accept_encoding='', if_none_match='', accept=''):
+        """
+        Work out how to answer GET /static/<relpath>.
+        May transcode a generated image on first request (blocking).
+
+        Returns:
+            StaticFile(status, path, headers), or None if there is no such file
+        """
+        vary = []
+        if relpath in self._fingerprinted:
+            relpath, digest = self._fingerprinted[relpath]
+            path = safe_join(self.root, relpath)
+            cache_control = IMMUTABLE
+            version = digest
+        else:
+            directory, _, name = relpath.partition('/')
+            store = self.outputs.get(directory)
+            if store is not None and (not name or '/' in name or name.startswith('.')):
+                return None
+            if store is not None and store.local_path(name) is None:
+                return self._resolve_output(store, name, if_none_match)
+            path = safe_join(self.root, relpath)
+            if path is None or not os.path.isfile(path):
+                return None
+            if directory in GENERATED_DIRS:
+                if self.variants is not None and directory in NEGOTIATED_DIRS:
+                    vary.append('Accept')
+                    path, fmt = self.variants.select(path, accept)
+                    if fmt:
+                        relpath = f"{relpath}.{fmt}"
+                # Never rewritten (upscales and variants get their mtime touched for LRU, so leave it out)
+                cache_control = IMMUTABLE
+                version = f"{os.path.splitext(os.path.basename(path))[0]}-{os.path.getsize(path):x}"
+            else:
+                stat = os.stat(path)
+                cache_control = REVALIDATE
+                version = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+        headers = {
+            'Cache-Control': cache_control,
+            'Content-Type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        }
+        if headers['Content-Type'].startswith('text/') or headers['Content-Type'] == 'application/javascript':
+            headers['Content-Type'] += '; charset=utf-8'
+
+        encoding = None
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            vary.append('Accept-Encoding')
+            # nginx picks the .gz itself (gzip_static) after an X-Accel-Redirect
+            if self.sendfile != 'x-accel-redirect' and self.compressed_root and relpath in self._urls:
+                compressed = self._compressed_path(relpath)
+                for suffix, coding in ENCODINGS:
+                    if _accepts(accept_encoding, coding) and os.path.exists(compressed + suffix):
+                        path, encoding = compressed + suffix, coding
+                        headers['Content-Encoding'] = coding
+                        break
+
+        if vary:
+            headers['Vary'] = ', '.join(vary)
+
+        # Strong ETag per representation
+        headers['ETag'] = f'"{version}-{encoding}"' if encoding else f'"{version}"'
+        if _etag_matches(if_none_match, headers['ETag']):
+            return StaticFile(304, None, headers)
+
+        if self.sendfile == 'x-accel-redirect':
+            headers['X-Accel-Redirect'] = self.accel_prefix + relpath
+            return StaticFile(200, None, headers)
+        if self.sendfile == 'x-sendfile':
+            headers['X-Sendfile'] = path
+            return StaticFile(200, None, headers)
+        headers['Content-Length'] = str(os.path.getsize(path))
+        return StaticFile(200, path, headers)
+
+    @staticmethod
+    def _resolve_output(store, name, if_none_match):
+        # Not a local file: still in the write-behind queue, or in object storage
+        data = store.pending(name)
+        if data is None:
+            url = store.public_url(name)
+            if url:
+                return StaticFile(302, None, {'Location': url, 'Cache-Control': IMMUTABLE})
+            data = store.read(name)
+            if data is None:
+                return None
+        headers = {
+            'Cache-Control': IMMUTABLE,
+            'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'ETag': f'"{os.path.splitext(name)[0]}-{len(data):x}"',
+        }
+        if _etag_matches(if_none_match, headers['ETag']):
+            return StaticFile(304, None, headers)
+        headers['Content-Length'] = str(len(data))
+        return StaticFile(200, None, headers, data)
+
+
+def assets_from_env(static_root, instance_path, variants=None, outputs=None):
+    """
+    STATIC_SENDFILE (x-accel-redirect | x-sendfile) and STATIC_ACCEL_PREFIX configure offloading;
+    STATIC_PRECOMPRESS_DIR is where .gz/.br variants go (empty: don't precompress)
+    """
+    compressed_root = os.getenv('STATIC_PRECOMPRESS_DIR')
+    if compressed_root is None:
+        compressed_root = os.path.join(instance_path, 'static-compressed')
+    return StaticAssets(
+        static_root,
+        sendfile=os.getenv('STATIC_SENDFILE', '').strip().lower() or None,
+        accel_prefix=os.getenv('STATIC_ACCEL_PREFIX', '/_static/'),
+        variants=variants,
+        outputs=outputs,
+        compressed_root=compressed_root.strip() or None,
+    )
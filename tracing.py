@@ -0,0 +1,174 @@
+"""
+Request Tracing and Structured Logs
+Gives each request a trace id that follows it through generation, the
+background event loop and image-processing threads (via contextvars), and
+records a per-stage / per-image timing breakdown for the response meta,
+plus an estimate of the request's peak image memory.
+
+Hot-path logging goes through log(), which writes one JSON object per line
+tagged with the trace id, so interleaved concurrent requests can be told apart.
+"""
+
+import contextlib
+import contextvars
+import json
+import sys
+import threading
+import time
+import uuid
+
+from metrics import REQUEST_PEAK_BYTES, STAGE_SECONDS
+
+
+TRACE_HEADER = 'X-Trace-Id'
+
+_current_trace = contextvars.ContextVar('gemini_trace', default=None)
+_current_image = contextvars.ContextVar('gemini_trace_image', default=None)
+_write_lock = threading.Lock()
+
+
+class Trace:
+    """Timing breakdown for one request"""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self._stages = {}   # stage -> [total seconds, count]
+        self._images = {}   # image index -> {stage: seconds}
+        self._held_bytes = 0
+        self.peak_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, image=None):
+        with self._lock:
+            totals = self._stages.setdefault(stage, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+            if image is not None:
+                per_image = self._images.setdefault(image, {})
+                per_image[stage] = per_image.get(stage, 0.0) + seconds
+
+    def hold(self, nbytes):
+        with self._lock:
+            self._held_bytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self._held_bytes)
+
+    def release(self, nbytes):
+        with self._lock:
+            self._held_bytes -= nbytes
+
+    def record_memory(self, nbytes):
+        """A transient allocation of nbytes on top of what the request currently holds"""
+        with self._lock:
+            self.peak_bytes = max(self.peak_bytes, self._held_bytes + nbytes)
+
+    def breakdown(self):
+        """Timing summary for response meta (milliseconds)"""
+        with self._lock:
+            return {
+                'total_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'peak_image_bytes': self.peak_bytes,
+                'stages': {
+                    stage: {'ms': round(total * 1000, 1), 'count': count}
+                    for stage, (total, count) in self._stages.items()
+                },
+                'images': [
+                    {'index': index, **{stage: round(seconds * 1000, 1) for stage, seconds in stages.items()}}
+                    for index, stages in sorted(self._images.items())
+                ],
+            }
+
+
+def start_trace(trace_id=None):
+    """Begin a trace for the current request (reuses a sane incoming id)"""
+    if trace_id and (len(trace_id) > 64 or not trace_id.replace('-', '').isalnum()):
+        trace_id = None
+    trace = Trace(trace_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(endpoint):
+    """Report the request's peak image memory (if it touched any images)"""
+    trace = _current_trace.get()
+    if trace is not None and trace.peak_bytes:
+        REQUEST_PEAK_BYTES.observe(trace.peak_bytes, endpoint=endpoint or 'unknown')
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextlib.contextmanager
+def image(index):
+    """Attribute stages inside this block (including worker threads started here) to an image"""
+    token = _current_image.set(index)
+    try:
+        yield
+    finally:
+        _current_image.reset(token)
+
+
+def record_stage(stage, seconds):
+    """Record an already-measured stage in the metrics histogram and the current trace"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record(stage, seconds, _current_image.get())
+
+
+@contextlib.contextmanager
+def holding(nbytes):
+    """Count nbytes (e.g. a downloaded image) against the current request while the block runs"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    trace.hold(nbytes)
+    try:
+        yield
+    finally:
+        trace.release(nbytes)
+
+
+def record_memory(nbytes):
+    """Record a transient allocation (e.g. an image operation's peak) for the current request"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record_memory(nbytes)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a pipeline stage for both /metrics and the request's trace"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def log(event, msg='', level='info', **fields):
+    """Write a structured JSON log line tagged with the current trace id"""
+    record = {
+        'ts': round(time.time(), 3),
+        'level': level,
+        'event': event,
+        'trace_id': current_trace_id(),
+    }
+    image_index = _current_image.get()
+    if image_index is not None:
+        record['image'] = image_index
+    if msg:
+        record['msg'] = msg
+    record.update(fields)
+
+    line = json.dumps(record, default=str, ensure_ascii=False)
+    with _write_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
@@ -0,0 +1,146 @@
+"""
+Upscale Result Cache
+Upscaled images are written once to a static directory and served from there.
+Entries are keyed by the source content hash, scale factor and output format,
+so repeated upscales of the same gallery image return the stored URL without
+decoding, resizing or re-encoding anything.
+
+The directory is the cache: every worker process sees the same entries, and
+a file's mtime is its LRU position (refreshed on each hit). When the total
+size passes the budget, the least recently used files are deleted.
+"""
+
+import hashlib
+import os
+import threading
+import uuid
+
+from PIL import Image
+
+import metrics
+
+
+class UpscaleCache:
+    """Size-bounded LRU store of upscaled outputs on disk"""
+
+    def __init__(self, directory, url_prefix, max_bytes):
+        self.directory = directory
+        self.url_prefix = url_prefix.rstrip('/')
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._costs = {}          # key -> CPU seconds it took to produce (this process)
+        self._cost_total = 0.0
+        self._cost_count = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._cpu_saved = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(data, scale, fmt):
+        """Cache key (also the file name) for an upscale of `data`"""
+        return f"up_{hashlib.sha256(data).hexdigest()[:40]}_x{scale}.{fmt}"
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Look up a cached output, moving it to the front of the LRU.
+
+        Returns:
+            {'url', 'size'} or None
+        """
+        path = self._path(key)
+        try:
+            os.utime(path)
+            with Image.open(path) as img:
+                size = img.size
+        except (OSError, ValueError):
+            # Missing (never stored, or evicted by another worker) or unreadable
+            with self._lock:
+                self._misses += 1
+            metrics.UPSCALE_CACHE_LOOKUPS.inc(result='miss')
+            return None
+
+        with self._lock:
+            self._hits += 1
+            # Entries produced by another process are credited with the average cost
+            saved = self._costs.get(key, self._cost_total / self._cost_count if self._cost_count else 0.0)
+            self._cpu_saved += saved
+        metrics.UPSCALE_CACHE_LOOKUPS.inc(result='hit')
+        metrics.UPSCALE_CACHE_CPU_SAVED.inc(saved)
+        return {'url': f"{self.url_prefix}/{key}", 'size': size}
+
+    def write(self, key, encoded):
+        """Store an encoded output (bytes-like) under `key`; returns its URL"""
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(encoded)
+        # Atomic: concurrent readers (and other workers) never see a partial file
+        os.replace(temp_path, path)
+        return f"{self.url_prefix}/{key}"
+
+    def record(self, key, cpu_seconds):
+        """Note what producing `key` cost, then evict down to the size budget"""
+        with self._lock:
+            self._costs[key] = cpu_seconds
+            self._cost_total += cpu_seconds
+            self._cost_count += 1
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name))
+        return entries
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+
+        evicted = 0
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass  # another worker got there first
+            total -= size
+            evicted += 1
+            with self._lock:
+                self._costs.pop(name, None)
+        with self._lock:
+            self._evictions += evicted
+
+    def stats(self):
+        entries = self._entries()
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 3) if lookups else 0.0,
+                'evictions': self._evictions,
+                'cpu_seconds_saved': round(self._cpu_saved, 2),
+            }
+
+
+def cache_from_env(static_root):
+    """UPSCALE_CACHE_MB bounds the on-disk cache (default 512MB)"""
+    return UpscaleCache(
+        os.path.join(static_root, 'upscaled'),
+        '/static/upscaled',
+        int(float(os.getenv('UPSCALE_CACHE_MB', '512')) * 1024 * 1024),
+    )
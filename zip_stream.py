@@ -0,0 +1,81 @@
+"""
+Streaming ZIP Writer
+Builds a ZIP archive as a generator of byte chunks, so an export can be
+sent while it is being assembled: no temporary file, and never more than
+one read chunk of any member in memory.
+
+zipfile writes into a sink without seek(), which makes it emit each member
+with a trailing data descriptor (CRC and sizes after the data) instead of
+going back to patch the local header. Members are STORED, not deflated:
+the exported images (JPEG/PNG/WebP) are compressed already.
+"""
+
+import os
+import time
+import zipfile
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _Sink:
+    """Write-only, unseekable file object that hands written bytes to the generator"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+
+def _member(arcname, date_time):
+    info = zipfile.ZipInfo(arcname, date_time)
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def stream_zip(entries):
+    """
+    Yield a ZIP archive of `entries` chunk by chunk.
+
+    Args:
+        entries: iterable of (arcname, source). source is a file path, or a
+                 callable returning the member's bytes (None to skip it),
+                 called only when the archive reaches that member.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for arcname, source in entries:
+            if callable(source):
+                data = source()
+                if data is not None:
+                    archive.writestr(_member(arcname, time.localtime()[:6]), data)
+            else:
+                try:
+                    f = open(source, 'rb')
+                except FileNotFoundError:
+                    continue  # removed since the export was requested (e.g. evicted upscale)
+                with f:
+                    date_time = time.localtime(os.fstat(f.fileno()).st_mtime)[:6]
+                    with archive.open(_member(arcname, date_time), 'w') as member:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            member.write(chunk)
+                            yield sink.drain()
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    # Central directory
+    yield sink.drain()